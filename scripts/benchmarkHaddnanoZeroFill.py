@@ -0,0 +1,91 @@
+#!/bin/env python
+# benchmark the back-filling of missing branches done by zeroFill() in haddnano.py: the original per-entry python loop
+# against the C++ loop HaddNano::FillBranch, checking that both give the same all-zero branches
+import ROOT
+import numpy
+import sys
+import time
+import os
+
+
+if len(sys.argv) < 2 :
+        print("Syntax: benchmarkHaddnanoZeroFill.py nEntries")
+        sys.exit(1)
+nEntries=int(sys.argv[1])
+
+# keep in sync with haddnano.py
+branch_type_dict = {'Bool_t':('?','O'), 'Float_t':('f4','F'), 'UInt_t':('u4','i'), 'Long64_t':('i8','L'), 'Double_t':('f8','D')}
+backFillBasketSize = 1024*1024
+maxBasketSize = 2**31-1
+
+if not hasattr(ROOT, "HaddNano"):
+        ROOT.gInterpreter.Declare("""
+        namespace HaddNano {
+        void FillBranch(TBranch* branch, Long64_t nEntries) {
+          for (Long64_t i = 0; i < nEntries; ++i)
+            branch->Fill();
+        }
+        }
+        """)
+
+
+def zeroFill(tree,brName,brObj,perEntry) :
+        # zeroFill() of haddnano.py, with the original per-entry python loop as reference
+        brType = brObj.GetLeaf(brName).GetTypeName()
+        buff=numpy.zeros(1,dtype=numpy.dtype(branch_type_dict[brType][0]))
+        b=tree.Branch(brName,buff,brName+"/"+branch_type_dict[brType][1])
+        treeDir=tree.GetDirectory()
+        if treeDir and treeDir.IsWritable() :
+                b.SetBasketSize(backFillBasketSize)
+        else :
+                b.SetBasketSize(min(tree.GetEntries()*max(2,buff.itemsize),maxBasketSize))
+        if perEntry :
+                for x in range(0,tree.GetEntries()):
+                        b.Fill()
+        else :
+                ROOT.HaddNano.FillBranch(b,tree.GetEntries())
+        b.ResetAddress()
+
+
+def GetBranchValues(tree,brName) :
+        values=[]
+        for entry in range(tree.GetEntries()) :
+                tree.GetBranch(brName).GetEntry(entry)
+                values.append(tree.GetLeaf(brName).GetValue())
+        return values
+
+
+print("Benchmarking zeroFill with {} entries".format(nEntries))
+template=ROOT.TTree("template","template")
+template.SetDirectory(0)
+buffs=[]
+for brType,(npType,rootType) in branch_type_dict.items() :
+        buffs.append(numpy.zeros(1,dtype=numpy.dtype(npType)))
+        template.Branch("b_"+brType,buffs[-1],"b_"+brType+"/"+rootType)
+for label in ["in memory","in a writable file"] :
+        for brType in branch_type_dict.keys() :
+                brName="b_"+brType
+                timings=[]
+                values=[]
+                for perEntry in [True,False] :
+                        tree=ROOT.TTree("bench","bench")
+                        if label=="in memory" :
+                                tree.SetDirectory(0)
+                        else :
+                                benchFile=ROOT.TFile.Open("haddnano_benchmark.root","recreate")
+                                tree.SetDirectory(benchFile)
+                                ROOT.SetOwnership(tree,False)  # deleted with the file
+                        tree.SetEntries(nEntries)
+                        start=time.time()
+                        zeroFill(tree,brName,template.GetBranch(brName),perEntry)
+                        timings.append(time.time()-start)
+                        if tree.GetBranch(brName).GetEntries()!=nEntries :
+                                raise RuntimeError("Back-filled branch {} {} has {} entries instead of {}".format(brName,label,tree.GetBranch(brName).GetEntries(),nEntries))
+                        values.append(GetBranchValues(tree,brName))
+                        if label!="in memory" :
+                                benchFile.Close()
+                                os.remove("haddnano_benchmark.root")
+                if values[0]!=values[1] or any(values[0]) :
+                        raise RuntimeError("Back-filled branch {} {} differs between the per-entry loop and FillBranch, or is not all zeros".format(brName,label))
+                print("{:>9} {:>20}: per-entry loop {:8.3f} s, FillBranch {:8.3f} s, speedup {:6.1f}".format(
+                        brType,label,timings[0],timings[1],timings[0]/max(timings[1],1e-9)))
@@ -30,6 +30,7 @@ from ROOT import (
 import ROOT
 import numpy as np
 import copy
+import combineCommon
 import ctypes
 import sys
 import os
@@ -106,55 +107,12 @@ def GetCanvasTitle(varName, region, jetBin):
     return titleStr
 
 
-def GetFakeRate(shortVarName, lowEnd, highEnd, reg, jets, histDict, verbose=False):
-    verbose = True
-    histo_Electrons = histDict[reg]["Electrons"][jets]
-    histo_Jets = histDict[reg]["Jets"][jets]
-    histo_Data = histDict[reg]["Total"][jets]
-    if verbose:
-        print("\t\tGetFakeRate: Considering region=", reg)
-        print("\t\tGetFakeRate: Considering jets=", jets)
-        print(
-            "\t\tGetFakeRate: Considering electron Pt:",
-            str(lowEnd) + "-" + str(highEnd),
-            "GeV",
-        )
-        print(
-            "\t\tGetFakeRate: Considering histo for electrons=>",
-            histo_Electrons.GetName(),
-            "; histo for jets=>",
-            histo_Jets.GetName(),
-            "; histo for data=>",
-            histo_Data.GetName(),
-        )
-        sys.stdout.flush()
-    if "2D" in histo_Electrons.GetName():
-        proj_Electrons = histo_Electrons.ProjectionY(
-            "Eles" + shortVarName,
-            histo_Electrons.GetXaxis().FindBin(lowEnd),
-            histo_Electrons.GetXaxis().FindBin(highEnd) - 1,
-        )
-        proj_Jets = histo_Jets.ProjectionY(
-            "Jets" + shortVarName,
-            histo_Jets.GetXaxis().FindBin(lowEnd),
-            histo_Jets.GetXaxis().FindBin(highEnd) - 1,
-        )
-        proj_Data = histo_Data.ProjectionY(
-            "Data" + shortVarName,
-            histo_Data.GetXaxis().FindBin(lowEnd),
-            histo_Data.GetXaxis().FindBin(highEnd) - 1,
-        )
-    else:
-        proj_Electrons = histo_Electrons
-        proj_Data = histo_Data
-        proj_Jets = histo_Jets
-    # proj_JetsEle_ = proj_Jets.Clone()
-    # proj_JetsEle_.SetName('JetsEleTrkIso')
-    if "TrkIsoHEEP7" in histo_Electrons.GetName():
+def GetSidebandAndSignalLimits(histName, reg, lowEnd):
+    if "TrkIsoHEEP7" in histName:
         upperSBLimit = 20  # GeV
         lowerSBLimit = 10
         upperSRLimit = 5
-    elif "PFRelIso" in histo_Electrons.GetName():
+    elif "PFRelIso" in histName:
         if float(lowEnd) >= 500:
             lowerSBLimit = 0.15
             upperSBLimit = 0.2
@@ -171,127 +129,177 @@ def GetFakeRate(shortVarName, lowEnd, highEnd, reg, jets, histDict, verbose=Fals
     else:
         raise RuntimeError(
             "Don't know how to determine SR/SB for histo named: {}".format(
-                histo_Electrons.GetName()
-            )
-        )
-    eleSBErr = ctypes.c_double()
-    eleSB = proj_Electrons.IntegralAndError(
-        proj_Electrons.GetXaxis().FindBin(lowerSBLimit),
-        proj_Electrons.GetXaxis().FindBin(upperSBLimit) - 1,
-        eleSBErr,
-    )
-    # data = proj_Data_.Integral(proj_Data_.GetXaxis().FindBin(10),proj_Data_.GetXaxis().FindBin(20)-1)
-    dataErr = ctypes.c_double()
-    data = proj_Data.IntegralAndError(
-        proj_Data.GetXaxis().GetFirst(), proj_Data.GetXaxis().GetLast(), dataErr
-    )
-    jets_SBErr = ctypes.c_double()
-    jets_SB = proj_Jets.IntegralAndError(
-        proj_Jets.GetXaxis().FindBin(lowerSBLimit),
-        proj_Jets.GetXaxis().FindBin(upperSBLimit) - 1,
-        jets_SBErr,
-    )
-    jets_SRErr = ctypes.c_double()
-    jets_SR = proj_Jets.IntegralAndError(
-        proj_Jets.GetXaxis().GetFirst(),
-        proj_Jets.GetXaxis().FindBin(upperSRLimit) - 1,
-        jets_SRErr,
-    )
-    print("jetsSR = ",jets_SR)
-    print("jetsSB = ",jets_SB)
-    if jets_SB == 0:
-        rJets = 0
-        if jets_SR == 0:
-            rJetsErr = math.sqrt(jets_SRErr.value ** 2 + jets_SBErr.value ** 2)
-        else:
-            rJetsErr = jets_SRErr.value / jets_SR
-    else:
-        rJets = jets_SR / jets_SB
-        if jets_SR==0:
-            rJetsErr = math.sqrt(jets_SRErr.value ** 2 + jets_SBErr.value ** 2)
-        else:
-            rJetsErr = (jets_SR / jets_SB) * math.sqrt(
-                (jets_SRErr.value / jets_SR) ** 2 + (jets_SBErr.value / jets_SB) ** 2
+                histName
             )
-    numerator = rJets * eleSB
-    try:
-        numeratorErr = numerator * math.sqrt(
-            (rJetsErr / rJets) ** 2 + (eleSBErr.value / eleSB) ** 2
         )
-    except ZeroDivisionError as e:
-        if eleSB == 0:
-            if rJets != 0:
-                numeratorErr = numerator * math.sqrt((rJetsErr / rJets) ** 2)
-                print(
-                    "WARN: GetFakeRate:  Had a ZeroDivisionError in numeratorError; ele==0, so ignore it in error computation"
-                )
-            else:
-                numeratorErr = math.sqrt(rJetsErr ** 2 + eleSBErr.value ** 2)
-        elif rJets == 0:
-            numeratorErr = numerator * math.sqrt((eleSBErr.value / eleSB) ** 2)
-            print(
-                "WARN: GetFakeRate:  Had a ZeroDivisionError in numeratorError; rJets==0, so ignore it in error computation"
-            )
+    return lowerSBLimit, upperSBLimit, upperSRLimit
+
+
+class ProjectionArrays:
+    # y projections of a 2D histo (or the 1D histo itself) for a list of x ranges, as (nBinsY+2, nRanges) arrays of contents and sumw2
+    # the histo is read into numpy once; all projections come from one cumulative sum along x
+    def __init__(self, histo, lowEnds, highEnds):
+        self.histo = histo
+        nCellsY = histo.GetNbinsY() + 2 if "2D" in histo.GetName() else histo.GetNbinsX() + 2
+        nCellsX = histo.GetNcells() // nCellsY
+        contents, _ = combineCommon.GetHistoBinContentArrays(histo)
+        sumw2 = np.array(combineCommon.GetHistoSumw2Array(histo), dtype=np.float64)
+        # global bin = xBin + (nBinsX+2)*yBin
+        contents = contents.reshape(nCellsY, nCellsX)
+        sumw2 = sumw2.reshape(nCellsY, nCellsX)
+        if "2D" in histo.GetName():
+            xAxis = histo.GetXaxis()
+            firstBins = np.array([xAxis.FindBin(lowEnd) for lowEnd in lowEnds])
+            lastBins = np.array([xAxis.FindBin(highEnd) - 1 for highEnd in highEnds])
+            self.yAxis = histo.GetYaxis()
         else:
-            print(
-                "ERROR in GetFakeRate:  Had a ZeroDivisionError in numeratorError; rJets=",
-                rJets,
-                "; eleSB=",
-                eleSB,
-            )
-            sys.stdout.flush()
-            raise e
+            # 1D histos are used as they are for every pT bin
+            firstBins = np.zeros(len(lowEnds), dtype=int)
+            lastBins = np.zeros(len(lowEnds), dtype=int)
+            self.yAxis = histo.GetXaxis()
+        self.contents = self.SumRanges(contents, firstBins, lastBins)
+        self.sumw2 = self.SumRanges(sumw2, firstBins, lastBins)
+        self.cumContents = np.vstack([np.zeros(len(lowEnds)), np.cumsum(self.contents, axis=0)])
+        self.cumSumw2 = np.vstack([np.zeros(len(lowEnds)), np.cumsum(self.sumw2, axis=0)])
+
+    @staticmethod
+    def SumRanges(array, firstBins, lastBins):
+        # sum of columns firstBin..lastBin (inclusive, clamped to the under/overflow like TH2::ProjectionY) for each range
+        nCells = array.shape[1]
+        cumArray = np.hstack([np.zeros((array.shape[0], 1)), np.cumsum(array, axis=1)])
+        firstBins = np.clip(firstBins, 0, nCells - 1)
+        lastBins = np.clip(lastBins, 0, nCells - 1)
+        return np.where(lastBins >= firstBins, cumArray[:, lastBins + 1] - cumArray[:, firstBins], 0.0)
+
+    def IntegralAndError(self, firstBins, lastBins):
+        # like TH1::IntegralAndError(firstBin, lastBin) on each projection, including its handling of out-of-range bins
+        nCells = self.contents.shape[0]
+        firstBins = np.clip(np.asarray(firstBins), 0, nCells - 1)
+        lastBins = np.asarray(lastBins)
+        lastBins = np.where((lastBins > nCells - 1) | (lastBins < firstBins), nCells - 1, lastBins)
+        cols = np.arange(self.contents.shape[1])
+        integral = self.cumContents[lastBins + 1, cols] - self.cumContents[firstBins, cols]
+        error = np.sqrt(np.maximum(self.cumSumw2[lastBins + 1, cols] - self.cumSumw2[firstBins, cols], 0.0))
+        return integral, error
+
+    def FindBins(self, values):
+        return np.array([self.yAxis.FindBin(value) for value in values])
+
+    def MakeProjection(self, name, lowEnd, highEnd):
+        # ROOT's own projection, for writing out the same histos as the per-bin code did
+        if "2D" in self.histo.GetName():
+            xAxis = self.histo.GetXaxis()
+            return self.histo.ProjectionY(name, xAxis.FindBin(lowEnd), xAxis.FindBin(highEnd) - 1)
+        return self.histo.Clone(name)
+
+
+def GetFakeRates(shortVarName, bins, reg, jets, histDict, verbose=False):
+    # data-driven fake rate numerators and denominators (with errors) for all pT bins at once, as arrays
+    histo_Electrons = histDict[reg]["Electrons"][jets]
+    histo_Jets = histDict[reg]["Jets"][jets]
+    histo_Data = histDict[reg]["Total"][jets]
+    lowEnds = bins[:-1]
+    highEnds = bins[1:]
     if verbose:
+        print("\t\tGetFakeRates: Considering region=", reg)
+        print("\t\tGetFakeRates: Considering jets=", jets)
         print(
-            "\t\tGetFakeRate: Considering hists:",
+            "\t\tGetFakeRates: Considering histo for electrons=>",
             histo_Electrons.GetName(),
-            ",",
+            "; histo for jets=>",
             histo_Jets.GetName(),
-            ",",
+            "; histo for data=>",
             histo_Data.GetName(),
         )
-        # print 'endcap1 N_jet>=0: Nele=',ele,'data=',data,'contam=',ele/data
-        # print 'barrel N_jet>=0: Nele=',ele,'data=',data,'contam=',ele/data
+        sys.stdout.flush()
+    proj_Electrons = ProjectionArrays(histo_Electrons, lowEnds, highEnds)
+    proj_Jets = ProjectionArrays(histo_Jets, lowEnds, highEnds)
+    proj_Data = ProjectionArrays(histo_Data, lowEnds, highEnds)
+    limits = np.array([GetSidebandAndSignalLimits(histo_Electrons.GetName(), reg, lowEnd) for lowEnd in lowEnds])
+    lowerSBLimits, upperSBLimits, upperSRLimits = limits[:, 0], limits[:, 1], limits[:, 2]
+    nBins = len(lowEnds)
+
+    eleSB, eleSBErr = proj_Electrons.IntegralAndError(
+        proj_Electrons.FindBins(lowerSBLimits),
+        proj_Electrons.FindBins(upperSBLimits) - 1,
+    )
+    data, dataErr = proj_Data.IntegralAndError(
+        np.full(nBins, proj_Data.yAxis.GetFirst()), np.full(nBins, proj_Data.yAxis.GetLast())
+    )
+    jets_SB, jets_SBErr = proj_Jets.IntegralAndError(
+        proj_Jets.FindBins(lowerSBLimits),
+        proj_Jets.FindBins(upperSBLimits) - 1,
+    )
+    jets_SR, jets_SRErr = proj_Jets.IntegralAndError(
+        np.full(nBins, proj_Jets.yAxis.GetFirst()),
+        proj_Jets.FindBins(upperSRLimits) - 1,
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rJets = np.where(jets_SB == 0, 0.0, jets_SR / jets_SB)
+        rJetsErr = np.where(
+            jets_SR == 0,
+            np.sqrt(jets_SRErr ** 2 + jets_SBErr ** 2),
+            np.where(
+                jets_SB == 0,
+                jets_SRErr / jets_SR,
+                rJets * np.sqrt((jets_SRErr / jets_SR) ** 2 + (jets_SBErr / jets_SB) ** 2),
+            ),
+        )
+        numerator = rJets * eleSB
+        numeratorErr = numerator * np.sqrt((rJetsErr / rJets) ** 2 + (eleSBErr / eleSB) ** 2)
+        # when rJets or eleSB vanish, the zero term is left out of the relative error
+        numeratorErr = np.where(
+            eleSB == 0,
+            np.where(rJets != 0, numerator * np.sqrt((rJetsErr / rJets) ** 2), np.sqrt(rJetsErr ** 2 + eleSBErr ** 2)),
+            np.where(rJets == 0, numerator * np.sqrt((eleSBErr / eleSB) ** 2), numeratorErr),
+        )
+    for idx in np.flatnonzero((rJets == 0) != (eleSB == 0)):
         print(
-            "\t\tGetFakeRate: nEle'SB=",
-            eleSB,
-            " +/-",
-            eleSBErr.value,
-            "; jetsSR=",
-            jets_SR,
-            "+/-",
-            jets_SRErr.value,
-            "; jetsSB=",
-            jets_SB,
-            "+/-",
-            jets_SBErr.value,
-            "; num=",
-            numerator,
-            "+/-",
-            numeratorErr,
-            "; data=",
-            data,
-            "+/-",
-            dataErr.value,
+            "WARN: GetFakeRates: Had a zero {} for Pt {}-{} in numeratorError; ignore it in error computation".format(
+                "ele" if eleSB[idx] == 0 else "rJets", lowEnds[idx], highEnds[idx])
         )
-        sys.stdout.flush()
-        print("\t\tGetFakeRate: FR=", numerator / data)
+    if verbose:
+        for idx in range(nBins):
+            print(
+                "\t\tGetFakeRates: Pt {}-{} GeV:".format(lowEnds[idx], highEnds[idx]),
+                "nEle'SB=",
+                eleSB[idx],
+                " +/-",
+                eleSBErr[idx],
+                "; jetsSR=",
+                jets_SR[idx],
+                "+/-",
+                jets_SRErr[idx],
+                "; jetsSB=",
+                jets_SB[idx],
+                "+/-",
+                jets_SBErr[idx],
+                "; num=",
+                numerator[idx],
+                "+/-",
+                numeratorErr[idx],
+                "; data=",
+                data[idx],
+                "+/-",
+                dataErr[idx],
+                "; FR=",
+                numerator[idx] / data[idx] if data[idx] != 0 else float("nan"),
+            )
         sys.stdout.flush()
     if writeOutput:
-        suffix = "_" + reg + "_" + jets + "Pt" + str(lowEnd) + "To" + str(highEnd)
-        if not outputFile.cd(shortVarName + "_Electrons"):
-            outputFile.mkdir(shortVarName + "_Electrons").cd()
-        proj_Electrons.SetName(proj_Electrons.GetName() + suffix)
-        proj_Electrons.Write()
-        if not outputFile.cd(shortVarName + "_Jets"):
-            outputFile.mkdir(shortVarName + "_Jets").cd()
-        proj_Jets.SetName(proj_Jets.GetName() + suffix)
-        proj_Jets.Write()
-        if not outputFile.cd(shortVarName + "_Data"):
-            outputFile.mkdir(shortVarName + "_Data").cd()
-        proj_Data.SetName(proj_Data.GetName() + suffix)
-        proj_Data.Write()
-    return numerator, numeratorErr, data, dataErr.value
+        for idx in range(nBins):
+            suffix = "_" + reg + "_" + jets + "Pt" + str(lowEnds[idx]) + "To" + str(highEnds[idx])
+            for projName, proj in [("Electrons", proj_Electrons), ("Jets", proj_Jets), ("Data", proj_Data)]:
+                if not outputFile.cd(shortVarName + "_" + projName):
+                    outputFile.mkdir(shortVarName + "_" + projName).cd()
+                histName = {"Electrons": "Eles", "Jets": "Jets", "Data": "Data"}[projName] + shortVarName + suffix
+                proj.MakeProjection(histName, lowEnds[idx], highEnds[idx]).Write()
+    return numerator, numeratorErr, data, dataErr
+
+
+def GetFakeRate(shortVarName, lowEnd, highEnd, reg, jets, histDict, verbose=False):
+    num, numErr, den, denErr = GetFakeRates(shortVarName, [lowEnd, highEnd], reg, jets, histDict, verbose)
+    return num[0], numErr[0], den[0], denErr[0]
 
 
 def GetFakeRateFractionFit(
@@ -658,6 +666,12 @@ def MakeFakeRatePlot(
         len(bins) - 1,
         np.array(bins, dtype=float),
     )
+    shortVarName = varName.split("vs")[0]
+    if dataDriven and not fractionFit:
+        # all pT bins at once
+        nums, numErrs, dens, denErrs = GetFakeRates(
+            shortVarName, bins, reg, jets, histDict, verbose
+        )
     for index, binLow in enumerate(bins):
         if index >= (len(bins) - 1):
             break
@@ -665,16 +679,13 @@ def MakeFakeRatePlot(
         if verbose:
             print("\tMakeFakeRatePlot:look at Pt:", str(binLow) + "-" + str(binHigh))
             sys.stdout.flush()
-        shortVarName = varName.split("vs")[0]
         if dataDriven:
             if fractionFit:
                 num, numErr, den, denErr = GetFakeRateFractionFit(
                     shortVarName, binLow, binHigh, reg, jets, histDict, verbose
                 )
             else:
-                num, numErr, den, denErr = GetFakeRate(
-                    shortVarName, binLow, binHigh, reg, jets, histDict, verbose
-                )
+                num, numErr, den, denErr = nums[index], numErrs[index], dens[index], denErrs[index]
         else:
             num, numErr, den, denErr = GetFakeRateMCSub(
                 shortVarName, binLow, binHigh, reg, jets, histDict, verbose
@@ -1,12 +1,18 @@
 #!/usr/bin/env python3
 
-import sys
+import os
 import glob
+import json
+import multiprocessing
+import sqlite3
+import concurrent.futures
+from optparse import OptionParser
 from pathlib import Path
 import subprocess
 import shlex
 import re
 from tabulate import tabulate
+from dasResolver import DasResolver
 import ROOT as r
 
 
@@ -16,25 +22,6 @@ def appendSlash(dirName):
     return dirName
 
 
-def GetNEventsFromRootFile(rootFileURL, treeName = "Events"):
-    r.gErrorIgnoreLevel = r.kWarning
-    tfile = r.TFile.Open(rootFileURL)
-    nevents = tfile.Get(treeName).GetEntries()
-    tfile.Close()
-    r.gErrorIgnoreLevel = r.kPrint
-    return nevents
-
-
-def GetNEventsFromFiles(fileList, treeName = "Events"):
-    r.gErrorIgnoreLevel = r.kWarning+1
-    tchain = r.TChain(treeName)
-    for rootFileURL in fileList:
-        tchain.Add(rootFileURL)
-    nevents = tchain.GetEntries()
-    r.gErrorIgnoreLevel = r.kPrint
-    return nevents
-
-
 def GetDatasets(datasetListFile):
     datasets = []
     with open(datasetListFile, "r") as datasetList:
@@ -46,104 +33,16 @@ def GetDatasets(datasetListFile):
     return datasets
 
 
-def GetFileEventsMapFromDAS(datasetList):
+def GetFileEventsMapFromDAS(datasetList, dasCache=None):
+    # the answers are kept in the DAS resolver cache, so repeated checks do not query DAS again
+    resolver = DasResolver(dasCache)
     fileNameToNEventsDict = {}
-    datasets = GetDatasets(datasetsFile)
-    cmdsToRun = []
-    for dataset in datasets:
-        dataset = dataset.strip("\n")
-        query = "file dataset={} | grep file.name, file.nevents".format(dataset)
-        cmd = 'dasgoclient --query="{}" --limit=-1'.format(query)
-        cmdsToRun.append(cmd)
-    # use 6 processes in parallel
-    procsToUse = 6
-    for i in range(0, len(cmdsToRun), procsToUse):
-         cmds = cmdsToRun[i:i+procsToUse]
-         procs = [subprocess.Popen(shlex.split(i), stdout=subprocess.PIPE, stderr=subprocess.PIPE) for i in cmds]
-         for idx, p in enumerate(procs):
-             res = p.communicate()
-             if p.returncode != 0:
-                  raise RuntimeError("DAS command failed with stderr =", res[1])
-             output = res[0].decode()
-             split = output.split()
-             it = iter(split)
-             for element in it:
-                 fileName = element
-                 nEvents = next(it)
-                 fileNameToNEventsDict[fileName] = int(nEvents)
+    for fileNamesToNEventsDict in resolver.Resolve(GetDatasets(datasetList)).values():
+        fileNameToNEventsDict.update(fileNamesToNEventsDict)
+    resolver.Close()
     return fileNameToNEventsDict
 
 
-def CheckEventsProcessedPerJob(datasetFileNameEventsDict):
-    fileList = glob.glob(localDir+"**/submit_*.sh", recursive=True)
-    if len(fileList) < 0:
-        raise RuntimeError("Could not find any submit files in localDir {}".format(localDir))
-    for srcFile in fileList:
-        index = srcFile.split("_")[-1].split(".")[0]
-        path = Path(srcFile)
-        datasetDir = str(path.parent.absolute().parent)+"/"
-        dataset = datasetDir.split("___")[1].strip("/")
-        if dataset not in datasetFileNameEventsDict.keys():
-            # print("INFO: skipping dataset {} which is not in datasetFileNameEventsDict.keys(): {}".format(dataset, datasetFileNameEventsDict.keys()), flush=True)
-            continue
-        filesProcessed = []
-        with open(srcFile, 'r') as thisFile:
-            for line in thisFile:
-                if "haddnano.py" in line and not "echo" in line:
-                    filesProcessed =  line.split()[2:]
-                    # print("DEBUG: found line='{}'; filesProcessed={}".format(line, filesProcessed))
-                    break
-        if len(filesProcessed) < 1:
-            raise RuntimeError("Did not find any input files processed when parsing file {}. Cannot check for correct number of events processed.".format(srcFile))
-        eventsExpected = 0
-        filesToReadFrom = []
-        for rootFile in filesProcessed:
-            fileName = "/"+rootFile.split("//")[-1]
-            try:
-                eventsExpected += datasetFileNameEventsDict[dataset][fileName]
-            except KeyError:
-                print("WARN: could not find key {} in datasetFileNameEventsDict[{}]. Getting events expected manually (very slow).".format(fileName, dataset))
-                filesToReadFrom.append(rootFile)
-        if len(filesToReadFrom) > 0:
-            eventsExpected += GetNEventsFromFiles(filesToReadFrom)
-        datFiles = glob.glob(datasetDir+"output/*_{}.dat".format(index), recursive=True)
-        if len(datFiles) > 1:
-            raise RuntimeError("Didn't get exactly 1 dat file matching pattern '{}': {}. There should only be one.".format(datasetDir+"output/*_{}.dat".format(index), datFiles))
-        elif len(datFiles) == 0:
-            print("ERROR: Something happened with the job for src file {}: was not able to find dat file matching pattern '{}'.".format(srcFile, datasetDir+"output/*_{}.dat".format(index)))
-            continue
-        datFilename = datFiles[0]
-        eventsProcessed = 0
-        with open(datFilename, 'r') as datFile:
-            for line in datFile:
-                splitLine = line.split()
-                if splitLine[1] == "nocut":
-                    eventsProcessed = int(splitLine[7])
-                    eventsProcessedPass = int(splitLine[8])
-                    assert(eventsProcessed == eventsProcessedPass)
-                    assert(eventsProcessed > 0)
-                    break
-        if eventsExpected != eventsProcessed:
-            print("ERROR: Something happened with the job for src file {}: expected {} events but processed {}".format(srcFile, eventsExpected, eventsProcessed))
-
-
-####################################################################################################
-# Run
-####################################################################################################
-#FIXME change to optparser
-if len(sys.argv) < 3:
-    raise RuntimeError("Incorrect number of arguments\n. Usage: inputList localDir [outputFileDir].")
-
-inputListFile = sys.argv[1]
-localDir = sys.argv[2]
-if len(sys.argv) > 3:
-    outputDir = sys.argv[3]
-else:
-    outputDir = localDir
-
-localDir = appendSlash(localDir)
-outputDir = appendSlash(outputDir)
-
 harmlessErrorMessages = ["WARNING: While bind mounting", "INFO:    Environment variable", "TClass::Init:0: RuntimeWarning: no dictionary for class"]
 harmlessErrorMessages.append("Environment variable SINGULARITY")
 harmlessErrorMessages.append("Unable to set SINGULARITY")
@@ -161,46 +60,122 @@ harmlessErrorMessages.append("gnuplot: error while loading shared libraries: lib
 harmlessOutMessages = ["xrdfs locate"]
 harmlessOutMessages = ["use default XRootD redirector"]
 
-print("Checking that all events expected were processed from datasets in given inputList...", flush = True)
-fileToEventsDict = {}
-with open(inputListFile, "r") as inputList:
-    for line in inputList:
-        if not len(line.strip()) > 0:
-            continue
-        if line.strip().startswith("#"):
-            continue
-        dataset = line.strip().split("/")[-1].split(".txt")[0]
-        fileToEventsDict[dataset] = {}
-        fileListFile = line.strip()
-        eventsFilename = fileListFile.replace(".txt", "_nevents.txt")
-        eventsFileList = glob.glob(eventsFilename)
-        if len(eventsFileList) != 1:
-            raise RuntimeError("Could not find 1 nevents file '{}' as expected.".format(eventsFilename))
+
+def GetStoreFileName(rootFileURL):
+    # need to remove the redirector prefix
+    return re.sub("root://.*/store", "/store", rootFileURL)
+
+
+def GetDatasetFromPath(fileName):
+    # job files live in <localDir>/analysisClass_<code>___<dataset>/<src|output|error>/
+    datasetDir = str(Path(fileName).parent.absolute().parent)+"/"
+    return datasetDir, datasetDir.split("___")[1].strip("/")
+
+
+class EventCountCatalog:
+    # number of events per input file, kept in SQLite so that the nevents lists and DAS answers are parsed once,
+    # and files missing from both are opened only once
+    def __init__(self, catalogPath):
+        self.db = sqlite3.connect(catalogPath)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, nEvents INTEGER);
+            CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, mtime REAL);
+        """)
+
+    def Close(self):
+        self.db.close()
+
+    def IsSourceUpToDate(self, sourcePath, mtime):
+        row = self.db.execute("SELECT mtime FROM sources WHERE path = ?", (sourcePath,)).fetchone()
+        return row is not None and row[0] == mtime
+
+    def Fill(self, fileNameToNEventsDict, sourcePath=None, mtime=None):
+        self.db.executemany("INSERT OR REPLACE INTO files (path, nEvents) VALUES (?, ?)", fileNameToNEventsDict.items())
+        if sourcePath is not None:
+            self.db.execute("INSERT OR REPLACE INTO sources (path, mtime) VALUES (?, ?)", (sourcePath, mtime))
+        self.db.commit()
+
+    def FillFromEventsList(self, fileListFile, eventsFilename):
+        # returns False if the lists did not change since they were last read
+        mtime = max(os.path.getmtime(fileListFile), os.path.getmtime(eventsFilename))
+        if self.IsSourceUpToDate(eventsFilename, mtime):
+            return False
+        fileNameToNEventsDict = {}
         with open(fileListFile, "r") as fileList, open(eventsFilename, "r") as eventsFile:
             for fileLine, eventsLine in zip(fileList, eventsFile):
                 if not len(fileLine.strip()) > 0:
                     continue
                 if fileLine.strip().startswith("#"):
                     continue
-                fileURL = fileLine.strip()
-                fileURL = re.sub("root://.*/store", "/store", fileURL)  # need to remove prefix
-                fileToEventsDict[dataset][fileURL] = int(eventsLine)
-CheckEventsProcessedPerJob(fileToEventsDict)
-print ("Done.", flush = True)
-
-print("Grepping error files for datasets in given inputList...")
-fileList = glob.glob(localDir+"**/*.err", recursive=True)
-filesAndErrorOutput = {}
-for errFile in fileList:
-    path = Path(errFile)
-    datasetDir = str(path.parent.absolute().parent)+"/"
-    dataset = datasetDir.split("___")[1].strip("/")
-    if dataset not in fileToEventsDict.keys():
-        continue
+                fileNameToNEventsDict[GetStoreFileName(fileLine.strip())] = int(eventsLine)
+        self.Fill(fileNameToNEventsDict, eventsFilename, mtime)
+        return True
+
+    def FillFromDAS(self, datasetList, dasCache=None):
+        mtime = os.path.getmtime(datasetList)
+        if self.IsSourceUpToDate("das:"+os.path.abspath(datasetList), mtime):
+            return False
+        self.Fill(GetFileEventsMapFromDAS(datasetList, dasCache), "das:"+os.path.abspath(datasetList), mtime)
+        return True
+
+    def GetNEventsDict(self):
+        return dict(self.db.execute("SELECT path, nEvents FROM files"))
+
+    def CountMissingEvents(self, rootFileURLs, nThreads):
+        # open the files which are in neither list once, in parallel, and remember the result
+        from fileCatalog import CountEvents
+        r.EnableThreadSafety()
+        r.gErrorIgnoreLevel = r.kWarning+1
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nThreads) as pool:
+            nEvents = list(pool.map(CountEvents, rootFileURLs))
+        r.gErrorIgnoreLevel = r.kPrint
+        self.Fill({GetStoreFileName(url): n for url, n in zip(rootFileURLs, nEvents) if n is not None})
+        return [url for url, n in zip(rootFileURLs, nEvents) if n is None]
+
+
+def ReadNoCutEvents(datFilename):
+    with open(datFilename, 'r') as datFile:
+        for line in datFile:
+            splitLine = line.split()
+            if len(splitLine) > 8 and splitLine[1] == "nocut":
+                eventsProcessed = int(splitLine[7])
+                eventsProcessedPass = int(splitLine[8])
+                if eventsProcessed != eventsProcessedPass or eventsProcessed <= 0:
+                    raise RuntimeError("nocut line of {} has {} events and {} passing".format(datFilename, eventsProcessed, eventsProcessedPass))
+                return eventsProcessed
+    raise RuntimeError("Did not find the nocut line in {}".format(datFilename))
+
+
+def ScanJob(srcFile):
+    # runs in the worker processes: the input files of one job from its submit file, and the events it processed
+    index = srcFile.split("_")[-1].split(".")[0]
+    datasetDir, dataset = GetDatasetFromPath(srcFile)
+    job = {"srcFile": srcFile, "dataset": dataset, "index": index, "inputFiles": [], "datFile": None, "eventsProcessed": None, "error": None}
+    with open(srcFile, 'r') as thisFile:
+        for line in thisFile:
+            if "haddnano.py" in line and not "echo" in line:
+                job["inputFiles"] = line.split()[2:]
+                break
+    if len(job["inputFiles"]) < 1:
+        job["error"] = "Did not find any input files processed when parsing the submit file."
+        return job
+    datPattern = datasetDir+"output/*_{}.dat".format(index)
+    datFiles = glob.glob(datPattern)
+    if len(datFiles) > 1:
+        job["error"] = "Didn't get exactly 1 dat file matching pattern '{}': {}. There should only be one.".format(datPattern, datFiles)
+    elif len(datFiles) == 1:
+        job["datFile"] = datFiles[0]
+        try:
+            job["eventsProcessed"] = ReadNoCutEvents(datFiles[0])
+        except (RuntimeError, ValueError) as e:
+            job["error"] = str(e)
+    return job
+
+
+def GrepErrFile(errFile):
     errorOutputThisFile = []
     with open(errFile, 'r') as thisFile:
-        lines = thisFile.readlines()
-        for line in lines:
+        for line in thisFile:
             if "messages after this line are from the actual job" in line:
                 errorOutputThisFile.clear()
             elif any(substring in line for substring in harmlessErrorMessages):
@@ -209,106 +184,242 @@ for errFile in fileList:
                 continue
             elif len(line.strip("\n")) > 0:
                 errorOutputThisFile.append(line.strip("\n"))
-    if len(errorOutputThisFile) > 0:
-        filesAndErrorOutput[errFile] = errorOutputThisFile
-
-for errorFile, errorOutput in filesAndErrorOutput.items():
-    print("Found unexpected content in {}".format(errorFile))
-    for line in errorOutput:
-        print("\t" + line)
-print ("Done.", flush=True)
-
-print("Grepping .out files...")
-fileList = glob.glob(localDir+"**/*.out", recursive=True)
-filesAndOutput = {}
-for outFile in fileList:
-    path = Path(outFile)
-    datasetDir = str(path.parent.absolute().parent)+"/"
-    dataset = datasetDir.split("___")[1].strip("/")
-    if dataset not in fileToEventsDict.keys():
-        continue
+    return errorOutputThisFile
+
+
+def GrepOutFile(outFile):
     outputThisFile = []
     with open(outFile, 'r') as thisFile:
-        lines = thisFile.readlines()
-        for line in lines:
+        for line in thisFile:
             if any(substring in line for substring in harmlessOutMessages):
                 continue
             elif "error" in line.lower():
                 outputThisFile.append(line.strip("\n"))
-    if len(outputThisFile) > 0:
-        filesAndOutput[outFile] = outputThisFile
-
-for outFile, output in filesAndOutput.items():
-    print("Found unexpected content in {}".format(outFile))
-    for line in output:
-        print("\t" + line)
-print ("Done.", flush=True)
-
-datasetInfoDict = {}
-print("Checking for output files...")
-fileList = glob.glob(localDir+"**/*.sub", recursive=True)
-numSubmitFiles = len(fileList)
-p = Path(localDir)
-subdirs = [x.name for x in p.iterdir() if x.is_dir()]
-cmdsToRun = []
-for dirName in subdirs:
-    if "analysisClass" in dirName:
-        dataset = dirName.split("___")[1].strip("/")
-        if dataset not in fileToEventsDict.keys():
-            continue
-        datasetInfoDict[dataset] = {}
-        numExpectedOutputFiles = len(glob.glob(localDir+dirName+"/src/submit*.sh"))
-        datasetInfoDict[dataset]["numExpectedOutputFiles"] = numExpectedOutputFiles
-        datasetInfoDict[dataset]["OK"] = True
-        if "/eos/cms" in outputDir:
-            cmd = "xrdfs root://eoscms.cern.ch ls {}".format(outputDir+dataset)
-        elif "/eos/user" in outputDir:
-            cmd = "xrdfs root://eosuser.cern.ch ls {}".format(outputDir+dataset)
+    return outputThisFile
+
+
+def GrepFiles(pool, nCores, localDir, pattern, grepFunc, datasets):
+    fileList = [fileName for fileName in glob.glob(localDir+pattern, recursive=True) if GetDatasetFromPath(fileName)[1] in datasets]
+    chunkSize = max(1, len(fileList) // (4*nCores))
+    return {fileName: output for fileName, output in zip(fileList, pool.map(grepFunc, fileList, chunkSize)) if len(output) > 0}
+
+
+def CheckEventsProcessedPerJob(pool, nCores, localDir, catalog, datasets):
+    # returns the jobs without dat file, those which processed fewer (or more) events than their inputs have,
+    # and those which could not be checked
+    fileList = glob.glob(localDir+"**/submit_*.sh", recursive=True)
+    if len(fileList) < 1:
+        raise RuntimeError("Could not find any submit files in localDir {}".format(localDir))
+    fileList = [srcFile for srcFile in fileList if GetDatasetFromPath(srcFile)[1] in datasets]
+    jobs = pool.map(ScanJob, fileList, max(1, len(fileList) // (4*nCores)))
+
+    nEventsDict = catalog.GetNEventsDict()
+    filesToCount = sorted(set(rootFile for job in jobs for rootFile in job["inputFiles"] if GetStoreFileName(rootFile) not in nEventsDict))
+    unreadableFiles = set()
+    if len(filesToCount) > 0:
+        print("WARN: {} input files are not in the event count catalog; getting their events directly (slow, but only done once).".format(len(filesToCount)), flush=True)
+        unreadableFiles = set(catalog.CountMissingEvents(filesToCount, nCores))
+        nEventsDict = catalog.GetNEventsDict()
+
+    missingJobs = []
+    shortJobs = []
+    failedJobs = []
+    for job in jobs:
+        unreadableThisJob = [rootFile for rootFile in job["inputFiles"] if rootFile in unreadableFiles]
+        if job["error"] is None and len(unreadableThisJob) > 0:
+            job["error"] = "Could not get the number of events from input files: {}".format(unreadableThisJob)
+        if job["error"] is not None:
+            print("ERROR: Something happened with the job for src file {}: {}".format(job["srcFile"], job["error"]))
+            failedJobs.append(job)
+        elif job["datFile"] is None:
+            print("ERROR: Something happened with the job for src file {}: was not able to find its dat file.".format(job["srcFile"]))
+            missingJobs.append(job)
         else:
-            # cmd = 'find {}/output -type f -iname "*.root" | grep -v ".sys." | wc -l'.format(outputDir+dirName)
-            numOutputFiles = glob.glob(outputDir+dirName+"/output/*.root", recursive=True)
-        if "xrdfs" in cmd:
-            # cmdOutput = subprocess.check_output(shlex.split(cmd))
-            # numOutputFiles = len(cmdOutput.split())
-            cmdsToRun.append(cmd)
-            continue
-        datasetInfoDict[dataset]["numOutputFiles"] = numOutputFiles
-        if numOutputFiles != numExpectedOutputFiles:
-            datasetInfoDict[dataset]["OK"] = False
-if len(cmdsToRun) > 0:
-    # use 4 processes
-    for i in range(0, len(cmdsToRun), 4):
-        cmds = cmdsToRun[i:i+4]
-        datasets = list(datasetInfoDict.keys())[i:i+4]
-        procs = [subprocess.Popen(shlex.split(i), stdout=subprocess.PIPE) for i in cmds]
-        for idx, p in enumerate(procs):
-            output = p.communicate()[0]
-            rootFiles = [thisFile for thisFile in output.decode().split() if ".root" in thisFile]
-            numOutputFiles = len(rootFiles)
-            datasetInfoDict[datasets[idx]]["numOutputFiles"] = numOutputFiles
-            if numOutputFiles != datasetInfoDict[datasets[idx]]["numExpectedOutputFiles"]:
-                datasetInfoDict[datasets[idx]]["OK"] = False
-        # print("Ran commands {} for datasets {} and got info {}".format(cmds, datasets, [datasetInfoDict[datasets[datasetIdx]] for datasetIdx in range(0, 4)]))
-print("Done")
-print()
-table = []
-columnNames = ["dataset", "expectedOutputFiles", "actualOutputFiles"]
-numOKdatasets = 0
-numBadDatasets = 0
-for dataset in datasetInfoDict.keys():
-    if datasetInfoDict[dataset]["OK"]:
-        numOKdatasets += 1
+            job["eventsExpected"] = sum(nEventsDict[GetStoreFileName(rootFile)] for rootFile in job["inputFiles"])
+            if job["eventsExpected"] != job["eventsProcessed"]:
+                print("ERROR: Something happened with the job for src file {}: expected {} events but processed {}".format(job["srcFile"], job["eventsExpected"], job["eventsProcessed"]))
+                shortJobs.append(job)
+    return missingJobs, shortJobs, failedJobs
+
+
+def GetJobReport(job):
+    reportKeys = ["dataset", "index", "srcFile", "datFile", "eventsExpected", "eventsProcessed", "error"]
+    return {key: job[key] for key in reportKeys if job.get(key) is not None}
+
+
+####################################################################################################
+# Run
+####################################################################################################
+if __name__ == "__main__":
+    usage = "usage: %prog [options] inputList localDir [outputFileDir]"
+    parser = OptionParser(usage=usage)
+    parser.add_option(
+        "-j",
+        "--nCores",
+        dest="nCores",
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help="number of processes used to scan the job files",
+        metavar="NCORES",
+    )
+    parser.add_option(
+        "-c",
+        "--catalog",
+        dest="catalog",
+        default=None,
+        help="SQLite catalog of events per input file; defaults to <localDir>/checkJobs_nevents.sqlite",
+        metavar="CATALOG",
+    )
+    parser.add_option(
+        "-d",
+        "--dasDatasets",
+        dest="dasDatasets",
+        default=None,
+        help="file with a list of DAS dataset names whose file event counts are added to the catalog",
+        metavar="DATASETLIST",
+    )
+    parser.add_option(
+        "--dasCache",
+        dest="dasCache",
+        default=None,
+        help="SQLite cache of DAS answers used with --dasDatasets; defaults to ~/.cache/dasResolver.sqlite",
+        metavar="CACHE",
+    )
+    parser.add_option(
+        "-r",
+        "--report",
+        dest="report",
+        default=None,
+        help="JSON report of missing, short and failed jobs; defaults to <localDir>/checkJobs_report.json",
+        metavar="REPORT",
+    )
+    (options, args) = parser.parse_args()
+    if len(args) < 2:
+        parser.print_help()
+        raise RuntimeError("Incorrect number of arguments\n. Usage: inputList localDir [outputFileDir].")
+
+    inputListFile = args[0]
+    localDir = args[1]
+    if len(args) > 2:
+        outputDir = args[2]
     else:
-        numBadDatasets += 1
-        table.append([dataset, datasetInfoDict[dataset]["numExpectedOutputFiles"], datasetInfoDict[dataset]["numOutputFiles"]])
-numDatasets = len(datasetInfoDict.keys())
-print("####################################################################################################")
-print("{}/{} datasets were checked and are OK.".format(numOKdatasets, numDatasets))
-if numBadDatasets > 0:
-    print("{}/{} datasets have problems:".format(numBadDatasets, numDatasets))
-    print(tabulate(table, headers=columnNames, tablefmt="github"))
-    print("Resubmission commands:")
-    for entry in table:
-        dataset = entry[0]
-        subFile = localDir+"/analysisClass_lq1_skim___"+dataset+"/condorSubmit.sub"
-        print("condor_submit "+subFile)
+        outputDir = localDir
+
+    localDir = appendSlash(localDir)
+    outputDir = appendSlash(outputDir)
+    nCores = options.nCores
+    catalogPath = options.catalog if options.catalog is not None else localDir+"checkJobs_nevents.sqlite"
+    reportPath = options.report if options.report is not None else localDir+"checkJobs_report.json"
+
+    print("Checking that all events expected were processed from datasets in given inputList...", flush = True)
+    catalog = EventCountCatalog(catalogPath)
+    datasets = set()
+    with open(inputListFile, "r") as inputList:
+        for line in inputList:
+            if not len(line.strip()) > 0:
+                continue
+            if line.strip().startswith("#"):
+                continue
+            dataset = line.strip().split("/")[-1].split(".txt")[0]
+            datasets.add(dataset)
+            fileListFile = line.strip()
+            eventsFilename = fileListFile.replace(".txt", "_nevents.txt")
+            if not os.path.isfile(eventsFilename):
+                print("WARN: Could not find nevents file '{}'; events will be taken from the catalog or from the files.".format(eventsFilename))
+                continue
+            catalog.FillFromEventsList(fileListFile, eventsFilename)
+    if options.dasDatasets is not None:
+        catalog.FillFromDAS(options.dasDatasets, options.dasCache)
+    with multiprocessing.Pool(nCores) as pool:
+        missingJobs, shortJobs, failedJobs = CheckEventsProcessedPerJob(pool, nCores, localDir, catalog, datasets)
+        catalog.Close()
+        print ("Done.", flush = True)
+
+        print("Grepping error files for datasets in given inputList...")
+        filesAndErrorOutput = GrepFiles(pool, nCores, localDir, "**/*.err", GrepErrFile, datasets)
+        for errorFile, errorOutput in filesAndErrorOutput.items():
+            print("Found unexpected content in {}".format(errorFile))
+            for line in errorOutput:
+                print("\t" + line)
+        print ("Done.", flush=True)
+
+        print("Grepping .out files...")
+        filesAndOutput = GrepFiles(pool, nCores, localDir, "**/*.out", GrepOutFile, datasets)
+        for outFile, output in filesAndOutput.items():
+            print("Found unexpected content in {}".format(outFile))
+            for line in output:
+                print("\t" + line)
+        print ("Done.", flush=True)
+
+    resubmitJobs = {}
+    for job in missingJobs + shortJobs + failedJobs:
+        resubmitJobs.setdefault(job["dataset"], []).append(job["index"])
+    report = {
+            "localDir": localDir,
+            "missing": [GetJobReport(job) for job in missingJobs],
+            "short": [GetJobReport(job) for job in shortJobs],
+            "failed": [GetJobReport(job) for job in failedJobs],
+            "errFiles": filesAndErrorOutput,
+            "outFiles": filesAndOutput,
+            "resubmit": {dataset: sorted(indices, key=int) for dataset, indices in resubmitJobs.items()}
+            }
+    with open(reportPath, "w") as reportFile:
+        json.dump(report, reportFile, indent=2)
+    print("Wrote report of {} missing, {} short and {} failed jobs to {}".format(len(missingJobs), len(shortJobs), len(failedJobs), reportPath), flush=True)
+
+    datasetInfoDict = {}
+    print("Checking for output files...")
+    p = Path(localDir)
+    subdirs = [x.name for x in p.iterdir() if x.is_dir()]
+    cmdsToRun = []
+    for dirName in subdirs:
+        if "analysisClass" in dirName:
+            dataset = dirName.split("___")[1].strip("/")
+            if dataset not in datasets:
+                continue
+            datasetInfoDict[dataset] = {}
+            numExpectedOutputFiles = len(glob.glob(localDir+dirName+"/src/submit*.sh"))
+            datasetInfoDict[dataset]["numExpectedOutputFiles"] = numExpectedOutputFiles
+            datasetInfoDict[dataset]["OK"] = True
+            if "/eos/cms" in outputDir:
+                cmdsToRun.append(("xrdfs root://eoscms.cern.ch ls {}".format(outputDir+dataset), dataset))
+                continue
+            elif "/eos/user" in outputDir:
+                cmdsToRun.append(("xrdfs root://eosuser.cern.ch ls {}".format(outputDir+dataset), dataset))
+                continue
+            numOutputFiles = len(glob.glob(outputDir+dirName+"/output/*.root", recursive=True))
+            datasetInfoDict[dataset]["numOutputFiles"] = numOutputFiles
+            if numOutputFiles != numExpectedOutputFiles:
+                datasetInfoDict[dataset]["OK"] = False
+    if len(cmdsToRun) > 0:
+        def ListOutputDir(cmdAndDataset):
+            output = subprocess.Popen(shlex.split(cmdAndDataset[0]), stdout=subprocess.PIPE).communicate()[0]
+            return cmdAndDataset[1], len([thisFile for thisFile in output.decode().split() if ".root" in thisFile])
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nCores) as executor:
+            for dataset, numOutputFiles in executor.map(ListOutputDir, cmdsToRun):
+                datasetInfoDict[dataset]["numOutputFiles"] = numOutputFiles
+                if numOutputFiles != datasetInfoDict[dataset]["numExpectedOutputFiles"]:
+                    datasetInfoDict[dataset]["OK"] = False
+    print("Done")
+    print()
+    table = []
+    columnNames = ["dataset", "expectedOutputFiles", "actualOutputFiles"]
+    numOKdatasets = 0
+    numBadDatasets = 0
+    for dataset in datasetInfoDict.keys():
+        if datasetInfoDict[dataset]["OK"]:
+            numOKdatasets += 1
+        else:
+            numBadDatasets += 1
+            table.append([dataset, datasetInfoDict[dataset]["numExpectedOutputFiles"], datasetInfoDict[dataset]["numOutputFiles"]])
+    numDatasets = len(datasetInfoDict.keys())
+    print("####################################################################################################")
+    print("{}/{} datasets were checked and are OK.".format(numOKdatasets, numDatasets))
+    if numBadDatasets > 0:
+        print("{}/{} datasets have problems:".format(numBadDatasets, numDatasets))
+        print(tabulate(table, headers=columnNames, tablefmt="github"))
+        print("Resubmission commands:")
+        for entry in table:
+            dataset = entry[0]
+            subFile = localDir+"/analysisClass_lq1_skim___"+dataset+"/condorSubmit.sub"
+            print("condor_submit "+subFile)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+#
+# Check the vectorized 1FR - 2FR histogram subtraction of makeQCDYield.py (SubtractHistosWithLimit() and
+# CheckAndFixNegativeBinContents() from combineCommon) against the original bin-by-bin implementation, on randomly
+# filled TH1D, TH2D and TProfile histograms; contents, bin entries, errors, entries and statistics must be identical.
+#
+import sys
+import copy
+from optparse import OptionParser
+
+import numpy as np
+
+from combineCommon import SubtractHistosWithLimit, CheckAndFixNegativeBinContents, GetHistoBinContentArrays
+
+from ROOT import TH1D, TH2D, TProfile, TRandom3, gROOT
+
+
+def SubtractHistosWithLimitPerBin(singleFRHisto, doubleFRHisto):
+    # original bin-by-bin version of SubtractHistosWithLimit()
+    limit = 0.5
+    isProfile = singleFRHisto.ClassName() == "TProfile"
+    doubleFRHistoNew = copy.deepcopy(doubleFRHisto.Clone())
+    for globalBin in range(0, singleFRHisto.GetNcells()+1):
+        singleBinContent = singleFRHisto.GetBinContent(globalBin)
+        if isProfile:
+            singleBinContent *= singleFRHisto.GetBinEntries(globalBin)
+        doubleBinContent = doubleFRHisto.GetBinContent(globalBin)
+        if isProfile:
+            doubleBinContent *= doubleFRHisto.GetBinEntries(globalBin)
+        if abs(doubleBinContent) > limit*abs(singleBinContent):
+            doubleBinContentNew = limit*singleBinContent
+            if isProfile:
+                doubleBinContentNew = singleFRHisto.GetBinContent(globalBin)*singleFRHisto.GetBinEntries(globalBin) * (1 - limit)
+            doubleFRHistoNew.SetBinContent(globalBin, doubleBinContentNew)
+    if not singleFRHisto.Add(doubleFRHistoNew, -1):
+        raise RuntimeError("Add failed for histos {} and {}".format(singleFRHisto.GetName(), doubleFRHistoNew.GetName()))
+
+
+def CheckAndFixNegativeBinContentsPerBin(histo):
+    # original bin-by-bin version of CheckAndFixNegativeBinContents()
+    for globalBin in range(0, histo.GetNcells()+1):
+        if histo.GetBinContent(globalBin) < 0:
+            histo.SetBinContent(globalBin, 0)
+
+
+def CompareWithPerBin(histo, refHisto):
+    # differences between the vectorized and the bin-by-bin results: contents, errors, entries and statistics
+    differences = []
+    contents, entries = GetHistoBinContentArrays(histo)
+    refContents, refEntries = GetHistoBinContentArrays(refHisto)
+    if not np.array_equal(contents, refContents):
+        differences.append("contents differ in bins {}".format(np.nonzero(contents != refContents)[0].tolist()))
+    if entries is not None and not np.array_equal(entries, refEntries):
+        differences.append("bin entries differ in bins {}".format(np.nonzero(entries != refEntries)[0].tolist()))
+    errors = np.array([histo.GetBinError(globalBin) for globalBin in range(histo.GetNcells())])
+    refErrors = np.array([refHisto.GetBinError(globalBin) for globalBin in range(refHisto.GetNcells())])
+    if not np.array_equal(errors, refErrors):
+        differences.append("errors differ in bins {}".format(np.nonzero(errors != refErrors)[0].tolist()))
+    if histo.GetEntries() != refHisto.GetEntries():
+        differences.append("entries {} vs. {}".format(histo.GetEntries(), refHisto.GetEntries()))
+    stats = np.zeros(13)
+    refStats = np.zeros(13)
+    histo.GetStats(stats)
+    refHisto.GetStats(refStats)
+    if not np.array_equal(stats, refStats):
+        differences.append("stats {} vs. {}".format(stats.tolist(), refStats.tolist()))
+    return differences
+
+
+def MakeHistos(className, name, nBins, nFills, rand):
+    # 1FR and 2FR histos filled over a range wider than the axis (so the under/overflows are populated), with some
+    # negative weights and a 2FR that is sometimes above and sometimes below the subtraction limit
+    histos = []
+    for fr, scale in [("1FR", 1.0), ("2FR", 0.6)]:
+        histoName = "{}_{}".format(name, fr)
+        if className == "TH2D":
+            histo = TH2D(histoName, histoName, nBins, 0, 1, nBins, 0, 1)
+        elif className == "TProfile":
+            histo = TProfile(histoName, histoName, nBins, 0, 1)
+        else:
+            histo = TH1D(histoName, histoName, nBins, 0, 1)
+        histo.Sumw2()
+        histo.SetDirectory(0)
+        for fill in range(nFills):
+            x = rand.Uniform(-0.1, 1.1)
+            weight = scale*rand.Uniform(-0.3, 1.0)
+            if className == "TH2D":
+                histo.Fill(x, rand.Uniform(-0.1, 1.1), weight)
+            else:
+                histo.Fill(x, weight)
+        histos.append(histo)
+    return histos
+
+
+####################################################################################################
+# Run
+####################################################################################################
+usage = "usage: %prog [options]"
+parser = OptionParser(usage=usage)
+parser.add_option(
+    "-n",
+    "--nBins",
+    dest="nBins",
+    type=int,
+    default=100,
+    help="number of bins per axis of the test histograms",
+)
+parser.add_option(
+    "-e",
+    "--nFills",
+    dest="nFills",
+    type=int,
+    default=10000,
+    help="number of fills of each test histogram",
+)
+parser.add_option(
+    "-t",
+    "--nTrials",
+    dest="nTrials",
+    type=int,
+    default=10,
+    help="number of random test histograms of each type",
+)
+parser.add_option(
+    "-s",
+    "--seed",
+    dest="seed",
+    type=int,
+    default=1234,
+    help="random seed",
+)
+(options, args) = parser.parse_args()
+
+gROOT.SetBatch(True)
+rand = TRandom3(options.seed)
+failures = 0
+for className in ["TH1D", "TH2D", "TProfile"]:
+    for trial in range(options.nTrials):
+        name = "{}_{}".format(className, trial)
+        singleFRHisto, doubleFRHisto = MakeHistos(className, name, options.nBins, options.nFills, rand)
+        refHisto = singleFRHisto.Clone(name+"_perBin")
+        refHisto.SetDirectory(0)
+        SubtractHistosWithLimitPerBin(refHisto, doubleFRHisto)
+        CheckAndFixNegativeBinContentsPerBin(refHisto)
+        SubtractHistosWithLimit(singleFRHisto, doubleFRHisto)
+        CheckAndFixNegativeBinContents(singleFRHisto)
+        differences = CompareWithPerBin(singleFRHisto, refHisto)
+        if len(differences):
+            print("ERROR: vectorized subtraction for histo {} does not match the bin-by-bin one: {}".format(name, "; ".join(differences)), flush=True)
+            failures += 1
+    print("INFO: checked {} {} histos".format(options.nTrials, className), flush=True)
+
+if failures:
+    print("ERROR: {} histos differ".format(failures))
+    sys.exit(1)
+print("INFO: vectorized subtraction matches the bin-by-bin one for all histos")
@@ -14,6 +14,7 @@ import numpy as np
 import ctypes
 import ROOT as r
 import json
+import hashlib
 import faulthandler
 faulthandler.enable()
 
@@ -1072,39 +1073,591 @@ def OverrideTableSelectionYieldAndUncertainty(inputTable, selection, value, unce
     return
 
 
-def GetSampleHistosFromTFile(tfileName, sample, keepHistName=True):
-    histNameToHistDict = {}
-    if tfileName.startswith("/eos/cms"):
-        tfileName = "root://eoscms.cern.ch/" + tfileName
-    elif tfileName.startswith("/eos/user"):
-        tfileName = "root://eosuser.cern.ch/" + tfileName
-    tfile = r.TFile.Open(tfileName)
-    for key in tfile.GetListOfKeys():
-        histoName = key.GetName()
-        htemp = key.ReadObj()
+class CutTable:
+    # columnar cut table: one float64 array per yield column, plus one shared list of row metadata
+    # the dict-of-dicts tables above can be converted with FromDict()/ToDict() so that callers can switch over one at a time
+    metadataColumns = ["variableName", "min1", "max1", "min2", "max2", "level"]
+
+    def __init__(self, rows, n, npass, errNpassSqr):
+        self.rows = rows
+        self.n = np.asarray(n, dtype=np.float64)
+        self.npass = np.asarray(npass, dtype=np.float64)
+        self.errNpassSqr = np.asarray(errNpassSqr, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def copy(self):
+        return CutTable(self.rows, self.n.copy(), self.npass.copy(), self.errNpassSqr.copy())
+
+    @classmethod
+    def FromDatFile(cls, datFilename):
+        rows = []
+        n = []
+        npass = []
+        errNpassSqr = []
+        column = []
+        try:
+            with open(datFilename) as datFile:
+                foundFirstLine = False
+                for line in datFile:
+                    if line.startswith("###"):
+                        continue
+                    if not foundFirstLine:
+                        if line.strip().startswith("#id"):
+                            foundFirstLine = True
+                            column = line.split()
+                            colIdx = {name: i for i, name in enumerate(column)}
+                        continue
+                    pieces = line.split()
+                    if len(pieces) == 0:
+                        continue
+                    rows.append(tuple(pieces[colIdx[name]] if name in colIdx else None for name in cls.metadataColumns))
+                    n.append(float(pieces[colIdx["N"]]) if "N" in colIdx else 0.0)
+                    npass.append(float(pieces[colIdx["Npass"]]))
+                    if "errNpass" in colIdx:
+                        errNpassSqr.append(float(pieces[colIdx["errNpass"]])**2)
+                    elif "errNpassSqr" in colIdx:
+                        errNpassSqr.append(float(pieces[colIdx["errNpassSqr"]]))
+                    else:
+                        errNpassSqr.append(0.0)
+        except Exception as e:
+            raise RuntimeError("Had an exception when reading dat file='{}':".format(datFilename), e)
+        return cls(rows, n, npass, errNpassSqr)
+
+    @classmethod
+    def FromDict(cls, table):
+        rows = []
+        n = np.zeros(len(table))
+        npass = np.zeros(len(table))
+        errNpassSqr = np.zeros(len(table))
+        for j in range(len(table)):
+            line = table[j]
+            rows.append(tuple(line[name] if name in line.keys() else None for name in cls.metadataColumns))
+            n[j] = float(line["N"]) if "N" in line.keys() else 0.0
+            npass[j] = float(line["Npass"])
+            if "errNpassSqr" in line.keys():
+                errNpassSqr[j] = float(line["errNpassSqr"])
+            elif "errNpass" in line.keys():
+                errNpassSqr[j] = pow(float(line["errNpass"]), 2)
+        return cls(rows, n, npass, errNpassSqr)
+
+    @classmethod
+    def FromNpz(cls, npzFilename):
+        with np.load(npzFilename) as cached:
+            return cls([tuple(row) for row in json.loads(str(cached["rows"]))], cached["n"], cached["npass"], cached["errNpassSqr"])
+
+    def WriteNpz(self, npzFilename):
+        np.savez(npzFilename, rows=np.array(json.dumps(self.rows)), n=self.n, npass=self.npass, errNpassSqr=self.errNpassSqr)
+
+    def ToDict(self):
+        table = {}
+        for j, row in enumerate(self.rows):
+            table[j] = {name: row[i] for i, name in enumerate(self.metadataColumns)}
+            table[j]["N"] = float(self.n[j])
+            table[j]["Npass"] = float(self.npass[j])
+            table[j]["errNpassSqr"] = float(self.errNpassSqr[j])
+        return table
+
+    def FillErrors(self, rootFileName, sampleName=""):
+        # same as FillTableErrors(), but fills all the errors of the columnar table in one go
+        tfile = r.TFile.Open(rootFileName)
+        if not tfile:
+            raise RuntimeError("ERROR: could not open file '{}'.".format(rootFileName))
+        if sampleName:
+            histName = "histo1D__{}__EventsPassingCutsAllHist".format(sampleName)
+        else:
+            histName = "EventsPassingCutsAllHist"
+        eventsPassingHist = tfile.Get(histName)
+        if not eventsPassingHist:
+            raise RuntimeError("ERROR: could not find hist '{}' in file '{}'.".format(histName, rootFileName))
+        self.FillErrorsFromHist(eventsPassingHist)
+        tfile.Close()
+        return self
+
+    def FillErrorsFromHist(self, eventsPassingHist):
+        # for callers that already have the EventsPassingCutsAllHist in hand
+        # GetBinError()**2 as in FillTableErrors(), which also covers hists without sumw2 (and their error options)
+        self.errNpassSqr = np.array([eventsPassingHist.GetBinError(iBin)**2 for iBin in range(1, len(self)+1)], dtype=np.float64)
+        return self
+
+    def CreateWeighted(self, weight=1.0):
+        # equivalent of CreateWeightedTable(): the first row (nocut) loses its metadata and its error
+        rows = list(self.rows)
+        rows[0] = (rows[0][0], "-", "-", "-", "-", -1)
+        for j in range(1, len(rows)):
+            if rows[j][-1] is None:
+                rows[j] = rows[j][:-1] + (-2,)
+        errNpassSqr = self.errNpassSqr * pow(weight, 2)
+        errNpassSqr[0] = 0
+        return CutTable(rows, self.n * weight, self.npass * weight, errNpassSqr)
+
+    def Scale(self, weight):
+        self.n *= weight
+        self.npass *= weight
+        self.errNpassSqr *= pow(weight, 2)
+        return self
+
+    def Add(self, other):
+        if len(other) != len(self):
+            raise RuntimeError("Cannot add CutTable with {} rows to CutTable with {} rows".format(len(other), len(self)))
+        self.rows = other.rows
+        self.n += other.n
+        self.npass += other.npass
+        self.errNpassSqr += other.errNpassSqr
+        return self
+
+    def Subtract(self, other, zeroNegatives=False):
+        if len(other) != len(self):
+            raise RuntimeError("Cannot subtract CutTable with {} rows from CutTable with {} rows".format(len(other), len(self)))
+        self.n -= other.n
+        self.npass -= other.npass
+        self.errNpassSqr += other.errNpassSqr
+        if zeroNegatives:
+            self.ZeroNegatives()
+        return self
+
+    def ZeroNegatives(self):
+        np.maximum(self.n, 0, out=self.n)
+        np.maximum(self.npass, 0, out=self.npass)
+        return self
+
+    def CalculateEfficiency(self):
+        # vectorized version of CalculateEfficiency(); returns the dict-of-dicts table expected by WriteTable()
+        nRows = len(self)
+        effRel = np.ones(nRows)
+        errEffRel = np.zeros(nRows)
+        effAbs = np.ones(nRows)
+        errEffAbs = np.zeros(nRows)
+        if nRows > 1:
+            confLevel = 0.683
+            prob = 0.5 * (1 - confLevel)
+            quantile = r.Math.normal_quantile_c(prob, 1.0)
+            # the total is the last reweighting row seen so far (or row 0 before that)
+            isReweighting = np.array([str(row[0]).lower() == "reweighting" for row in self.rows])
+            totalRow = np.maximum.accumulate(np.where(isReweighting, np.arange(nRows), 0))
+            pw2 = self.errNpassSqr[1:]
+            npass = self.npass[1:]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                tw = self.npass[:-1]
+                tw2 = self.errNpassSqr[:-1]
+                eff = np.where(tw == 0, 0.0, npass / tw)
+                variance = np.where(tw != 0, (pw2 * (1. - 2 * eff) + tw2 * eff * eff) / (tw * tw), 0.0)
+                delta = np.sqrt(np.where(variance >= 0, variance, 0)) * quantile
+                effRel[1:] = eff
+                errEffRel[1:] = np.where(variance >= 0, np.where(eff - delta < 0, eff, delta), -1)
+                tw = self.npass[totalRow[1:]]
+                tw2 = self.errNpassSqr[totalRow[1:]]
+                eff = np.where(tw != 0, npass / tw, 0.0)
+                variance = np.where(tw != 0, (pw2 * (1. - 2 * eff) + tw2 * eff * eff) / (tw * tw), 0.0)
+                delta = np.sqrt(np.where(variance >= 0, variance, 0)) * quantile
+                effAbs[1:] = eff
+                errEffAbs[1:] = np.where(variance >= 0, np.where(eff - delta < 0, eff, delta), -1)
+        errNpass = np.sqrt(self.errNpassSqr)
+        newTable = {}
+        for j, row in enumerate(self.rows):
+            newTable[j] = {name: row[i] for i, name in enumerate(self.metadataColumns)}
+            newTable[j].update({
+                "N": float(self.n[j]),
+                "Npass": float(self.npass[j]),
+                "errNpass": float(errNpass[j]),
+                "EffRel": float(effRel[j]),
+                "errEffRel": float(errEffRel[j]),
+                "EffAbs": float(effAbs[j]),
+                "errEffAbs": float(errEffAbs[j]),
+            })
+        return newTable
+
+
+class DatFileCache:
+    # on-disk cache of parsed .dat tables: one .npz per (path, size, mtime), evicted least-recently-used first
+    def __init__(self, cacheDir, maxBytes=2*1024**3, maxEntries=100000):
+        self.cacheDir = os.path.expandvars(cacheDir)
+        self.maxBytes = maxBytes
+        self.maxEntries = maxEntries
+        self.hits = 0
+        self.misses = 0
+        # running totals of the cache directory, filled by the first Store()
+        self.totalBytes = None
+        self.nEntries = None
+        if not os.path.isdir(self.cacheDir):
+            os.makedirs(self.cacheDir, exist_ok=True)
+
+    def GetCacheFilename(self, datFilename):
+        stat = os.stat(datFilename)
+        key = "{}:{}:{}".format(os.path.abspath(datFilename), stat.st_size, stat.st_mtime_ns)
+        return os.path.join(self.cacheDir, hashlib.sha1(key.encode()).hexdigest() + ".npz")
+
+    def Load(self, datFilename):
+        cacheFilename = self.GetCacheFilename(datFilename)
+        if os.path.isfile(cacheFilename):
+            try:
+                table = CutTable.FromNpz(cacheFilename)
+                # touch the entry so that it is the last to be evicted
+                os.utime(cacheFilename)
+                self.hits += 1
+                return table
+            except Exception as e:
+                print("WARN: DatFileCache: could not read cache file '{}' for dat file '{}'; reparsing: {}".format(cacheFilename, datFilename, e))
+        self.misses += 1
+        table = CutTable.FromDatFile(datFilename)
+        self.Store(cacheFilename, table)
+        return table
+
+    def Store(self, cacheFilename, table):
+        # write to a temporary file first so that concurrent jobs never see a partial entry
+        tmpFilename = "{}.{}.tmp.npz".format(cacheFilename[:-4], os.getpid())
+        table.WriteNpz(tmpFilename)
+        if self.totalBytes is None:
+            self.ScanEntries()
+        try:
+            self.totalBytes -= os.stat(cacheFilename).st_size
+            self.nEntries -= 1
+        except FileNotFoundError:
+            pass
+        self.totalBytes += os.stat(tmpFilename).st_size
+        self.nEntries += 1
+        os.replace(tmpFilename, cacheFilename)
+        # the running totals do not see what other jobs store, so only rescan the directory when over the limits
+        if self.totalBytes > self.maxBytes or self.nEntries > self.maxEntries:
+            self.Evict()
+
+    def ScanEntries(self):
+        # (mtime, size, path) of the cache entries; entries evicted meanwhile by other jobs are skipped
+        entries = []
+        for entry in os.scandir(self.cacheDir):
+            if entry.name.endswith(".npz") and ".tmp." not in entry.name:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        self.totalBytes = sum(entry[1] for entry in entries)
+        self.nEntries = len(entries)
+        return entries
+
+    def Evict(self):
+        entries = self.ScanEntries()
+        for mtime, size, path in sorted(entries):
+            if self.totalBytes <= self.maxBytes and self.nEntries <= self.maxEntries:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.totalBytes -= size
+            self.nEntries -= 1
+
+    def Clear(self):
+        for entry in os.scandir(self.cacheDir):
+            if entry.name.endswith(".npz"):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+        self.totalBytes = None
+        self.nEntries = None
+
+
+def LoadCutTable(datFilename, datFileCache=None):
+    if datFileCache is None:
+        return CutTable.FromDatFile(datFilename)
+    return datFileCache.Load(datFilename)
+
+
+def UpdateCutTable(inputTable, outputTable):
+    # CutTable version of UpdateTable()
+    if outputTable is None:
+        return inputTable
+    return outputTable.Add(inputTable)
+
+
+def GetHistoSumw2Array(hist):
+    # sum of squared weights per global bin (including under/overflow), as in GetBinError()**2
+    nCells = hist.GetNcells()
+    if hist.GetSumw2N():
+        buffer = hist.GetSumw2().GetArray()
+        buffer.reshape((nCells,))
+        return np.frombuffer(buffer, dtype=np.float64, count=nCells)
+    return np.abs(np.array([hist.GetBinContent(iBin) for iBin in range(nCells)], dtype=np.float64))
+
+
+# storage type of the bin contents by the last letter of the class name (TH1F, TH2D, ...); profiles are double
+histoStorageTypes = {"C": np.int8, "S": np.int16, "I": np.int32, "L": np.int64, "F": np.float32, "D": np.float64}
+
+# profiles keep their per-bin sums of weights (GetBinEntries()) in a protected array; copy them out in one C++ loop
+if not hasattr(r, "CombineCommon"):
+    r.gInterpreter.Declare("""
+    #include "TProfile.h"
+    #include "TProfile2D.h"
+    #include "TProfile3D.h"
+    namespace CombineCommon {
+    void GetBinEntries(const TH1* histo, double* entries) {
+      auto profile = dynamic_cast<const TProfile*>(histo);
+      auto profile2D = dynamic_cast<const TProfile2D*>(histo);
+      auto profile3D = dynamic_cast<const TProfile3D*>(histo);
+      for (Int_t bin = 0; bin < histo->GetNcells(); ++bin) {
+        if (profile) entries[bin] = profile->GetBinEntries(bin);
+        else if (profile2D) entries[bin] = profile2D->GetBinEntries(bin);
+        else if (profile3D) entries[bin] = profile3D->GetBinEntries(bin);
+      }
+    }
+    }
+    """)
+
+
+def GetHistoContentArray(hist):
+    # writable view of the bin contents (including under/overflow), in the storage type of the histogram
+    # for profiles these are the sums of weight*value, not GetBinContent()
+    nCells = hist.GetNcells()
+    dtype = np.float64 if IsProfile(hist) else histoStorageTypes.get(hist.ClassName()[-1], np.float64)
+    buffer = hist.GetArray()
+    buffer.reshape((nCells,))
+    return np.frombuffer(buffer, dtype=dtype, count=nCells)
+
+
+def IsProfile(hist):
+    return hist.InheritsFrom("TProfile") or hist.InheritsFrom("TProfile2D") or hist.InheritsFrom("TProfile3D")
+
+
+def GetHistoBinEntriesArray(hist):
+    # GetBinEntries() of all global bins of a profile
+    entries = np.zeros(hist.GetNcells())
+    r.CombineCommon.GetBinEntries(hist, entries)
+    return entries
+
+
+def GetHistoBinContentArrays(hist):
+    # GetBinContent() and, for profiles, GetBinEntries() (None otherwise) of all global bins, read once
+    sums = np.array(GetHistoContentArray(hist), dtype=np.float64)
+    if not IsProfile(hist):
+        return sums, None
+    entries = GetHistoBinEntriesArray(hist)
+    contents = np.where(entries != 0, sums/np.where(entries != 0, entries, 1), 0.0)
+    return contents, entries
+
+
+def SetHistoBinContents(hist, globalBins, values):
+    # same as calling hist.SetBinContent(globalBin, value) for the increasing globalBins one by one: the bins below the
+    # overflow go through the array, while the overflow (which can extend labelled axes) and the last bin go through
+    # SetBinContent(), so that the entries are counted and the statistics invalidated as ROOT does for every call
+    if len(globalBins) == 0:
+        return
+    nViaArray = min(np.searchsorted(globalBins, hist.GetNcells()-1), len(globalBins)-1)
+    GetHistoContentArray(hist)[globalBins[:nViaArray]] = values[:nViaArray]
+    hist.SetEntries(hist.GetEntries() + nViaArray)
+    for globalBin, value in zip(globalBins[nViaArray:], values[nViaArray:]):
+        hist.SetBinContent(int(globalBin), float(value))
+
+
+def SubtractHistosWithLimit(singleFRHisto, doubleFRHisto, verbose = False):
+    limit = 0.5
+    isProfile = False
+    if singleFRHisto.ClassName() == "TProfile":
+        isProfile = True
+        verbose = True
+    doubleFRHistoNew = doubleFRHisto.Clone()
+    singleContents, singleEntries = GetHistoBinContentArrays(singleFRHisto)
+    doubleContents, doubleEntries = GetHistoBinContentArrays(doubleFRHisto)
+    singleBinContents = singleContents*singleEntries if isProfile else singleContents
+    doubleBinContents = doubleContents*doubleEntries if isProfile else doubleContents
+    limitedBins = np.nonzero(np.abs(doubleBinContents) > limit*np.abs(singleBinContents))[0]
+    if not IsProfile(singleFRHisto) and len(limitedBins) and limitedBins[-1] == singleFRHisto.GetNcells()-1:
+        # GetBinContent() past the last bin returns the overflow, so the overflow is limited once more there
+        limitedBins = np.append(limitedBins, singleFRHisto.GetNcells())
+        singleBinContents = np.append(singleBinContents, singleBinContents[-1])
+        doubleBinContents = np.append(doubleBinContents, doubleBinContents[-1])
+    doubleBinContentsNew = singleBinContents[limitedBins] * (1 - limit) if isProfile else limit*singleBinContents[limitedBins]
+    SetHistoBinContents(doubleFRHistoNew, limitedBins, doubleBinContentsNew)
+    if verbose:
+        for globalBin, doubleBinContentNew in zip(limitedBins, doubleBinContentsNew):
+            if isProfile:
+                doubleBinContentNew *= doubleFRHistoNew.GetBinEntries(int(globalBin))
+                print("INFO: limited bin {} in histo {} to 50% of singleFR bin content = {}; singleFR orig content={}, entries={}, nominalYield={}; doubleFR orig content={}, entries={}, nominalYield={}".format(
+                    globalBin, singleFRHisto.GetName(), limit*singleBinContents[globalBin], singleContents[globalBin], singleEntries[globalBin], singleBinContents[globalBin],
+                    doubleContents[globalBin], doubleEntries[globalBin], doubleBinContents[globalBin]))
+            print("INFO: for hist {}: limited bin {} from {} to {}".format(doubleFRHistoNew.GetName(), globalBin, doubleBinContents[globalBin], doubleBinContentNew), flush=True)
+    if not singleFRHisto.Add(doubleFRHistoNew, -1):
+        print("INFO: {} has {} xbins and {} has {} xbins".format(singleFRHisto.GetName(), singleFRHisto.GetNbinsX(), doubleFRHistoNew.GetName(), doubleFRHistoNew.GetNbinsX()))
+        raise RuntimeError("Add failed for histos {} and {}".format(singleFRHisto.GetName(), doubleFRHistoNew.GetName()))
+    if verbose and isProfile:
+        binToUse = 118
+        content = singleFRHisto.GetBinContent(binToUse)
+        entries = singleFRHisto.GetBinEntries(binToUse)
+        print("INFO: singleFR-DYJ-2FR histo bin {} has content {} and entries {} for a nominal yield = {}".format(binToUse, content, entries, content*entries))
+
+
+def CheckAndFixNegativeBinContents(histo, verbose = False):
+    contents, entries = GetHistoBinContentArrays(histo)
+    negativeBins = np.nonzero(contents < 0)[0]
+    SetHistoBinContents(histo, negativeBins, np.zeros(len(negativeBins)))
+    if verbose:
+        for globalBin in negativeBins:
+            print("INFO: for hist {}: limited bin {} from {} to {}".format(histo.GetName(), globalBin, contents[globalBin], histo.GetBinContent(int(globalBin))), flush=True)
+
+
+def GetHisto2DArrays(hist):
+    # bin contents and squared errors (as GetBinError()**2) of a TH2, indexed [ybin, xbin] including under/overflows
+    shape = (hist.GetNbinsY()+2, hist.GetNbinsX()+2)
+    errors = np.sqrt(GetHistoSumw2Array(hist))
+    return GetHistoContentArray(hist).reshape(shape), (errors*errors).reshape(shape)
+
+
+def SetHisto2DArrays(hist, contents, errorsSqr, nSetBins):
+    # writes [ybin, xbin] arrays of contents and squared errors into a TH2 of that shape in one go; the entries are
+    # set to nSetBins, the number of SetBinContent() calls this replaces
+    if not hist.GetSumw2N():
+        hist.Sumw2()
+    GetHistoContentArray(hist)[:] = contents.ravel()
+    GetHistoSumw2Array(hist)[:] = errorsSqr.ravel()
+    hist.SetEntries(hist.GetEntries() + nSetBins)
+
+
+def GetAxisSignature(axis):
+    labels = axis.GetLabels()
+    labels = tuple(label.GetString().Data() for label in labels) if labels else ()
+    if axis.GetXbins().GetSize():
+        edges = tuple(axis.GetXbins()[i] for i in range(axis.GetXbins().GetSize()))
+    else:
+        edges = (axis.GetXmin(), axis.GetXmax())
+    return axis.GetNbins(), edges, labels
+
+
+def HistoBinningsMatch(hist1, hist2):
+    if hist1.GetDimension() != hist2.GetDimension() or hist1.GetNcells() != hist2.GetNcells():
+        return False
+    axes = [lambda hist: hist.GetXaxis(), lambda hist: hist.GetYaxis(), lambda hist: hist.GetZaxis()]
+    for getAxis in axes[:hist1.GetDimension()]:
+        if GetAxisSignature(getAxis(hist1)) != GetAxisSignature(getAxis(hist2)):
+            return False
+    return True
+
+
+def AddHistoArrays(histo, histoToAdd, weight=1.0):
+    # fast path for histo += weight*histoToAdd when both have the same binning
+    # sums contents and sumw2 in place via numpy views over the ROOT arrays; statistics are combined as by histoToAdd.Scale(weight) followed by histo.Add(histoToAdd)
+    # returns False (touching nothing) if the histos need ROOT's own Add(), e.g. profiles or different binnings/labels
+    if not histo.InheritsFrom("TH1") or not histoToAdd.InheritsFrom("TH1"):
+        return False
+    if histo.InheritsFrom("TProfile") or histoToAdd.InheritsFrom("TProfile") or histo.InheritsFrom("TProfile2D") or histoToAdd.InheritsFrom("TProfile2D"):
+        return False
+    if not histo.GetSumw2N() or not HistoBinningsMatch(histo, histoToAdd):
+        return False
+    if not np.issubdtype(histoStorageTypes.get(histo.ClassName()[-1], np.float64), np.floating):
+        # integer bin contents (TH1C/S/I/L) are rounded and saturated by ROOT itself
+        return False
+    stats = np.zeros(13)
+    statsToAdd = np.zeros(13)
+    histo.GetStats(stats)
+    histoToAdd.GetStats(statsToAdd)
+    entries = histo.GetEntries() + histoToAdd.GetEntries()
+    contents = GetHistoContentArray(histo)
+    contents += weight*GetHistoContentArray(histoToAdd)
+    sumw2 = GetHistoSumw2Array(histo)
+    sumw2 += weight*weight*GetHistoSumw2Array(histoToAdd)
+    stats[1:2] += weight*weight*statsToAdd[1:2]
+    stats[0] += weight*statsToAdd[0]
+    stats[2:] += weight*statsToAdd[2:]
+    histo.PutStats(stats)
+    histo.SetEntries(entries)
+    return True
+
+
+class SampleHistoReader:
+    # reads the objects of one file lazily, in the same (sorted by key name) order as GetSampleHistosFromTFile()
+    # keys are filtered by name before anything is deserialized, and each object is handed over as soon as it is read
+    def __init__(self, tfileName, sample="", keepHistName=True, inclusionList=None, namePattern=None):
+        self.sample = sample
+        self.keepHistName = keepHistName
+        if tfileName.startswith("/eos/cms"):
+            tfileName = "root://eoscms.cern.ch/" + tfileName
+        elif tfileName.startswith("/eos/user"):
+            tfileName = "root://eosuser.cern.ch/" + tfileName
+        self.tfile = r.TFile.Open(tfileName)
+        if not self.tfile or self.tfile.IsZombie():
+            raise RuntimeError("SampleHistoReader: could not open file '{}'".format(tfileName))
+        self.keysByName = {}
+        for key in self.tfile.GetListOfKeys():
+            self.keysByName[key.GetName()] = key
+        keyNames = self.keysByName.keys()
+        if inclusionList is not None:
+            inclusionSet = set(inclusionList)
+            missingNames = sorted(inclusionSet.difference(self.keysByName))
+            if len(missingNames) > 0:
+                raise RuntimeError("SampleHistoReader: file '{}' does not contain the {} requested objects: {}".format(tfileName, len(missingNames), missingNames))
+            keyNames = [name for name in keyNames if name in inclusionSet]
+        if namePattern is not None:
+            keyNames = [name for name in keyNames if re.search(namePattern, name)]
+        self.keyNames = sorted(keyNames)
+        self.shortNames = {keyName: self.ShortenName(keyName) for keyName in self.keyNames}
+        self.objectsRead = {}
+
+    def __len__(self):
+        return len(self.keyNames)
+
+    def ShortenName(self, hname):
+        if self.keepHistName:
+            return hname
+        if "cutHisto" in hname:
+            prefixEndPos = hname.rfind("cutHisto")
+        elif len(re.findall("__", hname)) > 2:
+            raise RuntimeError("Found hist {} in file {} and unclear how to shorten its name".format(hname, self.tfile.GetName()))
+        else:
+            prefixEndPos = hname.rfind("__")+2
+        return hname[prefixEndPos:]
+
+    def GetNames(self):
+        return [self.shortNames[keyName] for keyName in self.keyNames]
+
+    def ReadObject(self, keyName):
+        if keyName in self.objectsRead:
+            return self.objectsRead[keyName]
+        htemp = self.keysByName[keyName].ReadObj()
         if not htemp or htemp is None:
-            raise RuntimeError("failed to get histo named:", histoName, "from file:", tfile.GetName())
+            raise RuntimeError("failed to get histo named:", keyName, "from file:", self.tfile.GetName())
         r.SetOwnership(htemp, True)
         if htemp.InheritsFrom("TH1"):
             htemp.SetDirectory(0)
-        histNameToHistDict[histoName] = htemp
-    sortedDict = dict(sorted(histNameToHistDict.items()))
-    for htemp in sortedDict.values():
-        if not keepHistName:
-            hname = htemp.GetName()
-            if "cutHisto" in hname:
-                prefixEndPos = hname.rfind("cutHisto")
-            elif len(re.findall("__", hname)) > 2:
-                raise RuntimeError("Found hist {} in file {} and unclear how to shorten its name".format(hname, tfile.GetName()))
-            else:
-                prefixEndPos = hname.rfind("__")+2
-            htemp.SetName(hname[prefixEndPos:])
-    sampleHistos = list(sortedDict.values())
-    tfile.Close()
+        if not self.keepHistName:
+            htemp.SetName(self.shortNames[keyName])
+        return htemp
+
+    def Select(self, predicate):
+        # read (and keep for the later iteration) only those objects for which predicate(shortName, className) is true
+        selected = []
+        for keyName in self.keyNames:
+            if predicate(self.shortNames[keyName], self.keysByName[keyName].GetClassName()):
+                self.objectsRead[keyName] = self.ReadObject(keyName)
+                selected.append(self.objectsRead[keyName])
+        return selected
+
+    def Find(self, predicate):
+        selected = self.Select(predicate)
+        return selected[0] if len(selected) else None
+
+    def __iter__(self):
+        try:
+            for keyName in self.keyNames:
+                htemp = self.ReadObject(keyName)
+                self.objectsRead.pop(keyName, None)
+                yield self.shortNames[keyName], htemp
+                htemp = None
+        finally:
+            self.Close()
+
+    def Close(self):
+        if self.tfile:
+            self.tfile.Close()
+
+
+def GetSampleHistosFromTFile(tfileName, sample, keepHistName=True):
+    reader = SampleHistoReader(tfileName, sample, keepHistName)
+    tfileName = reader.tfile.GetName()
+    sampleHistos = [htemp for histoName, htemp in reader]
     if len(sampleHistos) < 1:
         raise RuntimeError(
                 "GetSampleHistosFromTFile({}, {}) -- failed to read any histos for the sampleName from this file!".format(
-                    tfile.GetName(), sample))
+                    tfileName, sample))
     return sampleHistos
 
 
@@ -1406,23 +1959,56 @@ def GetShortHistoName(histName):
         return histName
 
 
+class HistoAccumulator(OrderedDict):
+    # combined histos of a sample keyed by short histo name, in the order in which they were first added
+    # each output histo is allocated once by updateSample(), as a new TH1D/TH2F/TProfile/TH3D given the binning
+    # and axes of the first piece's histo with SetBins(); later pieces are added into it in place
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.validatedTMapKeySets = set()
+
+
+def GetTMapKeySet(tmap):
+    # only the key names are walked; the branch title lists are compared once per key set by CheckSystematicsTMapConsistency()
+    if tmap is None:
+        return None
+    keyNames = set()
+    mapIter = r.TIter(tmap)
+    mapKey = mapIter.Next()
+    while mapKey:
+        keyNames.add(mapKey.GetName())
+        mapKey = mapIter.Next()
+    return frozenset(keyNames)
+
+
 def UpdateHistoDict(sampleHistoDict, pieceHistoList, piece, sameProcess=True, sample="", plotWeight=1.0, correlateLHESystematics=False, isData=False, isQCD=False, uncorrelatedSysts=[],
                     symmetrize=True, flatSystematics={}, sameYear=True):
     # print "INFO: UpdateHistoDict for sample {}".format(sample)
     # sys.stdout.flush()
     systNameToBranchTitleDict = {}
+    if isinstance(pieceHistoList, SampleHistoReader):
+        # streaming: only the TMap and systematics hist are read up front, everything else is read and released one by one below
+        pieceHistoNames = set(pieceHistoList.GetNames())
+        findPieceObject = pieceHistoList.Find
+        pieceHistos = (histo for histoName, histo in pieceHistoList)
+    else:
+        pieceHistoNames = set(GetShortHistoName(histo.GetName()) for histo in pieceHistoList)
+        findPieceObject = lambda predicate: next((x for x in pieceHistoList if predicate(x.GetName(), x.ClassName())), None)
+        pieceHistos = pieceHistoList
     if not isData:
-        sampleTMap = next((x for x in pieceHistoList if x.ClassName() == "TMap" and "systematicNameToBranchesMap" in x.GetName()), None)
-        sampleSystHist = next((x for x in pieceHistoList if x.GetName() == "systematics"), None)
+        sampleTMap = findPieceObject(lambda name, className: className == "TMap" and "systematicNameToBranchesMap" in name)
+        sampleSystHist = findPieceObject(lambda name, className: name == "systematics")
         if sampleSystHist is None:
-            sampleSystHist = next((x for x in pieceHistoList if "systematics" == x.GetName().split("__")[-1] ), None)
+            sampleSystHist = findPieceObject(lambda name, className: "systematics" == name.split("__")[-1])
         if sampleSystHist is not None:
             systNameToBranchTitleDict = ExtractBranchTitles(sampleSystHist, sampleTMap)
         elif not isQCD:
             print("WARN UpdateHistoDict(): Did not find systematics hist for the piece {}, though it's not data.".format(piece))
-    idx = 0
-    # scaledHistos = []
-    for pieceHisto in pieceHistoList:
+    if not isinstance(sampleHistoDict, HistoAccumulator):
+        sampleHistoDict = HistoAccumulator(sampleHistoDict)
+    namesBefore = set(sampleHistoDict.keys())
+    namesUpdated = set()
+    for pieceHisto in pieceHistos:
         #XXX SIC FIXME TODO DEBUG
         # if "with" in pieceHisto.GetName().lower():
         #    continue
@@ -1430,45 +2016,32 @@ def UpdateHistoDict(sampleHistoDict, pieceHistoList, piece, sameProcess=True, sa
         #     continue
         #XXX SIC FIXME TODO DEBUG
         pieceHistoName = pieceHisto.GetName()
-        pieceHisto.SetName(GetShortHistoName(pieceHistoName))
-        if idx in sampleHistoDict:
-            # print("INFO: UpdateHistoDict(): sample={}, sampleHisto={}, piece={}, pieceHisto={}, idx={}".format(sample, sampleHistoDict[idx].GetName(), piece, pieceHisto.GetName(), idx), flush=True)
-            sampleHisto = sampleHistoDict[idx]
-            if pieceHisto.GetName() not in sampleHisto.GetName():
-                raise RuntimeError(
-                        "ERROR: non-matching histos between sample {} hist with name '{}' and piece {} hist with name '{}'. Quitting here".format(
-                            sample, sampleHisto.GetName(), piece, pieceHisto.GetName()))
-        if "eventspassingcuts" in pieceHisto.GetName().lower() and "unscaled" not in pieceHisto.GetName().lower():
-            if pieceHisto.GetName()+"_unscaled" not in [histo.GetName() for histo in pieceHistoList]:
+        h = GetShortHistoName(pieceHistoName)
+        pieceHisto.SetName(h)
+        if "eventspassingcuts" in h.lower() and "unscaled" not in h.lower():
+            if h+"_unscaled" not in pieceHistoNames:
                 # create new EventsPassingCuts hist that doesn't have scaling/reweighting by int. lumi.
                 unscaledEvtsPassingCuts = copy.deepcopy(pieceHisto)
-                unscaledEvtsPassingCuts.SetNameTitle(pieceHisto.GetName()+"_unscaled", pieceHisto.GetTitle()+"_unscaled")
-                #print("INFO: UpdateHistoDict(): sample={}, piece={}, create new EventsPassingCuts hist from {} that doesn't have scaling/reweighting by int. lumi. idx is now {}".format(sample, piece, pieceHisto.GetName(), idx), flush=True)
-                sampleHistoDict, unscaledEvtsPassingCuts = updateSample(sampleHistoDict, unscaledEvtsPassingCuts, idx, piece, sameProcess, sample, 1.0, correlateLHESystematics, isData, systNameToBranchTitleDict, uncorrelatedSysts, symmetrize, flatSystematics, sameYear)
-                # scaledHistos.append(unscaledEvtsPassingCuts)
-                idx += 1
+                unscaledEvtsPassingCuts.SetNameTitle(h+"_unscaled", pieceHisto.GetTitle()+"_unscaled")
+                sampleHistoDict, unscaledEvtsPassingCuts = updateSample(sampleHistoDict, unscaledEvtsPassingCuts, h+"_unscaled", piece, sameProcess, sample, 1.0, correlateLHESystematics, isData, systNameToBranchTitleDict, uncorrelatedSysts, symmetrize, flatSystematics, sameYear)
+                namesUpdated.add(h+"_unscaled")
         #print("INFO: updateSample for sample={}, correlateLHESystematics={}".format(sample, correlateLHESystematics), flush=True)
-        # print("SICDEBUG: [1] UpdateHistoDict(): sample={}, piece={}, pieceHisto={}, idx={}".format(sample, piece, pieceHisto.GetName(), idx), flush=True)
-        sampleHistoDict, pieceHisto = updateSample(sampleHistoDict, pieceHisto, idx, piece, sameProcess, sample, plotWeight, correlateLHESystematics, isData, systNameToBranchTitleDict, uncorrelatedSysts, symmetrize, flatSystematics, sameYear)
-        # scaledHistos.append(pieceHisto)
-        # if idx < 2:
-        #     print "\tINFO: UpdateHistoDict for sample {}: added pieceHisto {} with entries {} to sampleHistoDict[idx], which has name {} and entries {}".format(
-        #             sample, pieceHisto.GetName(), pieceHisto.GetEntries(), sampleHistoDict[idx].GetName(), sampleHistoDict[idx].GetEntries())
-        idx += 1
+        sampleHistoDict, pieceHisto = updateSample(sampleHistoDict, pieceHisto, h, piece, sameProcess, sample, plotWeight, correlateLHESystematics, isData, systNameToBranchTitleDict, uncorrelatedSysts, symmetrize, flatSystematics, sameYear)
+        namesUpdated.add(h)
         pieceHisto = None # try to clear
+    if len(namesBefore):
+        # every piece must provide the same set of histos
+        missingNames = namesBefore - namesUpdated
+        extraNames = set(sampleHistoDict.keys()) - namesBefore
+        if len(missingNames) or len(extraNames):
+            raise RuntimeError(
+                    "ERROR: non-matching histos between sample {} and piece {}: histos missing from piece: {}; histos only in piece: {}. Quitting here".format(
+                        sample, piece, sorted(missingNames), sorted(extraNames)))
     # check TMap consistency
-    #sampleTMap = next((x for x in pieceHistoList if x.ClassName() == "TMap" and "systematicNameToBranchesMap" in x.GetName()), None)
     comboTMap = next((x for x in list(sampleHistoDict.values()) if x.ClassName() == "TMap" and "systematicNameToBranchesMap" in x.GetName()), None)
-    # comboSystHist = next((x for x in list(sampleHistoDict.values()) if x.GetName().endswith("systematics")), None)
     comboSystHist = next((x for x in list(sampleHistoDict.values()) if x.GetName() == "systematics"), None)
     if comboSystHist is None:
         comboSystHist = next((x for x in list(sampleHistoDict.values()) if "systematics" == x.GetName().split("__")[-1] ), None)
-    # if comboSystHist is not None:
-    #     # print "Could not find comboSystHist in sampleHistoDict"
-    #     # print [x.GetName() for x in sampleHistoDict.values() if "systematics" in x.GetName()]
-    #     yBinLabels = [label.GetString().Data() for label in comboSystHist.GetYaxis().GetLabels()]
-    #     print("SICDEBUG UpdateHistoDict() (AFTER COMBINING): combo/sample systhist={}, y bin labels=".format(comboSystHist.GetName()), len(list(yBinLabels)), list(yBinLabels))
-    #     print("SICDEBUG UpdateHistoDict() (AFTER COMBINING): combo/sample systhist={}, {} y bins in hist".format(comboSystHist.GetName(), comboSystHist.GetNbinsY()))
     if not isData and comboSystHist is not None:
         # ignore pdf/scale weight bins, since we handle them specially
         binLabels = list(comboSystHist.GetYaxis().GetLabels())
@@ -1477,7 +2050,11 @@ def UpdateHistoDict(sampleHistoDict, pieceHistoList, piece, sameProcess=True, sa
                      and "lumi" not in label.GetString().Data().lower()
                      and "dynorm" not in label.GetString().Data().lower()
                      and "ttbarnorm" not in label.GetString().Data().lower()]
-        CheckSystematicsTMapConsistency(comboTMap, sampleTMap, binLabels)
+        # only check each distinct TMap key set/syst list once per sample
+        tmapKeySet = (GetTMapKeySet(sampleTMap), tuple(label.GetString().Data() for label in binLabels))
+        if tmapKeySet not in sampleHistoDict.validatedTMapKeySets:
+            CheckSystematicsTMapConsistency(comboTMap, sampleTMap, binLabels)
+            sampleHistoDict.validatedTMapKeySets.add(tmapKeySet)
     return sampleHistoDict #, scaledHistos  # copy.deepcopy(pieceHistoList)
 
 
@@ -1580,7 +2157,7 @@ def updateSample(dictFinalHistoAtSample, htemp, h, piece, sameProcess, sample, p
         if "TMap" not in htemp.ClassName():
             dictFinalHistoAtSample[h].Sumw2()
     if "optimizerentries" in histoName.lower() or "noweight" in histoName.lower() or "unscaled" in histoName.lower():
-        returnVal = dictFinalHistoAtSample[h].Add(htemp)
+        returnVal = AddHistoArrays(dictFinalHistoAtSample[h], htemp) or dictFinalHistoAtSample[h].Add(htemp)
     else:
         if "TMap" in htemp.ClassName() and "systematicNameToBranchesMap" in histoName:
             # for this special TMap, check that the keys and values are consistent
@@ -1734,7 +2311,9 @@ def updateSample(dictFinalHistoAtSample, htemp, h, piece, sameProcess, sample, p
 
         # Sep. 17 2017: scale first, then add with weight=1 to have "entries" correct
         # htemp.Scale(plotWeight)
-        if plotWeight != 1.0:
+        # same binning: one multiply-add over the bin arrays, with the statistics handled as for Scale()+Add()
+        returnVal = AddHistoArrays(dictFinalHistoAtSample[h], htemp, plotWeight if IsHistoScaled(htemp) else 1.0)
+        if not returnVal and plotWeight != 1.0:
             ScaleHisto(htemp, plotWeight)
         #r.gDebug = 3
         #r.gErrorIgnoreLevel = r.kPrint
@@ -1760,7 +2339,8 @@ def updateSample(dictFinalHistoAtSample, htemp, h, piece, sameProcess, sample, p
         #     yBinLabels = [label.GetString().Data() for label in htemp.GetYaxis().GetLabels()]
         #     print("SICDEBUG2.1 updateSample() : htemp hist={}, y bin labels=".format(htemp.GetName()), len(list(yBinLabels)), list(yBinLabels))
         #     print("SICDEBUG2.1 updateSample() : htemp hist={}, {} y bins in hist".format(htemp.GetName(), htemp.GetNbinsY()))
-        returnVal = dictFinalHistoAtSample[h].Add(htemp)
+        if not returnVal:
+            returnVal = dictFinalHistoAtSample[h].Add(htemp)
         # SICDEBUG
         # if "systematics" == dictFinalHistoAtSample[h].GetName().split("__")[-1]:
         #     print("SICDEBUG2.2 updateSample() : final hist={}, {} y bins in hist".format(dictFinalHistoAtSample[h].GetName(), dictFinalHistoAtSample[h].GetNbinsY()))
@@ -2226,16 +2806,20 @@ def GetSystematicGraphAndHist(bkgTotalHist, systNames, verbose=False):
     return systHist, systGraph
 
 
-def ScaleHisto(histo, plotWeight):
+def IsHistoScaled(histo):
     histoNameStrsToSkip = ["optimizerentries", "noweight", "unscaled", "unweighted"]
     # if "optimizerentries" in histoName.lower() or "noweight" in histoName.lower() or "unscaled" in histoName.lower() or "unweighted" in histoName.lower():
     #     continue
     histoName = histo.GetName()
     if any(substring in histoName.lower() for substring in histoNameStrsToSkip):
-        return
+        return False
     elif "TMap" in histo.ClassName():
-        return
-    else:
+        return False
+    return True
+
+
+def ScaleHisto(histo, plotWeight):
+    if IsHistoScaled(histo):
         histo.Scale(plotWeight)
 
 
@@ -2589,6 +3173,45 @@ def GetFinalSelection(selectionPoint):
     return selection
 
 
+class EventsPassingCutsArrays:
+    # EventsPassingCuts TProfile of one sample read once into arrays, so that rates at any selection are lookups by bin label
+    # gives the same numbers as GetRatesAndErrors() and GetFailingRatesAndErrors()
+    def __init__(self, combinedRootFile, sampleName, histName="EventsPassingCuts"):
+        self.histName = "profile1D__"+sampleName+"__"+histName
+        self.fileName = combinedRootFile.GetName()
+        scaledHist = combinedRootFile.Get(self.histName)
+        if not scaledHist or scaledHist.ClassName() != "TProfile":
+            raise RuntimeError("Could not find TProfile named '{}' in file: {}".format(self.histName, self.fileName))
+        bins = range(scaledHist.GetNbinsX()+2)
+        # raw events (without weights or any kind of scaling) will always be the BinEntries in a TProfile, even if scaling/weights are applied
+        self.binEntries = np.array([scaledHist.GetBinEntries(iBin) for iBin in bins])
+        self.rates = np.array([scaledHist.GetBinContent(iBin) for iBin in bins])*self.binEntries
+        self.rateErrs = np.sqrt(GetHistoSumw2Array(scaledHist))
+        # like FindFixBin(), the first bin with a given label wins
+        self.binByLabel = {}
+        for iBin in range(1, scaledHist.GetNbinsX()+1):
+            self.binByLabel.setdefault(scaledHist.GetXaxis().GetBinLabel(iBin), iBin)
+
+    def GetBin(self, selection):
+        selectionBin = self.binByLabel.get(selection, -1)
+        if selectionBin < 1:
+            raise RuntimeError("Could not find requested selection name '{}' in hist {} in file {}".format(
+                selection, self.histName, self.fileName))
+        return selectionBin
+
+    def GetRatesAndErrors(self, selection):
+        selectionBin = self.GetBin(GetFinalSelection(selection))
+        return float(self.rates[selectionBin]), float(self.rateErrs[selectionBin]), float(self.binEntries[selectionBin])
+
+    def GetFailingRatesAndErrors(self, selection, trainingSelectionCutName):
+        selectionBin = self.GetBin(GetFinalSelection(selection))
+        prevSelectionBin = self.GetBin(trainingSelectionCutName)
+        failRate = self.rates[prevSelectionBin] - self.rates[selectionBin]
+        failRateErr = math.sqrt(pow(float(self.rateErrs[selectionBin]), 2) + pow(float(self.rateErrs[prevSelectionBin]), 2))
+        rawEventsAtFailSelection = self.binEntries[prevSelectionBin] - self.binEntries[selectionBin]
+        return float(failRate), failRateErr, float(rawEventsAtFailSelection)
+
+
 def GetRatesAndErrors(
         combinedRootFile,
         sampleName,
@@ -2765,13 +3388,14 @@ def AddHistoBins(hist, axis, labelsToAdd):
             hist.GetXaxis().Copy(newHist.GetXaxis())
             if IsHistEmpty(hist):
                 return newHist
-            # now handle bin content
-            for xbin in range(0, newHist.GetNbinsX()+2):
-                for ybin in range(0, hist.GetNbinsY()+1):
-                    binContent = hist.GetBinContent(xbin, ybin)
-                    binError = hist.GetBinError(xbin, ybin)
-                    newHist.SetBinContent(xbin, ybin, binContent)
-                    newHist.SetBinError(xbin, ybin, binError)
+            # now handle bin content: the old rows from the y underflow up to the last bin are copied, the new ones are empty
+            contents, errorsSqr = GetHisto2DArrays(hist)
+            nCopiedRows = hist.GetNbinsY()+1
+            newContents = np.zeros((numNewBins+2, newHist.GetNbinsX()+2))
+            newErrorsSqr = np.zeros_like(newContents)
+            newContents[:nCopiedRows] = contents[:nCopiedRows]
+            newErrorsSqr[:nCopiedRows] = errorsSqr[:nCopiedRows]
+            SetHisto2DArrays(newHist, newContents, newErrorsSqr, newContents[:nCopiedRows].size)
             return newHist
         else:
             raise RuntimeError("ERROR: AddHistoBins not implemented for axes other than y, and {} was requested.".format(axis))
@@ -2799,24 +3423,21 @@ def RemoveHistoBins(hist, axis, labelsToRemove):
             for ibin in range(1, numNewBins+1):
                 newHist.GetYaxis().SetBinLabel(ibin, newBinLabels[ibin-1])
             hist.GetXaxis().Copy(newHist.GetXaxis())
+            # map each new y bin (including under/overflow) to the old one, skipping the removed labels
+            # past the old overflow there are no labels, and GetBinContent() returns the overflow
+            oldYBinsAndLabels = [(ybin, hist.GetYaxis().GetBinLabel(ybin)) for ybin in range(0, hist.GetNbinsY()+2)]
+            oldYBinsAndLabels = [(ybin, label) for ybin, label in oldYBinsAndLabels if label not in labelsToRemove]
+            oldYBinsAndLabels += [(hist.GetNbinsY()+1, "")]*max(0, numNewBins+2-len(oldYBinsAndLabels))
+            for ybin in range(0, numNewBins+2):
+                binLabelOld = oldYBinsAndLabels[ybin][1]
+                binLabelNew = newHist.GetYaxis().GetBinLabel(ybin)
+                if binLabelNew != binLabelOld:
+                    raise RuntimeError("RemoveHistoBins(): bin label of old histo {} doesn't match new histo label {}!".format(
+                        binLabelOld, binLabelNew))
             # now handle bin content
-            for xbin in range(0, newHist.GetNbinsX()+2):
-                ybin = 0
-                ybinOld = 0
-                while ybin < newHist.GetNbinsY()+2:
-                    while hist.GetYaxis().GetBinLabel(ybinOld) in labelsToRemove:
-                        ybinOld += 1
-                    binLabelOld = hist.GetYaxis().GetBinLabel(ybinOld)
-                    binLabelNew = newHist.GetYaxis().GetBinLabel(ybin)
-                    if binLabelNew != binLabelOld:
-                        raise RuntimeError("RemoveHistoBins(): bin label of old histo {} doesn't match new histo label {}!".format(
-                            binLabelOld, binLabelNew))
-                    binContent = hist.GetBinContent(xbin, ybinOld)
-                    binError = hist.GetBinError(xbin, ybinOld)
-                    newHist.SetBinContent(xbin, ybin, binContent)
-                    newHist.SetBinError(xbin, ybin, binError)
-                    ybin += 1
-                    ybinOld += 1
+            oldYBins = [ybin for ybin, label in oldYBinsAndLabels[:numNewBins+2]]
+            contents, errorsSqr = GetHisto2DArrays(hist)
+            SetHisto2DArrays(newHist, contents[oldYBins], errorsSqr[oldYBins], (numNewBins+2)*(newHist.GetNbinsX()+2))
             return newHist
         else:
             raise RuntimeError("ERROR: RemoveHistoBins not implemented for axes other than y, and {} was requested.".format(axis))
@@ -2830,36 +3451,18 @@ def ZeroNegativeHistoBins(histoList):
         if not hist.InheritsFrom("TH1"):
             continue
         histName = hist.GetName()
-        zeroedBinsX = []
-        zeroedBinLabelsX = []
-        zeroedBinsY = []
-        zeroedBinLabelsY = []
-        zeroedBinsContent = []
-        for iCell in range(0, hist.GetNcells()):
-            binContent = hist.GetBinContent(iCell)
-            if binContent < 0:
-                binx = ctypes.c_int()
-                biny = ctypes.c_int()
-                binz = ctypes.c_int()
-                hist.GetBinXYZ(iCell, binx, biny, binz)
-                labelx = hist.GetXaxis().GetBinLabel(binx.value)
-                labely = hist.GetYaxis().GetBinLabel(biny.value)
-                zeroedBinsX.append(binx.value)
-                zeroedBinsY.append(biny.value)
-                zeroedBinLabelsX.append(labelx)
-                zeroedBinLabelsY.append(labely)
-                zeroedBinsContent.append(binContent)
-                hist.SetBinContent(iCell, 0)
-        if len(zeroedBinsX):
-            print("INFO: Found {} bins in histo {} with with negative bin content; zeroed them.".format(len(zeroedBinsX), histName))
+        contents, entries = GetHistoBinContentArrays(hist)
+        zeroedBins = np.nonzero(contents < 0)[0]
+        SetHistoBinContents(hist, zeroedBins, np.zeros(len(zeroedBins)))
+        if len(zeroedBins):
+            print("INFO: Found {} bins in histo {} with with negative bin content; zeroed them.".format(len(zeroedBins), histName))
             if printDetailedInfo:
-                for idx, binx in enumerate(zeroedBinsX):
-                    biny = zeroedBinsY[idx]
-                    labelx = zeroedBinLabelsX[idx]
-                    labely = zeroedBinLabelsY[idx]
-                    binContent = zeroedBinsContent[idx]
+                zeroedBinsZ, zeroedBinsY, zeroedBinsX = np.unravel_index(zeroedBins, (hist.GetNbinsZ()+2, hist.GetNbinsY()+2, hist.GetNbinsX()+2))
+                for globalBin, binx, biny in zip(zeroedBins, zeroedBinsX, zeroedBinsY):
+                    labelx = hist.GetXaxis().GetBinLabel(int(binx))
+                    labely = hist.GetYaxis().GetBinLabel(int(biny))
                     print("INFO: Found bin({}, {}) in histo {} with labelsX '{}' labelsY '{}', with negative bin content: {}; zeroing it".format(
-                        binx, biny, histName, labelx, labely, binContent))
+                        binx, biny, histName, labelx, labely, contents[globalBin]))
 
 
 def MakeSystDiffsPlot(systHist):
@@ -1,33 +1,40 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 # ---Import
 import sys
 import os
-import string
 from optparse import OptionParser
 import glob
+import math
 import multiprocessing
+import queue
+import shutil
+import tempfile
+import time
 import traceback
 import re
+from collections import OrderedDict
 import ROOT as r
 import combineCommon
 import faulthandler
 faulthandler.enable()
 
-result_list = []
+r.gROOT.SetBatch(True)
+
 logString = "INFO: running {} parallel jobs for {} separate datasets found in inputList..."
+eventsPassingHistName = "EventsPassingCutsAllHist"
 
 
 def CombineLikeDatasets(dictDatasetsFileNames):
     combinedDictDatasetsFileNames = dict()
     sanitizedDatasetsHandled = []
-    for dataset, fileList in dictDatasetsFileNames.iteritems():
+    for dataset, fileList in dictDatasetsFileNames.items():
         sanitizedName = combineCommon.SanitizeDatasetNameFromInputList(dataset)
         if sanitizedName in sanitizedDatasetsHandled:
             continue  # already handled this dataset
         matchingDatasets = []
         matchingFiles = []
-        for matchingDataset, matchingFileList in dictDatasetsFileNames.iteritems():
+        for matchingDataset, matchingFileList in dictDatasetsFileNames.items():
             sanitizedMatchingName = combineCommon.SanitizeDatasetNameFromInputList(matchingDataset)
             if sanitizedMatchingName == sanitizedName:
                 matchingFiles.extend(matchingFileList)
@@ -40,57 +47,111 @@ def CombineLikeDatasets(dictDatasetsFileNames):
     return combinedDictDatasetsFileNames
 
 
-def log_result(result):
-    # This is called whenever foo_pool(i) returns a result.
-    # result_list is modified only by the main process, not the pool workers.
-    result_list.append(result)
-    sys.stdout.write("\r"+logString.format(jobCount, datasetCount))
-    sys.stdout.write("\t"+str(len(result_list))+" jobs done")
-    sys.stdout.flush()
+def ReadJobOutput(rootFilename):
+    # histos and table of one job output; the root file is opened only once, and the table errors are taken from the EventsPassingCutsAllHist read with the other histos
+    table = combineCommon.LoadCutTable(rootFilename.replace(".root", ".dat"))
+    histos = OrderedDict()
+    for histName, histo in combineCommon.SampleHistoReader(rootFilename):
+        histos[histName] = histo
+        if histName == eventsPassingHistName:
+            table.FillErrorsFromHist(histo)
+    if eventsPassingHistName not in histos:
+        raise RuntimeError("ERROR: could not find hist '{}' in file '{}'.".format(eventsPassingHistName, rootFilename))
+    return histos, table
+
+
+def ReadPartialSum(partialBasename):
+    table = combineCommon.CutTable.FromNpz(partialBasename + ".npz")
+    histos = OrderedDict(combineCommon.SampleHistoReader(partialBasename + ".root"))
+    return histos, table
+
+
+def AddHistos(histos, histosToAdd):
+    for histName, histo in histosToAdd.items():
+        if histName not in histos:
+            histos[histName] = histo
+        elif histo.InheritsFrom("TH1"):
+            if not combineCommon.AddHistoArrays(histos[histName], histo):
+                histos[histName].Add(histo)
+        # anything else (e.g. the systematicNameToBranchesMap) is the same for all jobs of a dataset, so we keep the first one
+    return histos
+
+
+def WriteHistos(tfileName, histos):
+    outputTfile = r.TFile(tfileName, "RECREATE", "", 207)
+    for histName, histo in histos.items():
+        if histo.ClassName() == "TMap":
+            histo.Write(histName, r.TObject.kSingleKey)
+        else:
+            histo.Write(histName)
+    outputTfile.Close()
 
 
-def CombinePlotsAndTables(args):
-    fileList, datasetName = args
-    # print "INFO: CombinePlotsAndTables() called for datasetName {} -- {} input files: {}".format(datasetName, len(fileList), fileList)
+def ReduceOutputs(args):
+    # sum job outputs (or partial sums from earlier reductions) into the partial sum <outputBasename>.root/.npz
+    inputs, outputBasename, inputsArePartial = args
+    timeStarted = time.time()
     try:
-        sampleHistos = {}
-        sampleTable = {}
-        for currentRootFile in fileList:
-            combineCommon.AddHistosFromFile(currentRootFile, sampleHistos, currentRootFile)  # use root filename as piece name--only used for logging
-            # print "INFO: done with AddHistosFromFile for datasetName {} file {}".format(datasetName, currentRootFile)
-            # sys.stdout.flush()
-            currentDatFile = currentRootFile.replace(".root", ".dat")
-            # print "INFO: ParseDatFile for datasetName {} file {}".format(datasetName, currentRootFile)
-            # sys.stdout.flush()
-            data = combineCommon.ParseDatFile(currentDatFile)
-            # print "INFO: FillTableErrors for datasetName {} file {}".format(datasetName, currentRootFile)
-            # sys.stdout.flush()
-            data = combineCommon.FillTableErrors(data, currentRootFile)
-            # print "INFO: UpdateTable for datasetName {} file {}".format(datasetName, currentRootFile)
-            # sys.stdout.flush()
-            sampleTable = combineCommon.UpdateTable(data, sampleTable)
-        # print "INFO: CalculateEfficiency for datasetName {}".format(datasetName)
-        # sys.stdout.flush()
-        sampleTable = combineCommon.CalculateEfficiency(sampleTable)
-        outputTableFilename = options.outputDir + "/" + options.analysisCode + "___" + datasetName + ".dat"
-        # print "INFO: WriteTable for datasetName {}".format(datasetName)
-        # sys.stdout.flush()
-        with open(outputTableFilename, "w") as outputTableFile:
-            # print "Write table to file:", outputTableFilename
-            combineCommon.WriteTable(sampleTable, datasetName, outputTableFile)
-        outputTfile = r.TFile(
-            outputTableFilename.replace(".dat", ".root"), "RECREATE", "", 207
-        )
-        # print "INFO: opened TFile; writing histos for datasetName {} to file {}".format(datasetName, outputTfile.GetName())
-        # sys.stdout.flush()
-        combineCommon.WriteHistos(outputTfile, sampleHistos)
-        outputTfile.Close()
+        histos = OrderedDict()
+        table = None
+        for inputName in inputs:
+            if inputsArePartial:
+                histosThisInput, tableThisInput = ReadPartialSum(inputName)
+            else:
+                histosThisInput, tableThisInput = ReadJobOutput(inputName)
+            AddHistos(histos, histosThisInput)
+            table = combineCommon.UpdateCutTable(tableThisInput, table)
+        WriteHistos(outputBasename + ".root", histos)
+        table.WriteNpz(outputBasename + ".npz")
+        if inputsArePartial:
+            for inputName in inputs:
+                os.remove(inputName + ".root")
+                os.remove(inputName + ".npz")
     except Exception as e:
-        print "ERROR: exception in CombinePlotsAndTables for datasetName={}".format(datasetName)
+        print("ERROR: exception in ReduceOutputs for output={}".format(outputBasename), flush=True)
         traceback.print_exc()
         raise e
+    return outputBasename, timeStarted, time.time()
 
-    return True
+
+class DatasetReduction:
+    # bookkeeping for the tree reduction of one dataset: job outputs are summed in chunks, then the partial sums pairwise
+    def __init__(self, datasetName, fileList, tmpDir, filesPerTask):
+        self.datasetName = datasetName
+        self.fileList = fileList
+        self.tmpDir = tmpDir
+        self.chunks = [fileList[i:i+filesPerTask] for i in range(0, len(fileList), filesPerTask)]
+        self.nBytes = sum(os.path.getsize(rootFile) + os.path.getsize(rootFile.replace(".root", ".dat")) for rootFile in fileList)
+        self.partialSums = []
+        self.nPending = 0
+        self.nTasks = 0
+        self.failed = False
+        self.timeStarted = None
+        self.timeEnded = None
+
+    def NewBasename(self):
+        self.nTasks += 1
+        return os.path.join(self.tmpDir, "{}_{}".format(self.datasetName, self.nTasks))
+
+    def AddResult(self, result):
+        outputBasename, timeStarted, timeEnded = result
+        self.timeStarted = timeStarted if self.timeStarted is None else min(self.timeStarted, timeStarted)
+        self.timeEnded = timeEnded if self.timeEnded is None else max(self.timeEnded, timeEnded)
+        self.partialSums.append(outputBasename)
+
+    def IsDone(self):
+        return self.nPending == 0 and len(self.partialSums) == 1
+
+    def Finalize(self, outputDir, analysisCode):
+        outputName = outputDir + "/" + analysisCode + "___" + self.datasetName
+        sampleTable = combineCommon.CutTable.FromNpz(self.partialSums[0] + ".npz").CalculateEfficiency()
+        with open(outputName + ".dat", "w") as outputTableFile:
+            combineCommon.WriteTable(sampleTable, self.datasetName, outputTableFile)
+        shutil.move(self.partialSums[0] + ".root", outputName + ".root")
+        os.remove(self.partialSums[0] + ".npz")
+        elapsed = max(self.timeEnded - self.timeStarted, 1e-6)
+        print("INFO: [{}] combined {} files ({:.1f} MB) with {} tasks in {:.1f} s: {:.2f} files/s, {:.2f} MB/s".format(
+            self.datasetName, len(self.fileList), self.nBytes/1024**2, self.nTasks, elapsed, len(self.fileList)/elapsed, self.nBytes/1024**2/elapsed), flush=True)
 
 
 usage = "usage: %prog [options] \nExample: \n./combineOutputJobs.py "
@@ -148,34 +209,49 @@ parser.add_option(
     metavar="EXCLUDEDATASETS",
 )
 
+parser.add_option(
+    "-n",
+    "--nCores",
+    dest="nCores",
+    type=int,
+    default=4,  # only use 4 parallel jobs by default to be nice
+    help="number of parallel worker processes; defaults to 4",
+    metavar="NCORES",
+)
+
+parser.add_option(
+    "-f",
+    "--filesPerTask",
+    dest="filesPerTask",
+    type=int,
+    default=0,
+    help="number of job outputs summed by one task before the partial sums are merged pairwise; defaults to splitting each dataset over all cores, with at least 10 files per task",
+    metavar="FILESPERTASK",
+)
+
 (options, args) = parser.parse_args()
 
 if options.inputList is None or options.analysisCode is None or options.inputDir is None or options.outputDir is None:
-    print "ERROR: missing a required option: i, c, d, o"
+    print("ERROR: missing a required option: i, c, d, o")
     parser.print_help()
     exit(-1)
 
 if not os.path.exists(options.outputDir):
     os.makedirs(options.outputDir)
 
-# ncores = multiprocessing.cpu_count()
-ncores = 4  # only use 4 parallel jobs to be nice
-pool = multiprocessing.Pool(ncores)
-
 # ---Loop over datasets in the inputlist to check if dat/root files are there
 #FIXME use combineCommon.FindInputFiles instead (needs some adaptation)
 dictDatasetsFileNames = {}
 missingDatasets = []
-jobCount = 0
 datasetCount = 0
 for lin in open(options.inputList):
 
-    lin = string.strip(lin, "\n")
+    lin = lin.strip("\n")
     # print 'lin=',lin
     if lin.startswith("#"):
         continue
 
-    dataset_fromInputList = string.split(string.split(lin, "/")[-1], ".")[0]
+    dataset_fromInputList = lin.split("/")[-1].split(".")[0]
     datasetCount += 1
     # strip off the slashes and the .txt at the end
     # so this will look like 'TTJets_DiLept_reduced_skim'
@@ -208,9 +284,9 @@ for lin in open(options.inputList):
         fileList = glob.glob(fullPath2+"/"+rootFileName1.replace(".root", "_*.root"))
         completeNamesTried.append(fullPath2+"/"+rootFileName1.replace(".root", "_*.root"))
     if len(fileList) < 1:
-        print "ERROR: could not find root file for dataset:", dataset_fromInputList
-        print "ERROR: tried these full paths:", completeNamesTried
-        print
+        print("ERROR: could not find root file for dataset:", dataset_fromInputList)
+        print("ERROR: tried these full paths:", completeNamesTried)
+        print()
         missingDatasets.append(dataset_fromInputList)
         continue
     # sampleName = combineCommon.SanitizeDatasetNameFromInputList(dataset_fromInputList.replace("_tree", ""))
@@ -220,49 +296,89 @@ for lin in open(options.inputList):
 datasetsToKeepSeparate = []
 if len(options.regexToExcludeFromCombining) > 0:
     regex = re.compile(options.regexToExcludeFromCombining)
-    for dataset, fileList in dictDatasetsFileNames.iteritems():
+    for dataset, fileList in dictDatasetsFileNames.items():
         regexMatch = re.match(regex, dataset)
         if regexMatch:
             datasetsToKeepSeparate.append(dataset)
-    print "Not combining like datasets for: {}".format(datasetsToKeepSeparate)
+    print("Not combining like datasets for: {}".format(datasetsToKeepSeparate))
 dictDatasetsToKeepSeparate = {dataset: fileList for dataset, fileList in dictDatasetsFileNames.items() if dataset in datasetsToKeepSeparate}
 dictDatasetsToCombine = {dataset: fileList for dataset, fileList in dictDatasetsFileNames.items() if dataset not in datasetsToKeepSeparate}
 dictDatasetsFileNames = CombineLikeDatasets(dictDatasetsToCombine)
 dictDatasetsFileNames.update(dictDatasetsToKeepSeparate)
 
-for datasetName, fileList in dictDatasetsFileNames.iteritems():
-    try:
-        pool.apply_async(CombinePlotsAndTables, [[fileList, datasetName]], callback=log_result)
-        jobCount += 1
-    except KeyboardInterrupt:
-        print "\n\nCtrl-C detected: Bailing."
-        pool.terminate()
-        sys.exit(1)
-    except Exception as e:
-        print "ERROR: caught exception in job for datasetName: {}; exiting".format(datasetName)
-        exit(-2)
+# ---Sum the job outputs of each dataset: chunks of files first, then pairs of partial sums, until one is left
+ncores = options.nCores
+tmpDir = tempfile.mkdtemp(prefix=".combineOutputJobs_", dir=options.outputDir)
+reductions = []
+for datasetName, fileList in dictDatasetsFileNames.items():
+    filesPerTask = options.filesPerTask
+    if filesPerTask <= 0:
+        filesPerTask = max(10, int(math.ceil(len(fileList)/float(ncores))))
+    reductions.append(DatasetReduction(datasetName, sorted(fileList), tmpDir, filesPerTask))
+# start the largest datasets first
+reductions.sort(key=lambda reduction: reduction.nBytes, reverse=True)
+jobCount = sum(len(reduction.chunks) for reduction in reductions)
+resultQueue = queue.Queue()
+failedDatasets = []
+datasetsDone = 0
+
+
+def Submit(reduction, inputs, inputsArePartial):
+    # the callbacks run in the pool's result thread; everything else happens in the main loop below
+    reduction.nPending += 1
+    pool.apply_async(
+            ReduceOutputs, [[inputs, reduction.NewBasename(), inputsArePartial]],
+            callback=lambda result: resultQueue.put((reduction, result, None)),
+            error_callback=lambda e: resultQueue.put((reduction, None, e)))
+
+
+pool = multiprocessing.Pool(ncores)
+try:
+    for reduction in reductions:
+        for chunk in reduction.chunks:
+            Submit(reduction, chunk, False)
+    print(logString.format(jobCount, datasetCount), flush=True)
+    while any(reduction.nPending > 0 for reduction in reductions):
+        reduction, result, error = resultQueue.get()
+        reduction.nPending -= 1
+        if error is not None:
+            if not reduction.failed:
+                print("ERROR: caught exception in job for datasetName: {}: {}".format(reduction.datasetName, error), flush=True)
+                failedDatasets.append(reduction.datasetName)
+            reduction.failed = True
+        if reduction.failed:
+            continue
+        reduction.AddResult(result)
+        while len(reduction.partialSums) > 1:
+            Submit(reduction, reduction.partialSums[:2], True)
+            del reduction.partialSums[:2]
+        if reduction.IsDone():
+            reduction.Finalize(options.outputDir, options.analysisCode)
+            datasetsDone += 1
+            print("INFO: {} of {} combined datasets done".format(datasetsDone, len(reductions)), flush=True)
+except KeyboardInterrupt:
+    print("\n\nCtrl-C detected: Bailing.")
+    pool.terminate()
+    sys.exit(1)
 
 # now close the pool and wait for jobs to finish
 pool.close()
-sys.stdout.write(logString.format(jobCount, datasetCount))
-sys.stdout.write("\t"+str(len(result_list))+" jobs done")
-sys.stdout.flush()
 pool.join()
-# check results?
-if len(result_list) < jobCount:
-    print "ERROR: {} jobs had errors. Exiting.".format(jobCount-len(result_list))
+# check results
+if len(failedDatasets):
+    print("ERROR: {} datasets had errors: {}. Partial sums are left in {}. Exiting.".format(len(failedDatasets), failedDatasets, tmpDir))
     exit(-2)
+shutil.rmtree(tmpDir)
 
 # don't remove anything until everything looks OK
 if not options.saveInputFiles:
-    for datasetName, fileList in dictDatasetsFileNames.iteritems():
+    for datasetName, fileList in dictDatasetsFileNames.items():
         # print "removing input root files"
         for rootFile in fileList:
             os.remove(rootFile)
-print
-print "Done"
-sys.stdout.flush()
+print()
+print("Done", flush=True)
 
 if len(missingDatasets):
-    print "ERROR: Some files not found. Missing datasets:", missingDatasets, ". Exiting..."
+    print("ERROR: Some files not found. Missing datasets:", missingDatasets, ". Exiting...")
     exit(-2)
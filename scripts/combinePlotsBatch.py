@@ -213,39 +213,81 @@ def GetXSection(matchingPiece, xsections):
     return xsection_val, xsectionFound
 
 
-def LoadDataFromRootFile(datasetsFileNamesCleaned, currentPiece, sample, histoNamesToUse, xsectionFound, useInclusionList, doHists,
-                         singleFilePiece, intLumi, matchingPiece, corrLHESysts, isMC, isQCD, xsection_val):
+def GetDatFilename(rootFilename):
+    return rootFilename.replace(".root", ".dat").replace("plots", "tables").replace("root://eoscms/", "/eos/cms/").replace("root://eosuser/", "/eos/user/")
+
+
+def ReadFileData(rootFilename, sample, histoNamesToUse, xsectionFound, useInclusionList, doHists, stream, datFileCache=None):
+    # read histos and table from one job output
+    if doHists and stream:
+        # objects are only read from the file as UpdateHistoDict() consumes them
+        sampleHistos = combineCommon.SampleHistoReader(rootFilename, sample, xsectionFound, histoNamesToUse if useInclusionList and xsectionFound else None)
+        if len(sampleHistos) < 1:
+            raise RuntimeError("ReadFileData({}, {}) -- failed to find any histos for the sampleName in this file!".format(rootFilename, sample))
+    elif doHists:
+        if useInclusionList:
+            sampleHistos = GetHistosFromInclusionList(rootFilename, sample, histoNamesToUse, xsectionFound)
+        else:
+            sampleHistos = combineCommon.GetSampleHistosFromTFile(rootFilename, sample, xsectionFound)
+    else:
+        sampleHistos = GetHistosFromInclusionList(rootFilename, sample, ["SumOfWeights", "LHEPdfSumw"], xsectionFound)
+
+    # XXX  DEBUG
+    # sampleHistos = [hist for hist in sampleHistos if any(nameToKeep in hist.GetName() for nameToKeep in ["Pt1stEle_LQ1200", "BDTOutput_LQ1200", "SumOfWeights", "systematicNameToBranchesMap", "systematics"])]
+    # XXX  DEBUG END
+
+    # ---Read .dat table
+    data = combineCommon.LoadCutTable(GetDatFilename(rootFilename), datFileCache)
+    if xsectionFound:
+        # unscaled job output, so the errors come from the unprefixed hist
+        data.FillErrors(rootFilename)
+    return sampleHistos, data
+
+
+def ReadFileDataInWorker(args):
+    # ReadFileData() in the worker processes with --nWorkers: the histos are read in full to be sent back to the parent,
+    # and so are the hits/misses of the worker's own copy of the dat file cache
+    rootFilename, sample, histoNamesToUse, xsectionFound, useInclusionList, doHists, datFileCache = args
+    cacheCounts = (datFileCache.hits, datFileCache.misses) if datFileCache is not None else (0, 0)
+    sampleHistos, data = ReadFileData(rootFilename, sample, histoNamesToUse, xsectionFound, useInclusionList, doHists, False, datFileCache)
+    if datFileCache is not None:
+        cacheCounts = (datFileCache.hits-cacheCounts[0], datFileCache.misses-cacheCounts[1])
+    return sampleHistos, data, cacheCounts
+
+
+def ReadFilesInWorkers(rootFilenames, readArgs, pool, datFileCache=None):
+    # the files come back from the workers in their original order
+    for sampleHistos, data, cacheCounts in pool.imap(ReadFileDataInWorker, [(rootFilename,) + readArgs for rootFilename in rootFilenames]):
+        if datFileCache is not None:
+            datFileCache.hits += cacheCounts[0]
+            datFileCache.misses += cacheCounts[1]
+        yield sampleHistos, data
+
+
+def SumFiles(rootFilenames, fileData, sample, xsectionFound, doHists, singleFilePiece, intLumi, matchingPiece, corrLHESysts, isMC, isQCD,
+             xsection_val, tfileNameTemplate):
+    # sums the (sampleHistos, data) read from the given job outputs of one piece, one file after the other in the order of rootFilenames
     sumWeights = 0
     lhePdfWeightSumw = 0
     Ntot = 0
-    thisYearTable = {}
+    thisYearTable = None
     thisYearHistos = {}
-    for rootFilename in datasetsFileNamesCleaned[currentPiece]:
-        inputDatFile = rootFilename.replace(".root", ".dat").replace("plots", "tables").replace("root://eoscms/", "/eos/cms/").replace("root://eosuser/", "/eos/user/")
+    for rootFilename, (sampleHistos, data) in zip(rootFilenames, fileData):
+        inputDatFile = GetDatFilename(rootFilename)
         print("\tfile: {}".format(rootFilename), flush=True)
         # print("INFO: TFilenameTemplate = {}".format(tfileNameTemplate.format(sample)))
-        if doHists:
-            if useInclusionList:
-                sampleHistos = GetHistosFromInclusionList(rootFilename, sample, histoNamesToUse, xsectionFound)
-            else:
-                sampleHistos = combineCommon.GetSampleHistosFromTFile(rootFilename, sample, xsectionFound)
-        else:
-            sampleHistos = GetHistosFromInclusionList(rootFilename, sample, ["SumOfWeights", "LHEPdfSumw"], xsectionFound)
-
-        # XXX  DEBUG
-        # sampleHistos = [hist for hist in sampleHistos if any(nameToKeep in hist.GetName() for nameToKeep in ["Pt1stEle_LQ1200", "BDTOutput_LQ1200", "SumOfWeights", "systematicNameToBranchesMap", "systematics"])]
-        # XXX  DEBUG END
-
-        # ---Read .dat table
-        data = combineCommon.ParseDatFile(inputDatFile)
-        NtotThisFile = float(data[0]["Npass"])
+        NtotThisFile = float(data.npass[0])
         sampleNameForHist = ""
 
         if xsectionFound:
             # ---Calculate weight
             sumWeightsThisFile = 0
             lhePdfWeightSumwThisFile = 0
-            for hist in sampleHistos:
+            if isinstance(sampleHistos, combineCommon.SampleHistoReader):
+                weightHistos = sampleHistos.Select(lambda name, className: "SumOfWeights" in name or "LHEPdfSumw" in name)
+            else:
+                weightHistos = sampleHistos
+            for hist in weightHistos:
                 if "SumOfWeights" in hist.GetName():
                     sumWeightsThisFile = hist.GetBinContent(1) if "powhegMiNNLO" not in rootFilename else hist.GetBinContent(3)
                 elif "LHEPdfSumw" in hist.GetName():
@@ -270,7 +312,7 @@ def LoadDataFromRootFile(datasetsFileNamesCleaned, currentPiece, sample, histoNa
         elif rootFilename == tfileNameTemplate.format(matchingPiece):
             if not singleFilePiece:
                 raise RuntimeError("this '{}' should be a file already scaled, but there are multiple files in the currentPiece '{}' of the sample '{}' {}:".format(
-                    rootFilename, currentPiece, sample, datasetsFileNamesCleaned[currentPiece]))
+                    rootFilename, matchingPiece, sample, rootFilenames))
             print("\t[{}] histos/tables taken from file already scaled".format(sample), flush=True)
             # xsection_val = 1.0
             weight = 1.0
@@ -281,20 +323,20 @@ def LoadDataFromRootFile(datasetsFileNamesCleaned, currentPiece, sample, histoNa
             raise RuntimeError("xsection not found")
 
         # ---Update table
-        dataThisFile = combineCommon.FillTableErrors(data, rootFilename, sampleNameForHist)
+        dataThisFile = data if xsectionFound else data.FillErrors(rootFilename, sampleNameForHist)
         if singleFilePiece:
-            dataThisFile = combineCommon.CreateWeightedTable(dataThisFile, weight, xsection_X_intLumi)
-            Ntot = float(dataThisFile[0]["Npass"])
+            dataThisFile = dataThisFile.CreateWeighted(weight)
+            Ntot = float(dataThisFile.npass[0])
             print("INFO: inputDatFile={} for sample={}, NoCuts(weighted)={}".format(inputDatFile, sample, Ntot), flush=True)
             # print("\t[{}] zeroing negative table yields for currentPiece={}".format(sample, currentPiece), flush=True)
             # combineCommon.ZeroNegativeTableYields(data)
             # thisPieceTable = combineCommon.UpdateTable(data, thisPieceTable)
-            print("INFO: dataThisFile for sample={} now has NoCuts(weighted)={}".format(sample, float(dataThisFile[0]["Npass"])), flush=True)
+            print("INFO: dataThisFile for sample={} now has NoCuts(weighted)={}".format(sample, float(dataThisFile.npass[0])), flush=True)
         # sample, numPieces = combineCommon.FindSampleNameFromPiece(currentPiece, dictSamples[year])
         # TODO if desired/needed later
         # if sample in samplesToOverrideFromYieldHistos and postPreRatios is not None:
         #     OverrideTableFinalSelections(dataThisFile, sample, postPreRatios[year])
-        thisYearTable = combineCommon.UpdateTable(dataThisFile, thisYearTable)
+        thisYearTable = combineCommon.UpdateCutTable(dataThisFile, thisYearTable)
         # dataThisFile = combineCommon.CreateWeightedTable(dataThisFile, weight, xsection_X_intLumi)
 
         # dataThisFile = combineCommon.CreateWeightedTable(dataThisFile, weight, 1.0)  # xsection_X_intLumi not actually used or needed here
@@ -304,8 +346,24 @@ def LoadDataFromRootFile(datasetsFileNamesCleaned, currentPiece, sample, histoNa
         if doHists:
             print("INFO: updating thisPieceHistos using plotWeight=", plotWeight)
             thisYearHistos = combineCommon.UpdateHistoDict(thisYearHistos, sampleHistos, matchingPiece, True, sample, plotWeight, corrLHESysts, not isMC, isQCD, [], symmetrize, True)
-    Ntot = float(thisYearTable[0]["Npass"])
-    print("INFO: inputDatFile={} for sample={}, {}={}".format(inputDatFile, sample, thisYearTable[0]["variableName"], Ntot), flush=True)
+    return thisYearTable, thisYearHistos, sumWeights, lhePdfWeightSumw
+
+
+def LoadDataFromRootFile(datasetsFileNamesCleaned, currentPiece, sample, histoNamesToUse, xsectionFound, useInclusionList, doHists,
+                         singleFilePiece, intLumi, matchingPiece, corrLHESysts, isMC, isQCD, xsection_val, tfileNameTemplate, datFileCache=None, pool=None):
+    rootFilenames = datasetsFileNamesCleaned[currentPiece]
+    readArgs = (sample, histoNamesToUse, xsectionFound, useInclusionList, doHists, datFileCache)
+    # with workers, the files are only read in parallel: the sums are always done here, in file order, so that they are identical to the serial case
+    if pool is not None and len(rootFilenames) > 1:
+        fileData = ReadFilesInWorkers(rootFilenames, readArgs, pool, datFileCache)
+    else:
+        # objects are streamed from one file at a time
+        fileData = (ReadFileData(rootFilename, sample, histoNamesToUse, xsectionFound, useInclusionList, doHists, True, datFileCache) for rootFilename in rootFilenames)
+    thisYearTable, thisYearHistos, sumWeights, lhePdfWeightSumw = SumFiles(rootFilenames, fileData, sample, xsectionFound, doHists, singleFilePiece, intLumi,
+                                                                          matchingPiece, corrLHESysts, isMC, isQCD, xsection_val, tfileNameTemplate)
+    inputDatFile = GetDatFilename(rootFilenames[-1])
+    Ntot = float(thisYearTable.npass[0])
+    print("INFO: inputDatFile={} for sample={}, {}={}".format(inputDatFile, sample, thisYearTable.rows[0][0], Ntot), flush=True)
     return thisYearTable, thisYearHistos, sumWeights, lhePdfWeightSumw, Ntot
 
 
@@ -450,14 +508,18 @@ def LoadDataFromRootFile(datasetsFileNamesCleaned, currentPiece, sample, histoNa
 #     return tfileNameTemplate.format(sample), outputDatFile
 
 
-def MakeCombinedSampleScaled(sample, dictSamples, dictDatasetsFileNames, tfileNameTemplate, datFileNameTemplate, samplesToSave, dictFinalHisto, dictFinalTables):
+def MakeCombinedSampleScaled(sample, dictSamples, dictDatasetsFileNames, tfileNameTemplate, datFileNameTemplate, samplesToSave, dictFinalHisto, dictFinalTables, datFileCache=None):
     renormThisSample = sample in samplesToOverrideFromYieldHistos
     doHists = not options.tablesOnly
+    # start the workers before opening the output file, so that they don't inherit it
+    pool = None
+    if options.nWorkers > 1:
+        pool = multiprocessing.Pool(options.nWorkers)
     if doHists:
         outputTfile = TFile.Open(tfileNameTemplate.format(sample), "RECREATE", "", 207)
     outputDatFile = datFileNameTemplate.format(sample)
     histoDictThisSample = OrderedDict()
-    sampleTable = {}
+    sampleTable = None
     isQCD = "qcd" in tfileNameTemplate.lower()
     doPrefit = options.preFit
     doPostFit = options.postFit
@@ -483,7 +545,7 @@ def MakeCombinedSampleScaled(sample, dictSamples, dictDatasetsFileNames, tfileNa
 
     # ---Loop over datasets in the inputlist
     for year in yearsToUse:
-        thisYearTable = {}
+        thisYearTable = None
         thisYearHistos = {}
         piecesAdded = []
         yearSampleInfo = dictSamples[year][sample]
@@ -493,7 +555,7 @@ def MakeCombinedSampleScaled(sample, dictSamples, dictDatasetsFileNames, tfileNa
         sameProcess = len(piecesToAdd) == 1
         print("INFO: for sample={}, these are all the same process".format(sample))
         for currentPiece in piecesToAdd:
-            thisPieceTable = {}
+            thisPieceTable = None
             thisPieceHistos = {}
             sumWeights = 0
             lhePdfWeightSumw = 0
@@ -518,11 +580,11 @@ def MakeCombinedSampleScaled(sample, dictSamples, dictDatasetsFileNames, tfileNa
             print("For sample {}, datasetsFileNamesCleaned[{}]={}".format(sample, currentPiece, datasetsFileNamesCleaned[currentPiece]))
             thisPieceTable, thisPieceHistos, sumWeights, lhePdfWeightSumw, Ntot = LoadDataFromRootFile(datasetsFileNamesCleaned, currentPiece, sample, histoNamesToUse, xsectionFound, useInclusionList, doHists,
                                                                  singleFilePiece, intLumi, matchingPiece, corrLHESysts, isMC, isQCD,
-                                                                 xsection_val)
+                                                                 xsection_val, tfileNameTemplate, datFileCache, pool)
 
             # combine this year with the rest of the pieces per year
             print("\t[{}] zeroing negative table yields for currentPiece={} for year={}".format(sample, currentPiece, year), flush=True)
-            combineCommon.ZeroNegativeTableYields(thisPieceTable)
+            thisPieceTable.ZeroNegatives()
             if doHists:
                 print("\t[{}] zeroing negative histo bins for piece={} for year={}".format(sample, currentPiece, year), flush=True)
                 combineCommon.ZeroNegativeHistoBins(thisPieceHistos.values())
@@ -538,21 +600,21 @@ def MakeCombinedSampleScaled(sample, dictSamples, dictDatasetsFileNames, tfileNa
                 )
                 print("\t[{}] weight(x1000): ".format(currentPiece) + str(weight) + " = " + str(xsection_X_intLumi), "/", end=' ', flush=True)
                 print(str(sumWeights), flush=True)
-                thisPieceTable = combineCommon.CreateWeightedTable(thisPieceTable, weight, xsection_X_intLumi)
-                Ntot = float(thisPieceTable[0]["Npass"])
+                thisPieceTable = thisPieceTable.CreateWeighted(weight)
+                Ntot = float(thisPieceTable.npass[0])
             if doHists:
                 # here is where we might have to combine different processes (same year)
                 thisYearHistos = combineCommon.UpdateHistoDict(thisYearHistos, list(thisPieceHistos.values()), matchingPiece, sameProcess, sample, plotWeight, corrLHESysts, not isMC, isQCD, [], symmetrize, d_flatSystematics[GetLookupYear(year)], True)
                 # thisYearHistos = combineCommon.UpdateHistoDict(thisYearHistos, list(thisPieceHistos.values()), matchingPiece, "", plotWeight, corrLHESysts, not isMC, isQCD)
-            thisYearTable = combineCommon.UpdateTable(thisPieceTable, thisYearTable)
+            thisYearTable = combineCommon.UpdateCutTable(thisPieceTable, thisYearTable)
             print("INFO: for sample={}, currentPiece={} NoCuts(weighted)={}".format(sample, currentPiece, Ntot), flush=True)
-            print("INFO: done with currentPiece={}, thisYearTable for sample={} now has NoCuts(weighted)={}".format(currentPiece, sample, float(thisYearTable[0]["Npass"])), flush=True)
+            print("INFO: done with currentPiece={}, thisYearTable for sample={} now has NoCuts(weighted)={}".format(currentPiece, sample, float(thisYearTable.npass[0])), flush=True)
             piecesAdded.append(matchingPiece)
 
         # validation of combining pieces
         Validate(piecesAdded, piecesToAdd, sample)
 
-        sampleTable = combineCommon.UpdateTable(thisYearTable, sampleTable)
+        sampleTable = combineCommon.UpdateCutTable(thisYearTable, sampleTable)
         # sampleTable = combineCommon.UpdateTable(thisPieceTable, sampleTable)
         if doHists:
             if renormThisSample and (options.fitDiagFilepath is not None or options.postfitjson is not None):
@@ -564,8 +626,12 @@ def MakeCombinedSampleScaled(sample, dictSamples, dictDatasetsFileNames, tfileNa
             histoDictThisSample = combineCommon.UpdateHistoDict(histoDictThisSample, list(thisYearHistos.values()), matchingPiece, True, sample, plotWeight, corrLHESysts, not isMC, isQCD, uncorrelatedSysts, symmetrize, [], sameYear)
             # histoDictThisSample = combineCommon.UpdateHistoDict(histoDictThisSample, list(thisYearHistos.values()), matchingPiece, sample, plotWeight, corrLHESysts, not isMC, isQCD)
 
+    if pool is not None:
+        pool.close()
+        pool.join()
+
     # ---Create final tables
-    combinedTableThisSample = combineCommon.CalculateEfficiency(sampleTable)
+    combinedTableThisSample = sampleTable.CalculateEfficiency()
     with open(outputDatFile, "w") as theFile:
         combineCommon.WriteTable(combinedTableThisSample, sample, theFile)
     # for writing tables later
@@ -899,6 +965,32 @@ if __name__ == "__main__":
         metavar="FITTYPE",
     )
 
+    parser.add_option(
+        "--nWorkers",
+        dest="nWorkers",
+        default=1,
+        type="int",
+        help="number of processes used to read the input files of each piece; the files are still summed one by one in their original order, so results are identical to the serial case (default: 1)",
+        metavar="NWORKERS",
+    )
+
+    parser.add_option(
+        "--datCacheDir",
+        dest="datCacheDir",
+        default=None,
+        help="directory holding the cache of parsed .dat tables; unchanged tables are not parsed again (default: no cache)",
+        metavar="DATCACHEDIR",
+    )
+
+    parser.add_option(
+        "--datCacheMaxMB",
+        dest="datCacheMaxMB",
+        default=2048,
+        type="int",
+        help="size limit of the parsed .dat table cache in MB; least recently used entries are evicted first",
+        metavar="DATCACHEMAXMB",
+    )
+
 
     # TODO perhaps make this an option
     inputListFilename = "inputListAllCurrent.txt"
@@ -970,6 +1062,10 @@ if __name__ == "__main__":
     #print("including histos: ",histoNamesToUse)
     
     sample = options.sample
+
+    datFileCache = None
+    if options.datCacheDir is not None:
+        datFileCache = combineCommon.DatFileCache(options.datCacheDir, options.datCacheMaxMB*1024**2)
     
     print("Launched like:")
     print("python ", end=' ')
@@ -1102,7 +1198,9 @@ if __name__ == "__main__":
     #                                                sampleDatFileNameTemplate, samplesToSave, dictFinalHisto, dictFinalTables)
     print("INFO: do MakeCombinedSampleScaled")
     outputFile, outputDatFile = MakeCombinedSampleScaled(sample, dictSamples, dictDatasetsFileNames, sampleTFileNameTemplate,
-                                                         sampleDatFileNameTemplate, samplesToSave, dictFinalHisto, dictFinalTables)
+                                                         sampleDatFileNameTemplate, samplesToSave, dictFinalHisto, dictFinalTables, datFileCache)
+    if datFileCache is not None:
+        print("INFO: dat file cache: {} hits, {} misses".format(datFileCache.hits, datFileCache.misses), flush=True)
     # if options.preFit or options.postFit:
     #     outputFile, outputDatFile = MakeCombinedSampleScaled(sample, dictSamples, dictDatasetsFileNames, sampleTFileNameTemplate,
     #                                                    sampleDatFileNameTemplate, samplesToSave, dictFinalHisto, dictFinalTables)
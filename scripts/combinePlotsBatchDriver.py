@@ -19,9 +19,12 @@ import pprint
 import tempfile
 from termcolor import colored
 from pathlib import Path
+import hashlib
+import json
+import concurrent.futures
 
 import combineCommon
-from combinePlotsBatch import SeparateArgs, FillDictFromOptionByYear
+from combinePlotsBatch import SeparateArgs, FillDictFromOptionByYear, GetDatFilename
 
 
 gROOT.SetBatch(True)
@@ -84,20 +87,219 @@ def RemoveFile(filename):
         result = subprocess.check_call(["eos", "rm", filename], env=my_env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
 
-def CreateAndSubmitJobs(sampleDict):
-    condorSubfileDir = "combinePlotsCondor"
-    Path(condorSubfileDir).mkdir(parents=True, exist_ok=True)
-    shFilename = condorSubfileDir + "/condor.sh"
+def GetFileChecksum(filename, blockSize=2**24):
+    checksum = hashlib.sha1()
+    with open(filename, "rb") as theFile:
+        for block in iter(lambda: theFile.read(blockSize), b""):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def GetFileFingerprint(filename, previousFingerprint=None):
+    # size/mtime/sha1 of a file; the checksum is only recomputed if the size or mtime changed since the previous fingerprint
+    filename = filename.replace("root://eoscms/", "/eos/cms/").replace("root://eosuser/", "/eos/user/")
+    if not os.path.isfile(filename):
+        return None
+    stat = os.stat(filename)
+    fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if previousFingerprint is not None and previousFingerprint["size"] == stat.st_size and previousFingerprint["mtime"] == stat.st_mtime_ns:
+        fingerprint["sha1"] = previousFingerprint["sha1"]
+    else:
+        fingerprint["sha1"] = GetFileChecksum(filename)
+    return fingerprint
+
+
+def GetSampleInputFiles(sample):
+    # root and dat files from the analysis jobs which combinePlotsBatch.py reads for this sample, over all years
+    inputFiles = []
+    for year in SeparateArgs(options.years):
+        if sample not in dictSamples[year].keys():
+            continue
+        datasetsFileNamesCleaned = {combineCommon.SanitizeDatasetNameFromInputList(k): v for k, v in dictDatasetsFileNames[year].items()}
+        for piece in combineCommon.ExpandPieces(dictSamples[year][sample]["pieces"], dictSamples[year]):
+            if piece not in datasetsFileNamesCleaned.keys():
+                raise RuntimeError("ERROR: for sample {}, could not find piece={} in datasetsFileNamesCleaned={}".format(sample, piece, datasetsFileNamesCleaned))
+            for rootFilename in sorted(datasetsFileNamesCleaned[piece]):
+                inputFiles.extend([rootFilename, GetDatFilename(rootFilename)])
+    return inputFiles
+
+
+def GetSampleConfigHash(sample):
+    # everything besides the input files that changes the output for this sample: job arguments, sample definition, and cross sections
+    config = {"args": CreateExecArgs(), "years": {}}
+    for year in SeparateArgs(options.years):
+        if sample not in dictSamples[year].keys():
+            continue
+        sampleInfo = dict(dictSamples[year][sample])
+        sampleInfo["pieces"] = list(sampleInfo["pieces"])
+        xsections = {}
+        for piece in combineCommon.ExpandPieces(sampleInfo["pieces"], dictSamples[year]):
+            try:
+                xsections[piece] = combineCommon.lookupXSection(piece, xsectionDict[year])
+            except RuntimeError:
+                xsections[piece] = None
+        config["years"][year] = {"sample": sampleInfo, "xsections": xsections}
+    if os.path.isfile(options.histInclusionList):
+        config["histInclusionList"] = GetFileChecksum(options.histInclusionList)
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def GetSampleOutputFiles(sample):
+    tfilePrefix = options.outputDir + "/" + options.analysisCode
+    outputFiles = [tfilePrefix + "_{}_tables.dat".format(sample)]
+    if not options.tablesOnly:
+        outputFiles.append(tfilePrefix + "_{}_plots.root".format(sample))
+    return outputFiles
+
+
+def ReadManifest(manifestFilename):
+    if not os.path.isfile(manifestFilename):
+        return {}
+    with open(manifestFilename, "r") as manifestFile:
+        return json.load(manifestFile)
+
+
+def WriteManifest(manifest, manifestFilename):
+    tmpFilename = manifestFilename + ".tmp"
+    with open(tmpFilename, "w") as manifestFile:
+        json.dump(manifest, manifestFile, indent=1, sort_keys=True)
+    os.replace(tmpFilename, manifestFilename)
+
+
+def IsSampleUpToDate(sample, manifestEntry, inputFingerprints, configHash):
+    if manifestEntry is None:
+        return False, "not in manifest"
+    if manifestEntry["configHash"] != configHash:
+        return False, "configuration changed"
+    if manifestEntry["inputs"].keys() != inputFingerprints.keys():
+        return False, "input files added or removed"
+    for inputFile, fingerprint in inputFingerprints.items():
+        if fingerprint is None or fingerprint["sha1"] != manifestEntry["inputs"][inputFile]["sha1"]:
+            return False, "input file {} changed".format(inputFile)
+    # the outputs must have been written by the jobs submitted with this manifest entry
+    for outputFile in GetSampleOutputFiles(sample):
+        if outputFile not in manifestEntry["outputs"] or not os.path.isfile(outputFile) or os.stat(outputFile).st_mtime_ns < manifestEntry["submitTime"]:
+            return False, "output file {} missing or not written since the last submission".format(outputFile)
+    return True, ""
+
+
+def GetSamplesToRebuild(samples, manifest):
+    # samples whose inputs, configuration, or outputs changed, plus the composite samples that depend on them
+    graph = {}
+    for year in SeparateArgs(options.years):
+        for sample, pieces in combineCommon.CreateGraphDict(dictSamples[year]).items():
+            graph.setdefault(sample, set()).update(pieces)
+    samplesToRebuild = set()
+    sampleFingerprints = {}
+    for sample in TopologicalSorter(graph).static_order():
+        if sample not in samples:
+            continue
+        manifestEntry = manifest.get(sample)
+        previousInputs = manifestEntry["inputs"] if manifestEntry is not None else {}
+        inputFingerprints = {inputFile: GetFileFingerprint(inputFile, previousInputs.get(inputFile)) for inputFile in GetSampleInputFiles(sample)}
+        configHash = GetSampleConfigHash(sample)
+        sampleFingerprints[sample] = (inputFingerprints, configHash)
+        upToDate, reason = IsSampleUpToDate(sample, manifestEntry, inputFingerprints, configHash)
+        dirtyPieces = [piece for piece in graph.get(sample, []) if piece in samplesToRebuild]
+        if not upToDate:
+            print("INFO: rebuilding sample {}: {}".format(sample, reason))
+            samplesToRebuild.add(sample)
+        elif len(dirtyPieces):
+            print("INFO: rebuilding sample {}: depends on rebuilt samples {}".format(sample, dirtyPieces))
+            samplesToRebuild.add(sample)
+    return samplesToRebuild, sampleFingerprints
+
+
+def UpdateManifest(manifest, samplesToRebuild, sampleFingerprints):
+    submitTime = time.time_ns()
+    for sample in samplesToRebuild:
+        inputFingerprints, configHash = sampleFingerprints[sample]
+        missingInputs = [inputFile for inputFile, fingerprint in inputFingerprints.items() if fingerprint is None]
+        if len(missingInputs):
+            raise RuntimeError("ERROR: for sample {}, could not stat input files: {}".format(sample, missingInputs))
+        manifest[sample] = {"outputs": GetSampleOutputFiles(sample), "inputs": inputFingerprints, "configHash": configHash, "submitTime": submitTime}
+    return manifest
+
+
+class CondorExecutor:
+    # writes one condor job per sample and submits them all at once; the jobs don't depend on each other's outputs
+    def __init__(self, condorSubfileDir="combinePlotsCondor"):
+        self.condorSubfileDir = condorSubfileDir
+
+    def Run(self, samples, graph):
+        Path(self.condorSubfileDir).mkdir(parents=True, exist_ok=True)
+        shFilename = self.condorSubfileDir + "/condor.sh"
+        WriteCondorShFile(samples, shFilename)
+        print("INFO: wrote sh file to {}".format(shFilename))
+        subFilename = shFilename.replace(".sh", ".sub")
+        WriteCondorSubFile(len(samples), subFilename)
+        print("INFO: wrote sub file to {}".format(subFilename))
+        SubmitCondorJob(str(Path(subFilename).name), self.condorSubfileDir)
+
+
+class LocalExecutor:
+    # runs combinePlotsBatch.py for each sample on this machine, up to nCores at a time
+    # samples are started in the order given by the TopologicalSorter, so composite samples start as soon as their pieces are done
+    def __init__(self, nCores, workingDir="combinePlotsLocal"):
+        self.nCores = nCores
+        self.workingDir = workingDir
+
+    def RunSample(self, sample):
+        sampleDir = self.workingDir + "/" + sample
+        Path(sampleDir).mkdir(parents=True, exist_ok=True)
+        execPath = str(Path(__file__).resolve().parent / "combinePlotsBatch.py")
+        cmd = [sys.executable, execPath, "--sample", sample] + shlex.split(" ".join(CreateExecArgs(localPaths=True)))
+        logFilename = self.workingDir + "/" + sample + ".log"
+        with open(logFilename, "w") as logFile:
+            result = subprocess.run(cmd, cwd=sampleDir, stdout=logFile, stderr=subprocess.STDOUT)
+        return sample, result.returncode, logFilename
+
+    def Run(self, samples, graph):
+        Path(self.workingDir).mkdir(parents=True, exist_ok=True)
+        ts = TopologicalSorter({sample: [piece for piece in graph.get(sample, []) if piece in samples] for sample in samples})
+        if options.dryRun:
+            # static_order() calls prepare() itself
+            for sample in ts.static_order():
+                print("INFO: dry run enabled; not running {}".format(" ".join(["combinePlotsBatch.py", "--sample", sample] + CreateExecArgs(localPaths=True))))
+            return
+        ts.prepare()
+        failedSamples = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.nCores) as pool:
+            futures = set()
+            while ts.is_active():
+                for sample in ts.get_ready():
+                    print("INFO: starting sample {}".format(sample), flush=True)
+                    futures.add(pool.submit(self.RunSample, sample))
+                if not len(futures):
+                    break
+                done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    sample, returnCode, logFilename = future.result()
+                    if returnCode != 0:
+                        print(colored("ERROR: combinePlotsBatch.py for sample {} returned {}; see {}".format(sample, returnCode, logFilename), "red"), flush=True)
+                        failedSamples.append(sample)
+                        # don't start samples depending on this one
+                        continue
+                    print("INFO: finished sample {}".format(sample), flush=True)
+                    ts.done(sample)
+        if len(failedSamples):
+            raise RuntimeError("combinePlotsBatch.py failed for samples: {}".format(failedSamples))
+
+
+def CreateAndSubmitJobs(sampleDict, samplesToRun=None, executor=None):
+    if executor is None:
+        executor = CondorExecutor()
     samplesSet = set()
+    graph = {}
     for year, sampleList in sampleDict.items():
-        samplesToCombine = [sample for sample, keys in sampleList.items()]
+        samplesToCombine = [sample for sample, keys in sampleList.items() if samplesToRun is None or sample in samplesToRun]
         samplesSet.update(samplesToCombine)
-    WriteCondorShFile(samplesSet, shFilename)
-    print("INFO: wrote sh file to {}".format(shFilename))
-    subFilename = shFilename.replace(".sh", ".sub")
-    WriteCondorSubFile(len(samplesSet), subFilename)
-    print("INFO: wrote sub file to {}".format(subFilename))
-    SubmitCondorJob(str(Path(subFilename).name), condorSubfileDir)
+        for sample, pieces in combineCommon.CreateGraphDict(sampleList).items():
+            graph.setdefault(sample, set()).update(pieces)
+    if not len(samplesSet):
+        print("INFO: no samples to combine; not submitting any jobs")
+        return
+    executor.Run(samplesSet, graph)
 
 
 def WriteCondorShFile(sampleList, filename):
@@ -134,20 +336,23 @@ def GetNameRelativeToParent(path):
     return str(Path(path).parent.name) + "/" + str(Path(path).name)
 
 
-def CreateExecArgs():
-   args = ['-i ' + ",".join([GetNameRelativeToParent(inputList) for idx, inputList in enumerate(SeparateArgs(options.inputList))])]
+def CreateExecArgs(localPaths=False):
+   # by default, input files are given relative to the condor job directory they are transferred to; with localPaths, as absolute paths
+   if localPaths:
+       GetInputPath = lambda path: str(Path(path).resolve())
+   args = ['-i ' + ",".join([GetInputPath(inputList) if localPaths else GetNameRelativeToParent(inputList) for idx, inputList in enumerate(SeparateArgs(options.inputList))])]
    args += ['-c ' + options.analysisCode]
    args += ['-d ' + ",".join([str(Path(sampleList).resolve()) for idx, sampleList in enumerate(SeparateArgs(options.inputDir))])]
    args += ['-l ' + options.intLumi]
    args += ['-y ' + options.years]
-   args += ['-x ' + ",".join([GetNameRelativeToSecondParent(xsection) for idx, xsection in enumerate(SeparateArgs(options.xsection))])]
-   args += ['-o ' + options.outputDir]
-   args += ['-s ' + ",".join([str(Path(sampleList).name) for idx, sampleList in enumerate(SeparateArgs(options.sampleListForMerging))])]
+   args += ['-x ' + ",".join([GetInputPath(xsection) if localPaths else GetNameRelativeToSecondParent(xsection) for idx, xsection in enumerate(SeparateArgs(options.xsection))])]
+   args += ['-o ' + (str(Path(options.outputDir).resolve()) if localPaths and not options.outputDir.startswith("/eos") else options.outputDir)]
+   args += ['-s ' + ",".join([GetInputPath(sampleList) if localPaths else str(Path(sampleList).name) for idx, sampleList in enumerate(SeparateArgs(options.sampleListForMerging))])]
    if options.fitDiagFilepath is not None or options.postFitJSON is not None:
        if options.fitDiagFilepath:
-           args += ['--fitDiagFilepath ' + str(Path(options.fitDiagFilepath).name)]
+           args += ['--fitDiagFilepath ' + (GetInputPath(options.fitDiagFilepath) if localPaths else str(Path(options.fitDiagFilepath).name))]
        elif options.postFitJSON:
-           args += ['--postFitJSON ' + str(Path(options.postFitJSON).name)]
+           args += ['--postFitJSON ' + (GetInputPath(options.postFitJSON) if localPaths else str(Path(options.postFitJSON).name))]
        if options.preFit:
            args += ['--preFit']
        elif options.postFit:
@@ -412,6 +617,42 @@ parser.add_option(
     metavar="FITTYPE",
 )
 
+parser.add_option(
+    "--executor",
+    dest="executor",
+    default="condor",
+    type="choice",
+    choices=["condor", "local"],
+    help="how to run the combinePlotsBatch.py jobs: submit them to condor, or run them on this machine in dependency order [default: %default]",
+    metavar="EXECUTOR",
+)
+
+parser.add_option(
+    "--nCores",
+    dest="nCores",
+    default=os.cpu_count(),
+    type="int",
+    help="number of samples to combine at the same time with --executor local [default: %default]",
+    metavar="NCORES",
+)
+
+parser.add_option(
+    "--incremental",
+    dest="incremental",
+    default=False,
+    action="store_true",
+    help="only resubmit samples whose input files or configuration changed since the last submission (and samples which depend on them), using the manifest",
+    metavar="INCREMENTAL",
+)
+
+parser.add_option(
+    "--manifest",
+    dest="manifest",
+    default=None,
+    help="manifest of input files and configuration per sample for --incremental; defaults to OUTDIR/combinePlotsManifest.json",
+    metavar="MANIFEST",
+)
+
 (options, args) = parser.parse_args()
 
 requiredOpts = [options.inputList, options.analysisCode, options.inputDir, options.intLumi, options.xsection, options.outputDir, options.sampleListForMerging, options.years]
@@ -524,8 +765,24 @@ for year in SeparateArgs(options.years):
         print("\bDone.  All root/dat files are present for year {}.".format(year))
 print()
 
-
-CreateAndSubmitJobs(dictSamples)
+samplesToRun = None
+if options.incremental:
+    manifestFilename = options.manifest if options.manifest is not None else options.outputDir + "/combinePlotsManifest.json"
+    manifest = ReadManifest(manifestFilename)
+    allSamples = set()
+    for year in SeparateArgs(options.years):
+        allSamples.update(dictSamples[year].keys())
+    samplesToRun, sampleFingerprints = GetSamplesToRebuild(allSamples, manifest)
+    print("INFO: {} of {} samples need to be rebuilt: {}".format(len(samplesToRun), len(allSamples), sorted(samplesToRun)))
+    if not options.dryRun:
+        WriteManifest(UpdateManifest(manifest, samplesToRun, sampleFingerprints), manifestFilename)
+        print("INFO: wrote manifest to {}".format(manifestFilename))
+
+if options.executor == "local":
+    executor = LocalExecutor(options.nCores)
+else:
+    executor = CondorExecutor()
+CreateAndSubmitJobs(dictSamples, samplesToRun, executor)
 
 # now handle special backgrounds
 # FIXME: will need special handling of these
@@ -1,10 +1,11 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 
 import os
 import sys
 import optparse
-import subprocess
 import re
+import time
+from fileCatalog import FileCatalog, LocalBackend, XRootDBackend
 
 
 # needed for having multiple arguments per option flag
@@ -37,24 +38,10 @@ def sortByNumber(x):
     return [int(y) if y.isdigit() else y for y in l]
 
 
-# NB: now use eos find to find the files in subdirectories, and (therefore) returns full paths
-def make_filenamelist_eos(inputDir):
-    # path = inputDir
+# NB: the files in subdirectories come from the crawl of the FileCatalog, and (therefore) have full paths
+def make_filenamelist_eos(crawledFiles):
     filenamelist = []
-    # proc = subprocess.Popen( '/afs/cern.ch/project/eos/installation/pro/bin/eos.select ls ' + inputDir , shell=True,stdout = subprocess.PIPE, stderr = subprocess.STDOUT )
-    proc = subprocess.Popen(
-        "eos find -f " + inputDir,
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-    )
-    # this gives the full path though
-    output = proc.communicate()[0]
-    if proc.returncode != 0:
-        print("eos find command for dir {} failed with output=".format(inputDir), output)
-        sys.exit(1)
-    output = output.decode(sys.stdout.encoding)
-    for line in output.splitlines():
+    for line in crawledFiles:
         # ignore failed jobs
         if "failed" in line:
             continue
@@ -62,14 +49,7 @@ def make_filenamelist_eos(inputDir):
         # if it's not a root file, forget about it
         if re.search(".root$", filename) is None:
             continue
-        # print('line=', line)
         filenamelist.append(line)
-        # filenamelist.append(filename)
-        ##print 'added:',filenamelist[-1]
-        # dirname=os.path.split(line)[0]
-        # if path != dirname:
-        #  path = dirname
-        #  path+='/'
 
     return filenamelist
 
@@ -89,7 +69,7 @@ def make_filenamelist_default(inputDir):
     return filenamelist
 
 
-def process_input_dir(inputDir, match, filelist, useCERNEOS, eosHost):
+def process_input_dir(inputDir, match, filelist, useCERNEOS, eosHost, crawledFiles, localBackend=False):
     inputDir = inputDir.rstrip("/") + "/"
     prefix = ""
     filenamelist = []
@@ -103,13 +83,15 @@ def process_input_dir(inputDir, match, filelist, useCERNEOS, eosHost):
             prefix = eosHost
         else:
             prefix = "root://cms-xrd-global.cern.ch/"
-        filenamelist = make_filenamelist_eos(inputDir)
+        filenamelist = make_filenamelist_eos(crawledFiles)
     elif re.search("^/store/", inputDir):
         if useCERNEOS:
             prefix = eosHost
         else:
             prefix = "root://cms-xrd-global.cern.ch/"
-        filenamelist = make_filenamelist_eos(inputDir)
+        filenamelist = make_filenamelist_eos(crawledFiles)
+    elif localBackend:
+        filenamelist = make_filenamelist_eos(crawledFiles)
     else:
         # filenamelist = make_filenamelist_default(inputDir)
         print("ERROR: unsupported access protocol")
@@ -319,6 +301,39 @@ def main():
         help="root:// URL of eos host",
         default="root://eoscms.cern.ch/",
     )
+    parser.add_option(
+        "-d",
+        "--catalog",
+        metavar="CATALOG",
+        action="store",
+        help="SQLite catalog of the directories and files seen so far; directories whose mtime did not change are not listed again",
+        default=os.path.expanduser("~/.cache/createInputLists/catalog.sqlite"),
+    )
+    parser.add_option(
+        "-j",
+        "--nThreads",
+        metavar="NTHREADS",
+        action="store",
+        type=int,
+        help="number of directories listed concurrently",
+        default=8,
+    )
+    parser.add_option(
+        "-n",
+        "--countEvents",
+        dest="countEvents",
+        default=False,
+        action="store_true",
+        help="Also record the number of events of new or changed files in the catalog",
+    )
+    parser.add_option(
+        "-l",
+        "--localBackend",
+        dest="localBackend",
+        default=False,
+        action="store_true",
+        help="List directories through the local filesystem (e.g. a FUSE-mounted /eos, or a test directory) instead of xrdfs",
+    )
 
     (options, args) = parser.parse_args(args=None)
 
@@ -339,9 +354,22 @@ def main():
 
     inputDirs = unique(options.inputDirs)
 
+    if options.localBackend:
+        backend = LocalBackend()
+    else:
+        backend = XRootDBackend(options.eosHost)
+    catalog = FileCatalog(options.catalog, backend, options.nThreads)
+    timeStarted = time.time()
+    crawledFilesByDir = catalog.Crawl(inputDirs)
+    print("INFO: crawled {} input dirs in {:.1f} s: listed {} directories, took {} unchanged ones from the catalog {} ({} files in them rewritten)".format(
+        len(inputDirs), time.time()-timeStarted, catalog.nListed, catalog.nCached, options.catalog, catalog.nChangedFiles))
+    if options.countEvents:
+        catalog.CountMissingEvents([filePath for files in crawledFilesByDir.values() for filePath in make_filenamelist_eos(files)])
+    catalog.Close()
+
     for inputDir in inputDirs:
         process_input_dir(
-            inputDir, options.match, filelist, not options.useGLOBALEOS, options.eosHost
+            inputDir, options.match, filelist, not options.useGLOBALEOS, options.eosHost, crawledFilesByDir[inputDir.rstrip("/")], options.localBackend
         )
 
     if options.combineLikeDatasets:
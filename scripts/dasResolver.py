@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+#
+# Resolve datasets to their files and numbers of events, keeping the answers in an on-disk SQLite cache so that
+# regenerating input lists does not query DAS again. Datasets not in the cache (or older than the TTL) are
+# queried concurrently through a backend: dasgoclient, or a local JSON file standing in for DAS in offline tests.
+#
+# Query:  dasResolver.py [-c cache.sqlite] [-t TTL_HOURS] [-r] [-b stand-in.json] /A/B/NANOAODSIM ...
+#
+from optparse import OptionParser
+import collections
+import concurrent.futures
+import json
+import os
+import shlex
+import sqlite3
+import subprocess
+import sys
+import time
+
+
+def GetDefaultCachePath():
+    return os.path.join(os.path.expanduser("~"), ".cache", "dasResolver.sqlite")
+
+
+class DasClientBackend:
+    # dasgoclient; datasets not found in the prod instance are looked up in prod/phys03
+    instances = [None, "prod/phys03"]
+
+    def RunQuery(self, dataset, instance):
+        query = "file dataset={}".format(dataset)
+        if instance is not None:
+            query += " instance={}".format(instance)
+        query += " | grep file.name, file.nevents"
+        cmd = 'dasgoclient --query="{}" --limit=0'.format(query)
+        proc = subprocess.run(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            raise RuntimeError("DAS command '{}' failed with stderr={}".format(cmd, proc.stderr.decode()))
+        fileNameToEventsDict = {}
+        for line in proc.stdout.decode().split("\n"):
+            lineSplit = line.split()
+            if len(lineSplit) < 2:
+                continue
+            fileNameToEventsDict[lineSplit[0]] = int(lineSplit[1])
+        return cmd, fileNameToEventsDict
+
+    def Query(self, dataset):
+        cmds = []
+        for instance in self.instances:
+            cmd, fileNameToEventsDict = self.RunQuery(dataset, instance)
+            if len(fileNameToEventsDict) > 0:
+                return fileNameToEventsDict
+            cmds.append(cmd)
+        raise RuntimeError("Did not find any files for the dataset '{}' by running the commands {}.  Please correct or remove this dataset from the inputlist file.".format(dataset, cmds))
+
+
+class JsonBackend:
+    # stand-in for DAS: a JSON file of {dataset: {fileName: nEvents}}
+    def __init__(self, jsonFileName):
+        with open(jsonFileName, "r") as jsonFile:
+            self.answers = json.load(jsonFile)
+
+    def Query(self, dataset):
+        if dataset not in self.answers or len(self.answers[dataset]) == 0:
+            raise RuntimeError("Did not find any files for the dataset '{}' in the JSON stand-in.".format(dataset))
+        return {fileName: int(nEvents) for fileName, nEvents in self.answers[dataset].items()}
+
+
+class DasResolver:
+    def __init__(self, cachePath=None, backend=None, nThreads=6, ttlHours=None):
+        # ttlHours=None keeps answers until they are invalidated
+        self.backend = backend if backend is not None else DasClientBackend()
+        self.nThreads = nThreads
+        self.ttlHours = ttlHours
+        cachePath = cachePath if cachePath is not None else GetDefaultCachePath()
+        cacheDir = os.path.dirname(os.path.abspath(cachePath))
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        self.db = sqlite3.connect(cachePath)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS datasets (dataset TEXT PRIMARY KEY, timeQueried REAL);
+            CREATE TABLE IF NOT EXISTS files (dataset TEXT, fileName TEXT, nEvents INTEGER, PRIMARY KEY (dataset, fileName));
+        """)
+        self.nQueried = 0
+        self.nCached = 0
+
+    def Close(self):
+        self.db.close()
+
+    def IsCached(self, dataset):
+        row = self.db.execute("SELECT timeQueried FROM datasets WHERE dataset = ?", (dataset,)).fetchone()
+        if row is None:
+            return False
+        return self.ttlHours is None or time.time() - row[0] < 3600*self.ttlHours
+
+    def Invalidate(self, datasets=None):
+        # forget the given datasets, or everything
+        if datasets is None:
+            self.db.executescript("DELETE FROM datasets; DELETE FROM files;")
+        else:
+            self.db.executemany("DELETE FROM datasets WHERE dataset = ?", [(dataset,) for dataset in datasets])
+            self.db.executemany("DELETE FROM files WHERE dataset = ?", [(dataset,) for dataset in datasets])
+        self.db.commit()
+
+    def Store(self, dataset, fileNameToEventsDict):
+        self.db.execute("DELETE FROM files WHERE dataset = ?", (dataset,))
+        self.db.executemany("INSERT INTO files (dataset, fileName, nEvents) VALUES (?, ?, ?)",
+                            [(dataset, fileName, nEvents) for fileName, nEvents in fileNameToEventsDict.items()])
+        self.db.execute("INSERT OR REPLACE INTO datasets (dataset, timeQueried) VALUES (?, ?)", (dataset, time.time()))
+        self.db.commit()
+
+    def GetCached(self, dataset):
+        return collections.OrderedDict(self.db.execute("SELECT fileName, nEvents FROM files WHERE dataset = ? ORDER BY fileName", (dataset,)))
+
+    def Resolve(self, datasets, callback=None):
+        # returns {dataset: OrderedDict(fileName: nEvents) sorted by file name}
+        # callback(dataset) is called as each dataset is resolved, e.g. for a progress bar
+        toQuery = []
+        for dataset in datasets:
+            if self.IsCached(dataset):
+                self.nCached += 1
+                if callback is not None:
+                    callback(dataset)
+            elif dataset not in toQuery:
+                toQuery.append(dataset)
+        if len(toQuery) > 0:
+            # the backend queries run in the worker threads; the cache is only touched from this one
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.nThreads) as pool:
+                futures = {pool.submit(self.backend.Query, dataset): dataset for dataset in toQuery}
+                for future in concurrent.futures.as_completed(futures):
+                    dataset = futures[future]
+                    self.Store(dataset, future.result())
+                    self.nQueried += 1
+                    if callback is not None:
+                        callback(dataset)
+        return collections.OrderedDict((dataset, self.GetCached(dataset)) for dataset in datasets)
+
+
+if __name__ == "__main__":
+    usage = "usage: %prog [options] dataset [dataset ...]"
+    parser = OptionParser(usage=usage)
+    parser.add_option(
+        "-c",
+        "--cache",
+        dest="cache",
+        default=GetDefaultCachePath(),
+        help="SQLite cache of DAS answers; defaults to ~/.cache/dasResolver.sqlite",
+        metavar="CACHE",
+    )
+    parser.add_option(
+        "-t",
+        "--ttl",
+        dest="ttl",
+        type=float,
+        default=None,
+        help="hours after which cached answers are queried again; by default they are kept",
+        metavar="HOURS",
+    )
+    parser.add_option(
+        "-r",
+        "--refresh",
+        dest="refresh",
+        action="store_true",
+        default=False,
+        help="invalidate the cached answers for the given datasets",
+    )
+    parser.add_option(
+        "-b",
+        "--backendJson",
+        dest="backendJson",
+        default=None,
+        help="JSON file of {dataset: {fileName: nEvents}} to use instead of DAS",
+        metavar="JSON",
+    )
+    parser.add_option(
+        "-j",
+        "--nThreads",
+        dest="nThreads",
+        type=int,
+        default=6,
+        help="number of concurrent queries",
+        metavar="NTHREADS",
+    )
+    (options, args) = parser.parse_args()
+    if len(args) < 1:
+        parser.print_help()
+        sys.exit(-1)
+    backend = JsonBackend(options.backendJson) if options.backendJson is not None else DasClientBackend()
+    resolver = DasResolver(options.cache, backend, options.nThreads, options.ttl)
+    if options.refresh:
+        resolver.Invalidate(args)
+    timeStarted = time.time()
+    for dataset, fileNameToEventsDict in resolver.Resolve(args).items():
+        print("{}\t{} files\t{} events".format(dataset, len(fileNameToEventsDict), sum(fileNameToEventsDict.values())))
+    print("INFO: resolved {} datasets in {:.2f} s; queried {}, {} from the cache".format(len(args), time.time()-timeStarted, resolver.nQueried, resolver.nCached))
+    resolver.Close()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+#
+# Sidecar index mapping (run, lumi, event) -> (file, entry) for the files of a dataset.
+# The index is built with one RDataFrame pass over each file (in parallel over files), stored as sorted
+# numpy arrays in an .npz, and queried with binary search.
+#
+# Build:  eventIndex.py -i inputList.txt -x myDataset_eventIndex.npz [-t Events] [-j 8]
+# Query:  eventIndex.py -x myDataset_eventIndex.npz 275658:197:387100603 275658:197:386939841
+#
+from optparse import OptionParser
+import multiprocessing
+import os
+import sys
+import time
+import numpy as np
+import ROOT
+
+keyDtype = np.dtype([("runLs", "<u8"), ("event", "<u8")])
+
+
+def MakeKeys(runs, lumis, events):
+    # run and lumi are 32-bit in NanoAOD, so they share one 64-bit word; the structured array sorts as (run, lumi, event)
+    keys = np.empty(len(events), dtype=keyDtype)
+    keys["runLs"] = (np.asarray(runs, dtype=np.uint64) << np.uint64(32)) | np.asarray(lumis, dtype=np.uint64)
+    keys["event"] = np.asarray(events, dtype=np.uint64)
+    return keys
+
+
+def ParseEvents(events):
+    # accepts "run:lumi:event" strings (as in readNanoAOD.selectedEvents) or (run, lumi, event) tuples
+    runs, lumis, evts = [], [], []
+    for evt in events:
+        if isinstance(evt, str):
+            evt = evt.split(":")
+        if len(evt) != 3:
+            raise RuntimeError("Cannot interpret '{}' as run:lumi:event".format(evt))
+        runs.append(int(evt[0]))
+        lumis.append(int(evt[1]))
+        evts.append(int(evt[2]))
+    return MakeKeys(runs, lumis, evts)
+
+
+def GetLumiBranchName(tfile, treeName):
+    # NanoAOD uses luminosityBlock, the older rootTupleTree ntuples ls
+    tree = tfile.Get(treeName)
+    if not tree:
+        raise RuntimeError("Could not find tree '{}' in file '{}'".format(treeName, tfile.GetName()))
+    return "luminosityBlock" if tree.GetBranch("luminosityBlock") else "ls"
+
+
+def ReadFileKeys(args):
+    # the keys of one file, in entry order
+    fileName, treeName = args
+    tfile = ROOT.TFile.Open(fileName)
+    if not tfile or tfile.IsZombie():
+        raise RuntimeError("Could not open file '{}'".format(fileName))
+    lumiBranch = GetLumiBranchName(tfile, treeName)
+    tfile.Close()
+    df = ROOT.RDataFrame(treeName, fileName)
+    columns = df.AsNumpy(["run", lumiBranch, "event"])
+    return MakeKeys(columns["run"], columns[lumiBranch], columns["event"])
+
+
+class EventIndex:
+    # sorted keys, with the file index and the entry in that file for each key
+    def __init__(self, fileNames, keys, fileIdx, entries):
+        self.fileNames = list(fileNames)
+        self.keys = keys
+        self.fileIdx = fileIdx
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def FromFiles(cls, fileNames, treeName="Events", nCores=1):
+        fileNames = list(fileNames)
+        if nCores > 1 and len(fileNames) > 1:
+            with multiprocessing.Pool(min(nCores, len(fileNames))) as pool:
+                keysByFile = pool.map(ReadFileKeys, [(fileName, treeName) for fileName in fileNames], 1)
+        else:
+            keysByFile = [ReadFileKeys((fileName, treeName)) for fileName in fileNames]
+        keys = np.concatenate(keysByFile) if len(keysByFile) else np.empty(0, dtype=keyDtype)
+        fileIdx = np.concatenate([np.full(len(fileKeys), idx, dtype=np.uint32) for idx, fileKeys in enumerate(keysByFile)]) if len(keysByFile) else np.empty(0, dtype=np.uint32)
+        entries = np.concatenate([np.arange(len(fileKeys), dtype=np.int64) for fileKeys in keysByFile]) if len(keysByFile) else np.empty(0, dtype=np.int64)
+        order = np.argsort(keys, kind="stable")
+        return cls(fileNames, keys[order], fileIdx[order], entries[order])
+
+    @classmethod
+    def Load(cls, indexFileName):
+        with np.load(indexFileName) as index:
+            keys = np.empty(len(index["runLs"]), dtype=keyDtype)
+            keys["runLs"] = index["runLs"]
+            keys["event"] = index["event"]
+            return cls(index["fileNames"].tolist(), keys, index["fileIdx"], index["entries"])
+
+    def Write(self, indexFileName):
+        np.savez(indexFileName, fileNames=np.array(self.fileNames), runLs=self.keys["runLs"], event=self.keys["event"], fileIdx=self.fileIdx, entries=self.entries)
+
+    def IsUpToDate(self, fileNames, indexFileName):
+        # same files in the same order, none of the local ones modified after the index was written; remote files are taken as unchanged
+        if self.fileNames != list(fileNames):
+            return False
+        indexTime = os.path.getmtime(indexFileName)
+        return all(not os.path.isfile(fileName) or os.path.getmtime(fileName) <= indexTime for fileName in fileNames)
+
+    @classmethod
+    def LoadOrBuild(cls, indexFileName, fileNames, treeName="Events", nCores=1):
+        # the index stored in indexFileName if it is up to date for these files, otherwise a new one, which is written there
+        if os.path.isfile(indexFileName):
+            index = cls.Load(indexFileName)
+            if index.IsUpToDate(fileNames, indexFileName):
+                return index
+        index = cls.FromFiles(fileNames, treeName, nCores)
+        index.Write(indexFileName)
+        return index
+
+    def FindIndices(self, events):
+        # positions in the sorted arrays of each requested event, or -1 if it is not in the index
+        queries = ParseEvents(events)
+        positions = np.searchsorted(self.keys, queries)
+        found = positions < len(self.keys)
+        found[found] = self.keys[positions[found]] == queries[found]
+        return np.where(found, positions, -1)
+
+    def Find(self, events):
+        # (fileName, entry) for each requested event, or None if it is not in the index
+        # duplicated events (e.g. the same event in two files) return the first file in the input order
+        return [None if pos < 0 else (self.fileNames[self.fileIdx[pos]], int(self.entries[pos])) for pos in self.FindIndices(events)]
+
+    def FindEntriesByFile(self, events):
+        # {fileName: sorted entries} of the requested events that are in the index, e.g. to loop over them with TTree::GetEntry()
+        positions = self.FindIndices(events)
+        positions = positions[positions >= 0]
+        entriesByFile = {}
+        for idx in np.unique(self.fileIdx[positions]):
+            entriesByFile[self.fileNames[idx]] = np.sort(self.entries[positions][self.fileIdx[positions] == idx])
+        return entriesByFile
+
+
+def GetIndexFileName(inputList):
+    # default sidecar name for the files listed in a dataset's input list
+    return os.path.splitext(inputList)[0] + "_eventIndex.npz"
+
+
+if __name__ == "__main__":
+    usage = "usage: %prog [options] [run:lumi:event ...]"
+    parser = OptionParser(usage=usage)
+    parser.add_option(
+        "-i",
+        "--inputList",
+        dest="inputList",
+        help="build the index for the root files in this input list",
+        metavar="LIST",
+    )
+    parser.add_option(
+        "-x",
+        "--index",
+        dest="index",
+        help="index file; defaults to <inputList>_eventIndex.npz",
+        metavar="INDEX",
+    )
+    parser.add_option(
+        "-t",
+        "--treeName",
+        dest="treeName",
+        default="Events",
+        help="name of the tree in the root files; defaults to Events",
+        metavar="TREE",
+    )
+    parser.add_option(
+        "-j",
+        "--nCores",
+        dest="nCores",
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help="number of files read in parallel when building",
+        metavar="NCORES",
+    )
+    (options, args) = parser.parse_args()
+    if options.inputList is None and options.index is None:
+        print("ERROR: need either an input list to index (-i) or an index to query (-x)")
+        parser.print_help()
+        sys.exit(-1)
+    indexFileName = options.index if options.index is not None else GetIndexFileName(options.inputList)
+
+    if options.inputList is not None:
+        with open(options.inputList) as inputList:
+            fileNames = [line.strip() for line in inputList if line.strip() != "" and not line.startswith("#")]
+        timeStarted = time.time()
+        index = EventIndex.FromFiles(fileNames, options.treeName, options.nCores)
+        index.Write(indexFileName)
+        print("INFO: indexed {} events in {} files in {:.1f} s; wrote {}".format(len(index), len(fileNames), time.time()-timeStarted, indexFileName), flush=True)
+    else:
+        index = EventIndex.Load(indexFileName)
+
+    if len(args):
+        timeStarted = time.time()
+        results = index.Find(args)
+        print("INFO: looked up {} events in {:.2f} ms".format(len(args), 1000*(time.time()-timeStarted)))
+        for evt, result in zip(args, results):
+            print("{}\t{}".format(evt, "not found" if result is None else "{} entry {}".format(*result)))
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+#
+# Crawl directory trees on EOS (via xrdfs) or on a local filesystem concurrently, remembering what was found in
+# an SQLite catalog: per directory its mtime, per file its size, mtime and (optionally) number of events.
+# On later crawls, directories whose mtime did not change are taken from the catalog instead of being listed again;
+# their catalogued files are still checked one by one, since a file rewritten in place leaves the directory mtime alone.
+#
+import concurrent.futures
+import datetime
+import os
+import sqlite3
+import subprocess
+import time
+
+
+class LocalBackend:
+    # plain filesystem; also a stand-in for EOS through a FUSE mount, or for offline tests
+    def __init__(self, urlPrefix=""):
+        self.urlPrefix = urlPrefix
+
+    def GetDirMtime(self, path):
+        return os.stat(path).st_mtime
+
+    def StatFile(self, path):
+        # returns (size, mtime)
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime
+
+    def ListDir(self, path):
+        # returns ([(subdir, mtime)], [(file, size, mtime)])
+        subdirs = []
+        files = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                stat = entry.stat()
+                if entry.is_dir():
+                    subdirs.append((entry.path, stat.st_mtime))
+                else:
+                    files.append((entry.path, stat.st_size, stat.st_mtime))
+        return subdirs, files
+
+
+class XRootDBackend:
+    # EOS (or any XRootD server) through the xrdfs command line client
+    def __init__(self, host):
+        self.host = host.rstrip("/")
+        self.urlPrefix = self.host + "/"
+
+    def RunXrdfs(self, args):
+        proc = subprocess.Popen(["xrdfs", self.host] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        stdout, stderr = proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError("xrdfs {} {} failed with output={}{}".format(self.host, " ".join(args), stdout, stderr))
+        return stdout
+
+    @staticmethod
+    def ParseTime(date, clock):
+        return (datetime.datetime.strptime(date + " " + clock, "%Y-%m-%d %H:%M:%S") - datetime.datetime(1970, 1, 1)).total_seconds()
+
+    def GetDirMtime(self, path):
+        for line in self.RunXrdfs(["stat", path]).splitlines():
+            if line.startswith("MTime:"):
+                date, clock = line.split()[1:3]
+                return self.ParseTime(date, clock)
+        raise RuntimeError("Could not find the MTime of {} in the xrdfs stat output".format(path))
+
+    def StatFile(self, path):
+        # returns (size, mtime)
+        size = mtime = None
+        for line in self.RunXrdfs(["stat", path]).splitlines():
+            if line.startswith("Size:"):
+                size = int(line.split()[1])
+            elif line.startswith("MTime:"):
+                date, clock = line.split()[1:3]
+                mtime = self.ParseTime(date, clock)
+        if size is None or mtime is None:
+            raise RuntimeError("Could not find the Size and MTime of {} in the xrdfs stat output".format(path))
+        return size, mtime
+
+    def ListDir(self, path):
+        # 'xrdfs ls -l' lines look like: dr-x 2023-01-05 12:34:56 4096 /eos/cms/store/...
+        subdirs = []
+        files = []
+        for line in self.RunXrdfs(["ls", "-l", path]).splitlines():
+            fields = line.split(None, 4)
+            if len(fields) < 5:
+                continue
+            flags, date, clock, size, entryPath = fields
+            mtime = self.ParseTime(date, clock)
+            if flags.startswith("d"):
+                subdirs.append((entryPath, mtime))
+            else:
+                files.append((entryPath, int(size), mtime))
+        return subdirs, files
+
+
+def CountEvents(url, treeNames=("Events", "rootTupleTree/tree")):
+    import ROOT
+    tfile = ROOT.TFile.Open(url)
+    if not tfile or tfile.IsZombie():
+        return None
+    try:
+        for treeName in treeNames:
+            tree = tfile.Get(treeName)
+            if tree:
+                return int(tree.GetEntries())
+        return None
+    finally:
+        tfile.Close()
+
+
+class FileCatalog:
+    def __init__(self, catalogPath, backend, nThreads=8):
+        self.backend = backend
+        self.nThreads = nThreads
+        catalogDir = os.path.dirname(os.path.abspath(catalogPath))
+        if not os.path.isdir(catalogDir):
+            os.makedirs(catalogDir)
+        self.db = sqlite3.connect(catalogPath)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime REAL);
+            CREATE INDEX IF NOT EXISTS dirsParent ON dirs (parent);
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dir TEXT, size INTEGER, mtime REAL, nEvents INTEGER);
+            CREATE INDEX IF NOT EXISTS filesDir ON files (dir);
+        """)
+        self.nListed = 0
+        self.nCached = 0
+        self.nChangedFiles = 0
+
+    def Close(self):
+        self.db.close()
+
+    def VisitDir(self, path, cachedMtime, cachedFiles):
+        # runs in the worker threads: only talks to the backend, never to the catalog
+        # returns the listing of a changed directory, or else the catalogued files whose size or mtime changed
+        mtime = self.backend.GetDirMtime(path)
+        if cachedMtime is not None and mtime == cachedMtime:
+            changedFiles = []
+            for filePath, cachedInfo in cachedFiles.items():
+                size, fileMtime = self.backend.StatFile(filePath)
+                if (size, fileMtime) != cachedInfo:
+                    changedFiles.append((filePath, size, fileMtime))
+            return path, mtime, None, changedFiles
+        return path, mtime, self.backend.ListDir(path), None
+
+    def GetCachedMtime(self, path):
+        row = self.db.execute("SELECT mtime FROM dirs WHERE path = ?", (path,)).fetchone()
+        return row[0] if row is not None else None
+
+    def GetCachedFiles(self, path):
+        # {file: (size, mtime)} of the catalogued files in a directory
+        return {row[0]: (row[1], row[2]) for row in self.db.execute("SELECT path, size, mtime FROM files WHERE dir = ?", (path,))}
+
+    def RemoveDirs(self, paths):
+        # drop directories that disappeared, with everything below them
+        for path in paths:
+            self.db.execute("DELETE FROM dirs WHERE path = ? OR path LIKE ?", (path, path.rstrip("/") + "/%"))
+            self.db.execute("DELETE FROM files WHERE dir = ? OR dir LIKE ?", (path, path.rstrip("/") + "/%"))
+
+    def UpdateDir(self, path, parent, mtime, subdirs, files):
+        oldSubdirs = set(row[0] for row in self.db.execute("SELECT path FROM dirs WHERE parent = ?", (path,)))
+        self.RemoveDirs(oldSubdirs - set(subdir for subdir, subdirMtime in subdirs))
+        oldFiles = self.GetCachedFiles(path)
+        newFiles = set(filePath for filePath, size, fileMtime in files)
+        self.db.executemany("DELETE FROM files WHERE path = ?", [(filePath,) for filePath in oldFiles if filePath not in newFiles])
+        # the event count is kept only for files that did not change
+        self.db.executemany(
+                "INSERT OR REPLACE INTO files (path, dir, size, mtime, nEvents) VALUES (?, ?, ?, ?, (SELECT nEvents FROM files WHERE path = ? AND size = ? AND mtime = ?))",
+                [(filePath, path, size, fileMtime, filePath, size, fileMtime) for filePath, size, fileMtime in files if oldFiles.get(filePath) != (size, fileMtime)])
+        self.db.execute("INSERT OR REPLACE INTO dirs (path, parent, mtime) VALUES (?, ?, ?)", (path, parent, mtime))
+
+    def UpdateFiles(self, files):
+        # files rewritten in place: new size and mtime, and the event count has to be redone
+        self.db.executemany("UPDATE files SET size = ?, mtime = ?, nEvents = NULL WHERE path = ?",
+                [(size, fileMtime, filePath) for filePath, size, fileMtime in files])
+
+    def Crawl(self, topDirs):
+        # walks all topDirs at once, one directory level at a time with up to nThreads directories in flight
+        # returns {topDir: [file paths below it]}
+        topDirs = [topDir.rstrip("/") for topDir in topDirs]
+        filesByTopDir = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.nThreads) as pool:
+            frontier = [(topDir, None, topDir) for topDir in topDirs]
+            while len(frontier):
+                futures = {pool.submit(self.VisitDir, path, self.GetCachedMtime(path), self.GetCachedFiles(path)): (path, parent, topDir) for path, parent, topDir in frontier}
+                frontier = []
+                for future in concurrent.futures.as_completed(futures):
+                    path, parent, topDir = futures[future]
+                    path, mtime, listing, changedFiles = future.result()
+                    if listing is None:
+                        self.nCached += 1
+                        self.nChangedFiles += len(changedFiles)
+                        self.UpdateFiles(changedFiles)
+                        subdirs = [row[0] for row in self.db.execute("SELECT path FROM dirs WHERE parent = ?", (path,))]
+                    else:
+                        self.nListed += 1
+                        self.UpdateDir(path, parent, mtime, *listing)
+                        subdirs = [subdir for subdir, subdirMtime in listing[0]]
+                    filesByTopDir.setdefault(topDir, []).extend(row[0] for row in self.db.execute("SELECT path FROM files WHERE dir = ?", (path,)))
+                    frontier.extend((subdir, path, topDir) for subdir in subdirs)
+                self.db.commit()
+        return filesByTopDir
+
+    def CountMissingEvents(self, filePaths):
+        # fills in nEvents for the given files that do not have it yet
+        filePaths = set(filePaths)
+        toCount = [row[0] for row in self.db.execute("SELECT path FROM files WHERE nEvents IS NULL") if row[0] in filePaths]
+        if len(toCount) == 0:
+            return
+        import ROOT
+        ROOT.EnableThreadSafety()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.nThreads) as pool:
+            nEvents = list(pool.map(lambda filePath: CountEvents(self.backend.urlPrefix + filePath), toCount))
+        self.db.executemany("UPDATE files SET nEvents = ? WHERE path = ?", [(n, filePath) for n, filePath in zip(nEvents, toCount) if n is not None])
+        self.db.commit()
+
+    def GetFileInfo(self, filePath):
+        # (size, mtime, nEvents) of a catalogued file
+        return self.db.execute("SELECT size, mtime, nEvents FROM files WHERE path = ?", (filePath,)).fetchone()
+
+
+if __name__ == "__main__":
+    # quick offline check: crawl a local directory twice
+    import sys
+    catalog = FileCatalog(sys.argv[1], LocalBackend())
+    for attempt in range(2):
+        timeStarted = time.time()
+        files = catalog.Crawl(sys.argv[2:])
+        print("crawl {}: {} files in {:.2f} s; listed {} directories, {} from the catalog with {} files rewritten".format(
+            attempt, sum(len(fileList) for fileList in files.values()), time.time()-timeStarted, catalog.nListed, catalog.nCached, catalog.nChangedFiles))
+        catalog.nListed = catalog.nCached = catalog.nChangedFiles = 0
+    catalog.Close()
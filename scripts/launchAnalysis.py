@@ -7,8 +7,11 @@
 import optparse
 import sys
 import os
+import signal
+import subprocess
 import multiprocessing
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 #----------------------------------------------------------------
 # Define functions
@@ -16,7 +19,59 @@ from multiprocessing import Pool
 
 def printAndExecute ( command ): 
     print (command)
-    os.system ( command ) 
+    sys.stdout.flush()
+    return os.system ( command ) 
+
+def initWorker ():
+    # let the parent handle Ctrl-C so that it can record the state and terminate the pool
+    signal.signal ( signal.SIGINT, signal.SIG_IGN )
+
+def runJob ( job ):
+    return job, printAndExecute ( job["command"] )
+
+def getFileSizeInBytes ( file_name ):
+    # same queries as launchAnalysis_batch_ForSkimToEOS.get_n_largest_file_sizes_in_bytes_in_inputlist
+    if file_name.startswith ( "root://eoscms//" ):
+        proc = subprocess.Popen ( ["/usr/bin/eos", "ls", "-l", file_name[15:]], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True )
+        stdout, stderr = proc.communicate()
+        if proc.returncode != 0 or len(stdout.split()) < 5:
+            return None
+        return int ( stdout.split()[-5] )
+    elif os.path.isfile ( file_name ):
+        return int ( os.path.getsize ( file_name ) )
+    return None
+
+def splitInputList ( inputList, maxChunkBytes ):
+    # returns a list of [files, cost] chunks; without a size limit, the cost is the number of files
+    with open ( inputList, "r" ) as sublist_file:
+        files = [ sublist_line.strip() for sublist_line in sublist_file if ".root" in sublist_line and not sublist_line.startswith('#') ]
+    if maxChunkBytes <= 0:
+        return [ [files, len(files)] ]
+    # sorted, so that the chunk -> output mapping is the same when resuming
+    files.sort()
+    # the size queries (eos ls for remote files) mostly wait, so run them in threads
+    size_pool = ThreadPool ( min ( 16, len(files) ) if len(files) > 0 else 1 )
+    try:
+        sizes = size_pool.map ( getFileSizeInBytes, files )
+    finally:
+        size_pool.close()
+    knownSizes = [ size for size in sizes if size is not None ]
+    # files we cannot query (e.g. via xrootd redirectors) are counted with the mean known size
+    meanSize = sum(knownSizes) // len(knownSizes) if len(knownSizes) > 0 else maxChunkBytes
+    chunks = []
+    for file_name, size in zip ( files, sizes ):
+        size = meanSize if size is None else size
+        if len(chunks) == 0 or ( chunks[-1][1] + size > maxChunkBytes and len(chunks[-1][0]) > 0 ):
+            chunks.append ( [[], 0] )
+        chunks[-1][0].append ( file_name )
+        chunks[-1][1] += size
+    return chunks
+
+def readStateFile ( stateFile ):
+    if not os.path.isfile ( stateFile ):
+        return set()
+    with open ( stateFile, "r" ) as theFile:
+        return set ( line.strip() for line in theFile if line.strip() != "" )
 
 #----------------------------------------------------------------
 # Get user options
@@ -30,6 +85,8 @@ parser.add_option ("--cut_file"  , "-c" , dest = "cut_file"  , type=str, help="T
 parser.add_option ("--ncores"    , "-p" , dest = "ncores"    , type=int, help="Number of processor cores to be used to run the job" )
 parser.add_option ("--exe"       , "-e" , dest = "execut"    , type=str, help="name of exec" )
 parser.add_option ("--code_name" , "-k" , dest = "code_name" , type=str, help="code name" )
+parser.add_option ("--split_mb"  , "-s" , dest = "split_mb"  , type=float, default=0, help="Split input lists into jobs of at most this many MB of input files (default: 0, one job per input list)" )
+parser.add_option ("--state_file", "-r" , dest = "state_file", type=str, help="File recording the finished jobs, used to resume an interrupted run (default: <output_dir>/launchAnalysis_state.txt)" )
 
 (options, args) = parser.parse_args()
 
@@ -121,28 +178,84 @@ cut_file.close()
 
 #----------------------------------------------------------------
 # Loop over the input list and get a command for each file
+# Input lists larger than --split_mb are split into several jobs,
+# whose outputs (<code_name>___<dataset>_<n>) are picked up by the combine scripts
 #----------------------------------------------------------------
 
+state_file = options.state_file
+if not state_file:
+    state_file = options.output_dir + "/launchAnalysis_state.txt"
+finished_jobs = readStateFile ( state_file )
+if len(finished_jobs) > 0:
+    print ("Resuming from state file " + state_file + " with " + str(len(finished_jobs)) + " finished jobs")
+
+split_list_dir = options.output_dir + "/inputListChunks"
+max_chunk_bytes = int ( options.split_mb * 1024 * 1024 )
+
 input_list = open ( options.input_list, "r" ) 
-command_list = []
+job_list = []
 
 for line in input_list:
-    if line.startswith('#'):
+    if line.startswith('#') or line.strip() == "":
       continue
     dataset = line.strip().split("/")[-1][:-4]
-    output_file_name = options.output_dir + "/" + options.code_name + "___" + dataset    
-    command = "./" + executable
-    command += " " + line.strip() + " " + options.cut_file + " " + options.tree_name + " " + output_file_name + " " + output_file_name
-    command_list.append ( command ) 
+    chunks = splitInputList ( line.strip(), max_chunk_bytes )
+    for iChunk, (files, cost) in enumerate(chunks):
+        output_file_name = options.output_dir + "/" + options.code_name + "___" + dataset    
+        list_file_name = line.strip()
+        if len(chunks) > 1:
+            output_file_name += "_" + str(iChunk)
+            list_file_name = split_list_dir + "/" + dataset + "_" + str(iChunk) + ".txt"
+        if output_file_name in finished_jobs and os.path.isfile ( output_file_name + ".root" ):
+            continue
+        if len(chunks) > 1:
+            if not os.path.isdir ( split_list_dir ):
+                os.makedirs ( split_list_dir )
+            with open ( list_file_name, "w" ) as list_file:
+                list_file.write ( "\n".join(files) + "\n" )
+        command = "./" + executable
+        command += " " + list_file_name + " " + options.cut_file + " " + options.tree_name + " " + output_file_name + " " + output_file_name
+        job_list.append ( { "command": command, "output": output_file_name, "cost": cost } ) 
+
+input_list.close()
+
+# longest first, so that the big datasets don't end up alone at the tail of the run
+job_list.sort ( key = lambda job: job["cost"], reverse = True )
 
 #----------------------------------------------------------------
-# Execute using all available CPUs.  Quit on Ctrl-C.
+# Execute using all available CPUs.  Idle workers take the next
+# largest job.  Quit on Ctrl-C; rerunning the same command resumes.
 #----------------------------------------------------------------
 
-pool = Pool ( ncores ) 
+failed_jobs = []
+n_jobs = len(job_list)
+print ("Running " + str(n_jobs) + " jobs on " + str(ncores) + " cores")
+sys.stdout.flush()
+pool = Pool ( ncores, initWorker ) 
 try:
-    pool.map_async( printAndExecute, command_list ).get(99999999)
+    results = pool.imap_unordered( runJob, job_list, 1 )
+    with open ( state_file, "a" ) as state:
+        for i_job in range(n_jobs):
+            job, returnCode = results.next(99999999)
+            if returnCode == 0:
+                state.write ( job["output"] + "\n" )
+                state.flush()
+                status = "done"
+            else:
+                failed_jobs.append ( job )
+                status = "FAILED (exit status " + str(returnCode) + ")"
+            print ("[" + str(i_job + 1) + "/" + str(n_jobs) + "] " + status + ": " + job["output"])
+            sys.stdout.flush()
+    pool.close()
+    pool.join()
 except KeyboardInterrupt:
     print ("\n\nCtrl-C detected: Bailing.") 
+    print ("Finished jobs are recorded in " + state_file + "; rerun the same command to resume.")
     pool.terminate()
     sys.exit(1) 
+
+if len(failed_jobs) > 0:
+    print ("ERROR. " + str(len(failed_jobs)) + " jobs failed:")
+    for job in failed_jobs:
+        print ("   " + job["command"])
+    sys.exit(1)
@@ -120,8 +120,44 @@ def handle_error(error):
     print("ERROR: caught exception in job: {}".format(error), flush=True)
 
 
+def WriteEventCounterHist(tfilepath, eventCounterHist, expectedEvents):
+    # add the EventCounter hist to the snapshot; returns False if the file doesn't hold the expected tree and hist
+    tfile = TFile.Open(tfilepath, "update")
+    if not tfile or tfile.IsZombie():
+        print("WARN: couldn't open the file {}".format(tfilepath), flush=True)
+        return False
+    tfile.cd()
+    eventCounterHist.Write()
+    isGood = True
+    if expectedEvents > 0:
+        tree = tfile.Get("rootTupleTree/tree")
+        if not tree or tree == None:
+            print("WARN: didn't get a tree from the file {}".format(tfilepath), flush=True)
+            isGood = False
+        elif tree.ClassName() != "TTree":
+            print("WARN: read tree of class {} instead of TTree from the file {}".format(tree.ClassName(), tfilepath), flush=True)
+            isGood = False
+        elif tree.GetEntries() != expectedEvents:
+            print("WARN: didn't get expected number of events ({} instead of {}) in the file {}".format(tree.GetEntries(), expectedEvents, tfilepath), flush=True)
+            isGood = False
+        # check for hist in written file
+        hist = tfile.Get("EventCounter")
+        if not hist or hist is None or hist.GetEntries() != eventCounterHist.GetEntries():
+            print("WARN: didn't get proper EventCounter hist in the file {}".format(tfilepath), flush=True)
+            isGood = False
+    tfile.Close()
+    return isGood
+
+
 def ProcessDataset(args):
     txtFile, mass, branchesToSave, year, qcdLabel, makeWeightsNegative = args
+    return ProcessDatasetForMasses([txtFile, [mass], branchesToSave, year, qcdLabel, makeWeightsNegative])
+
+
+def ProcessDatasetForMasses(args):
+    # read the dataset once and write the training trees for all the given masses from the same event loop;
+    # only LQCandidateMass differs between them
+    txtFile, masses, branchesToSave, year, qcdLabel, makeWeightsNegative = args
     #print("got args = {}".format(args))
     try:
         tchainBkg = LoadChainFromTxtFile(txtFile)
@@ -129,8 +165,6 @@ def ProcessDataset(args):
             return True
         nEntriesBeforeCut = tchainBkg.GetEntries()
         maxTrials = 5
-        trials = 0
-        redo = True
         df = RDataFrame(tchainBkg)
         df = df.Filter(mycut.GetTitle())  # will work for expressions valid in C++
         df = df.Define("Masym", "Numba::CalcMAsym(M_e1j1, M_e2j2, M_e1j2, M_e2j1)")
@@ -138,97 +172,60 @@ def ProcessDataset(args):
         df = df.Define("MejMin", "Numba::CalcMejMin(M_e1j1, M_e2j2, M_e1j2, M_e2j1)")
         df = df.Define("Meejj", "CalcMeejj(Ele1_Pt, Ele1_Eta, Ele1_Phi, Ele2_Pt, Ele2_Eta, Ele2_Phi,Jet1_Pt, Jet1_Eta, Jet1_Phi, Jet2_Pt, Jet2_Eta, Jet2_Phi)")
         df = df.Define("Meejjj", "CalcMeejjj(Ele1_Pt, Ele1_Eta, Ele1_Phi, Ele2_Pt, Ele2_Eta, Ele2_Phi,Jet1_Pt, Jet1_Eta, Jet1_Phi, Jet2_Pt, Jet2_Eta, Jet2_Phi, Jet3_Pt, Jet3_Eta, Jet3_Phi)")
-        df = df.Define("LQCandidateMassInt", str(mass))
-        df = df.Define("LQCandidateMass", "Numba::GetMassFloat(LQCandidateMassInt)")
         if makeWeightsNegative:
             df = df.Redefine("EventWeight", "-1.0*EventWeight")
         # elif "powhegMiNNLO" in txtFile:
         #     print("INFO: Using sign of Weight for this powhegMiNNLO sample: {}".format(txtFile))
         #     df = df.Redefine("Weight", "float(TMath::Sign(1, Weight))")
-        expectedEvents = df.Count().GetValue()
         datasetName = os.path.basename(txtFile).replace(".txt", "")
         tempDir = tempfile.mkdtemp()
-        if len(qcdLabel):
-            tfilepath = "{}/{}.root".format(tempDir,datasetName)
-            outputOnEos = outputTFileDir+"/{}/{}".format(qcdLabel, mass)
-            #if not os.path.isdir(outputTFileDir+"/{}/{}".format(qcdLabel, mass)):
-             #   os.makedirs(outputTFileDir+"/{}/{}".format(qcdLabel, mass))
-        else:
-            tfilepath = "{}/{}.root".format(tempDir,datasetName)
-            outputOnEos = outputTFileDir+"/{}".format(mass)
-            #if not os.path.isdir(outputTFileDir+"/{}".format(mass)):
-             #   os.mkdir(outputTFileDir+"/{}".format(mass))
-        if "root://" not in outputOnEos:
-            os.makedirs(outputOnEos, exist_ok=True)
-            print("proccess dataset ",datasetName)
-        if signalNameTemplate.format(mass) in tfilepath:
-            eventCounterHist = GetTotalEventsHist(mass, year, allSignalDatasetsDict, signalNameTemplate)
-        else:
-            eventCounterHist = GetTotalEventsHist(mass, year, {datasetName: [txtFile]}, datasetName)
-        eventCounterHistEntries = eventCounterHist.GetEntries()
-        while redo and trials < maxTrials:
-            print("INFO: Writing snapshot to:", tfilepath)
-        #    if "TTToHadronic" in tfilepath:
-        #        print("columns for TTToHadronic sample")
-        #        df.Describe().Print()
-            #if expectedEvents > 0:
-            df.Snapshot("rootTupleTree/tree", tfilepath, branchesToSave)
-            #sleep(3)    
-            #if signalNameTemplate.format(mass) in tfilepath:
-            #    eventCounterHist = GetTotalEventsHist(mass, allSignalDatasetsDict, signalNameTemplate)
-            #    tfile = TFile(tfilepath, "update")
-            #    tfile.cd()
-            #    eventCounterHist.Write()
-            #    tfile.Close()
-            tfile = TFile.Open(tfilepath, "update")
-            tfile.cd()
-            eventCounterHist.Write()
-            tfile.Close()
-         #   else:
-        #    print("INFO: expectedEvents={} for txtFile={}, mass={}. Events before cut={}".format(expectedEvents,txtFile,mass,nEntriesBeforeCut))
-            # check -- sometimes, for some reason, the snapshot or hist writing fails, so this should catch that
-            # expectedEvents = expectedEvents.GetValue()
-            if expectedEvents > 0:
-                tfile = TFile.Open(tfilepath)
-                tree = tfile.Get("rootTupleTree/tree")
-                if not tree or tree == None:
-                    print("WARN: didn't get a tree from the file {}; redoing training tree for txtFile={}, mass={}".format(tfilepath, txtFile, mass), flush=True)
-                elif tree.ClassName() != "TTree":
-                    print("WARN: read tree of class {} instead of TTree; redoing training tree for txtFile={}, mass={}".format(tree.ClassName(), txtFile, mass), flush=True)
-                else:
-                    if tree.GetEntries() != expectedEvents:
-                        print("WARN: didn't get expected number of events; redoing training tree for txtFile={}, mass={}".format(txtFile, mass), flush=True)
-                    else:
-                        redo = False
-                        break
-                # check for hist in written file
-                hist = tfile.Get("EventCounter")
-                if not hist or hist is None or hist.GetEntries() != eventCounterHistEntries:
-                    print("WARN: didn't get proper EventCounter hist; redoing training tree/hist for txtFile={}, mass={}".format(txtFile, mass), flush=True)
-                tfile.Close()
+        snapshotOptions = ROOT.RDF.RSnapshotOptions()
+        snapshotOptions.fLazy = True
+        expectedEvents = df.Count()
+        dfByMass = {}
+        tfilepaths = {}
+        snapshots = []
+        for mass in masses:
+            dfByMass[mass] = df.Define("LQCandidateMassInt", str(mass)).Define("LQCandidateMass", "Numba::GetMassFloat(LQCandidateMassInt)")
+            os.mkdir("{}/{}".format(tempDir, mass))
+            tfilepaths[mass] = "{}/{}/{}.root".format(tempDir, mass, datasetName)
+            print("INFO: Writing snapshot to:", tfilepaths[mass])
+            snapshots.append(dfByMass[mass].Snapshot("rootTupleTree/tree", tfilepaths[mass], branchesToSave, snapshotOptions))
+        # all the snapshots are written in this one event loop
+        expectedEvents = expectedEvents.GetValue()
+        if expectedEvents <= 0:
+            print("INFO: expectedEvents={} for txtFile={}, masses={}. Events before cut={}".format(expectedEvents, txtFile, masses, nEntriesBeforeCut))
+        for mass in masses:
+            if len(qcdLabel):
+                outputOnEos = outputTFileDir+"/{}/{}".format(qcdLabel, mass)
             else:
-                redo = False
-                break
-            trials+=1
-        if redo:
-            #print("ERROR: After {} trials, didn't write the tree properly into the root file; txtFile={}, mass={}".format(maxTrials, txtFile, mass), flush=True)
-            raise RuntimeError("After {} trials, didn't write the tree or hist properly into the root file; txtFile={}, mass={}".format(maxTrials, txtFile, mass))
-        else:
-            #if len(qcdLabel):
-             #   shutil.copy(tfilepath, outputOnEos+"/{}.root".format(datasetName))
-            #else:
+                outputOnEos = outputTFileDir+"/{}".format(mass)
+            if "root://" not in outputOnEos:
+                os.makedirs(outputOnEos, exist_ok=True)
+                print("proccess dataset ",datasetName)
+            tfilepath = tfilepaths[mass]
+            if signalNameTemplate.format(mass) in tfilepath:
+                eventCounterHist = GetTotalEventsHist(mass, year, allSignalDatasetsDict, signalNameTemplate)
+            else:
+                eventCounterHist = GetTotalEventsHist(mass, year, {datasetName: [txtFile]}, datasetName)
+            # check -- sometimes, for some reason, the snapshot or hist writing fails, so this should catch that
+            # the tree entries are checked against the count from the snapshot's own event loop
+            trials = 1
+            while not WriteEventCounterHist(tfilepath, eventCounterHist, expectedEvents):
+                if trials >= maxTrials:
+                    raise RuntimeError("After {} trials, didn't write the tree or hist properly into the root file; txtFile={}, mass={}".format(maxTrials, txtFile, mass))
+                print("WARN: redoing training tree/hist for txtFile={}, mass={}".format(txtFile, mass), flush=True)
+                dfByMass[mass].Snapshot("rootTupleTree/tree", tfilepath, branchesToSave)
+                trials += 1
             shutil.copy(tfilepath, outputOnEos)
             print("copied to ", outputOnEos+"/{}.root".format(datasetName))
-            #clean out /tmp/
-            for f in os.listdir(tempDir):
-                os.remove(tempDir+"/"+f)
-            if os.path.isdir(tempDir):
-                os.rmdir(tempDir)
+        #clean out /tmp/
+        shutil.rmtree(tempDir, ignore_errors=True)
     except Exception as e:
         #print("ERROR: exception in ProcessDataset for txtFile={}, mass={}".format(txtFile, mass), flush=True)
         traceback.print_exc()
         # raise e
-        raise RuntimeError("Caught exception in ProcessDataset for txtFile={}, mass={}".format(txtFile, mass))
+        raise RuntimeError("Caught exception in ProcessDataset for txtFile={}, masses={}".format(txtFile, masses))
     return True
 
 
@@ -487,6 +484,7 @@ parallelize = True
 date = "9oct2023"
 includeQCD = True
 doQCDOnly = False
+fanOutMasses = True  # read each background dataset once and write the trees for all masses in the same pass
 year = sys.argv[1]
 inputListBkgBase = "$LQANA/config/myDatasets/BDT/"+str(year)+"/7feb/trainingTreeInputs/preselOnly"
 inputListQCD1FRBase = "$LQANA/config/myDatasets/BDT/"+str(year)+"/7feb/trainingTreeInputs/singleFR/"
@@ -559,6 +557,8 @@ if __name__ == "__main__":
                         print("ERROR: caught exception in job for LQ mass: {}; exiting".format(mass))
                         traceback.print_exc()
                         exit(-2)
+                if fanOutMasses:
+                    continue
                 for bkgSample in backgroundDatasetsDict.keys():
                     for bkgTxtFile in backgroundDatasetsDict[bkgSample]:
                         try:
@@ -576,6 +576,22 @@ if __name__ == "__main__":
                             traceback.print_exc()
                             exit(-2)
                         # ProcessDataset(bkgTxtFile, mass, branchesToSave)
+        if fanOutMasses:
+            for bkgSample in backgroundDatasetsDict.keys():
+                for bkgTxtFile in backgroundDatasetsDict[bkgSample]:
+                    try:
+                        makeWeightsNegative = True if bkgSample in qcdSamplesToSub else False
+                        qcdLabel = bkgSample if "qcd" in bkgSample.lower() else ""
+                        pool.apply_async(ProcessDatasetForMasses, [[bkgTxtFile, massList, branchesToSave, year, qcdLabel, makeWeightsNegative]], callback=log_result, error_callback=handle_error)
+                        jobCount += 1
+                    except KeyboardInterrupt:
+                        print("\n\nCtrl-C detected: Bailing.")
+                        pool.terminate()
+                        exit(-1)
+                    except Exception as e:
+                        print("ERROR: caught exception in job for dataset: {}; exiting".format(bkgTxtFile))
+                        traceback.print_exc()
+                        exit(-2)
         # now close the pool and wait for jobs to finish
         pool.close()
         #sys.stdout.write(logString.format(jobCount, len(massList)))
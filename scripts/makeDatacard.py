@@ -14,6 +14,7 @@ from decimal import Decimal
 from termcolor import colored
 from bisect import bisect
 from collections import OrderedDict
+from collections.abc import MutableMapping
 import numpy as np
 import ROOT as r
 import matplotlib.pyplot as plt
@@ -26,17 +27,259 @@ from plotSignalEfficiencyTimesAcceptance import plotSignalEfficiencyTimesAccepta
 r.gROOT.SetBatch()
 
 
+class SelectionValues(MutableMapping):
+    # one number per selection, stored in an array with a fixed selection->index map; reads and writes like a dict keyed by selection name
+    def __init__(self, selectionIndex, values):
+        self.selectionIndex = selectionIndex
+        self.values = np.array(values, dtype=np.float64)
+
+    @classmethod
+    def FromDict(cls, valuesDict, selectionIndex=None):
+        if isinstance(valuesDict, SelectionValues):
+            return valuesDict
+        if selectionIndex is None:
+            selectionIndex = {selection: idx for idx, selection in enumerate(valuesDict.keys())}
+        return cls(selectionIndex, [valuesDict[selection] for selection in selectionIndex.keys()])
+
+    def __getitem__(self, selection):
+        return float(self.values[self.selectionIndex[selection]])
+
+    def __setitem__(self, selection, value):
+        self.values[self.selectionIndex[selection]] = value
+
+    def __delitem__(self, selection):
+        raise RuntimeError("Can't remove selection '{}'; the selections of a SampleInfo are fixed.".format(selection))
+
+    def __iter__(self):
+        return iter(self.selectionIndex)
+
+    def __len__(self):
+        return len(self.selectionIndex)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def ValuesInOrder(self, selectionIndex):
+        # the values ordered as in the given selection->index map
+        if selectionIndex is self.selectionIndex or list(selectionIndex) == list(self.selectionIndex):
+            return self.values
+        return self.values[[self.selectionIndex[selection] for selection in selectionIndex.keys()]]
+
+
+class SystematicsTable(MutableMapping):
+    # systematic yields of a sample, one (selection x syst) array per entry field, with fixed selection->index and syst->index maps
+    # reads and writes like the nested dict {syst: {selection: {"yield": ..., "preselYield": ..., ...}, "branchTitles": [...]}}
+    fields = ["yield", "preselYield", "kEff", "deltaQuad"]
+    fieldIndex = {field: idx for idx, field in enumerate(fields)}
+    # state of each (field, selection, syst) entry: not set, set to a number, or set to None
+    notSet = 0
+    isNumber = 1
+    isNone = 2
+
+    def __init__(self, selectionIndex):
+        # indices are given out in insertion order, so the maps also give the order of the array axes
+        self.selectionIndex = {selection: idx for idx, selection in enumerate(selectionIndex)}
+        self.systIndex = {}
+        self.values = np.zeros((len(self.fields), len(self.selectionIndex), 0))
+        self.states = np.zeros(self.values.shape, dtype=np.int8)
+        self.hasSelection = np.zeros(self.values.shape[1:], dtype=bool)
+        self.branchTitles = {}
+
+    @classmethod
+    def FromDict(cls, systDict, selectionIndex):
+        if isinstance(systDict, SystematicsTable):
+            return systDict
+        table = cls(selectionIndex)
+        table.update(systDict)
+        return table
+
+    def AddSelection(self, selection):
+        if selection not in self.selectionIndex:
+            self.selectionIndex[selection] = len(self.selectionIndex)
+            self.values = np.concatenate([self.values, np.zeros((len(self.fields), 1, len(self.systIndex)))], axis=1)
+            self.states = np.concatenate([self.states, np.zeros((len(self.fields), 1, len(self.systIndex)), dtype=np.int8)], axis=1)
+            self.hasSelection = np.concatenate([self.hasSelection, np.zeros((1, len(self.systIndex)), dtype=bool)], axis=0)
+        return self.selectionIndex[selection]
+
+    def ResetSysts(self, systs):
+        # adds the systs which are new, and empties the existing ones; returns their indices
+        newSysts = [syst for syst in dict.fromkeys(systs) if syst not in self.systIndex]
+        if len(newSysts):
+            for syst in newSysts:
+                self.systIndex[syst] = len(self.systIndex)
+            self.values = np.concatenate([self.values, np.zeros((len(self.fields), len(self.selectionIndex), len(newSysts)))], axis=2)
+            self.states = np.concatenate([self.states, np.zeros((len(self.fields), len(self.selectionIndex), len(newSysts)), dtype=np.int8)], axis=2)
+            self.hasSelection = np.concatenate([self.hasSelection, np.zeros((len(self.selectionIndex), len(newSysts)), dtype=bool)], axis=1)
+        systIdxs = np.array([self.systIndex[syst] for syst in systs], dtype=int)
+        self.values[:, :, systIdxs] = 0
+        self.states[:, :, systIdxs] = self.notSet
+        self.hasSelection[:, systIdxs] = False
+        for syst in systs:
+            self.branchTitles.pop(syst, None)
+        return systIdxs
+
+    def SetSystYields(self, systs, yields, preselYields):
+        # sets the given systs for all selections at once from (selection x syst) arrays; NaN preselYields are stored as None
+        systIdxs = self.ResetSysts(systs)
+        yieldIdx = self.fieldIndex["yield"]
+        preselIdx = self.fieldIndex["preselYield"]
+        self.values[yieldIdx][:, systIdxs] = yields
+        self.states[yieldIdx][:, systIdxs] = self.isNumber
+        self.values[preselIdx][:, systIdxs] = np.nan_to_num(preselYields)
+        self.states[preselIdx][:, systIdxs] = np.where(np.isnan(preselYields), self.isNone, self.isNumber)
+        self.hasSelection[:, systIdxs] = True
+
+    def CopySysts(self, other, systs):
+        # copies the given systs of another table into this one, with their branch titles
+        for selection in other.selectionIndex:
+            self.AddSelection(selection)
+        selIdxs = np.array([self.selectionIndex[selection] for selection in other.selectionIndex], dtype=int)
+        otherSystIdxs = np.array([other.systIndex[syst] for syst in systs], dtype=int)
+        otherValues = other.values[:, :, otherSystIdxs]
+        otherStates = other.states[:, :, otherSystIdxs]
+        otherHasSelection = other.hasSelection[:, otherSystIdxs]
+        systIdxs = self.ResetSysts(systs)
+        self.values[:, selIdxs[:, None], systIdxs] = otherValues
+        self.states[:, selIdxs[:, None], systIdxs] = otherStates
+        self.hasSelection[selIdxs[:, None], systIdxs] = otherHasSelection
+        for syst in systs:
+            if syst in other.branchTitles:
+                self.branchTitles[syst] = list(other.branchTitles[syst])
+
+    def SelectionIdxsIn(self, selectionIndex):
+        # this table's index of each selection of the given selection->index map, or -1 where it doesn't have the selection
+        return np.array([self.selectionIndex.get(selection, -1) for selection in selectionIndex], dtype=int)
+
+    def HasEntriesFor(self, selectionIndex, systIdxs):
+        # whether this table has an entry for each of the given selections and systs, as a (selection x syst) array
+        selIdxs = self.SelectionIdxsIn(selectionIndex)
+        found = selIdxs >= 0
+        hasEntries = np.zeros((len(selIdxs), len(systIdxs)), dtype=bool)
+        hasEntries[found] = self.hasSelection[np.ix_(selIdxs[found], systIdxs)]
+        return hasEntries
+
+    def __getitem__(self, syst):
+        if syst not in self.systIndex:
+            raise KeyError(syst)
+        return SystematicsRow(self, syst)
+
+    def __setitem__(self, syst, selectionsDict):
+        if isinstance(selectionsDict, SystematicsRow):
+            self.CopySysts(selectionsDict.table, [selectionsDict.syst])
+            return
+        self.ResetSysts([syst])
+        row = self[syst]
+        for selection, entry in selectionsDict.items():
+            row[selection] = entry
+
+    def __delitem__(self, syst):
+        raise RuntimeError("Can't remove syst '{}'; systs can only be added to a SampleInfo.".format(syst))
+
+    def __iter__(self):
+        return iter(self.systIndex)
+
+    def __len__(self):
+        return len(self.systIndex)
+
+    def __repr__(self):
+        return repr({syst: row for syst, row in self.items()})
+
+
+class SystematicsRow(MutableMapping):
+    # the entries of one syst in a SystematicsTable; reads and writes like a dict keyed by selection name, plus "branchTitles"
+    def __init__(self, table, syst):
+        self.table = table
+        self.syst = syst
+
+    def __getitem__(self, selection):
+        if selection == "branchTitles":
+            return self.table.branchTitles[self.syst]
+        selIdx = self.table.selectionIndex[selection]
+        systIdx = self.table.systIndex[self.syst]
+        if not self.table.hasSelection[selIdx, systIdx]:
+            raise KeyError(selection)
+        return SystematicsEntry(self.table, selIdx, systIdx)
+
+    def __setitem__(self, selection, entry):
+        if selection == "branchTitles":
+            self.table.branchTitles[self.syst] = entry
+            return
+        selIdx = self.table.AddSelection(selection)
+        systIdx = self.table.systIndex[self.syst]
+        self.table.hasSelection[selIdx, systIdx] = True
+        self.table.states[:, selIdx, systIdx] = self.table.notSet
+        newEntry = SystematicsEntry(self.table, selIdx, systIdx)
+        for field, value in entry.items():
+            newEntry[field] = value
+
+    def __delitem__(self, selection):
+        raise RuntimeError("Can't remove selection '{}' of syst '{}'.".format(selection, self.syst))
+
+    def __iter__(self):
+        systIdx = self.table.systIndex[self.syst]
+        if self.syst in self.table.branchTitles:
+            yield "branchTitles"
+        for selection, selIdx in self.table.selectionIndex.items():
+            if self.table.hasSelection[selIdx, systIdx]:
+                yield selection
+
+    def __len__(self):
+        return int(self.table.hasSelection[:, self.table.systIndex[self.syst]].sum()) + (self.syst in self.table.branchTitles)
+
+    def __repr__(self):
+        return repr({selection: entry if selection == "branchTitles" else dict(entry) for selection, entry in self.items()})
+
+
+class SystematicsEntry(MutableMapping):
+    # one (selection, syst) entry of a SystematicsTable; reads and writes like a dict keyed by field name
+    def __init__(self, table, selIdx, systIdx):
+        self.table = table
+        self.selIdx = selIdx
+        self.systIdx = systIdx
+
+    def __getitem__(self, field):
+        fieldIdx = self.table.fieldIndex[field]
+        state = self.table.states[fieldIdx, self.selIdx, self.systIdx]
+        if state == self.table.notSet:
+            raise KeyError(field)
+        if state == self.table.isNone:
+            return None
+        return float(self.table.values[fieldIdx, self.selIdx, self.systIdx])
+
+    def __setitem__(self, field, value):
+        if field not in self.table.fieldIndex:
+            raise RuntimeError("Can't store '{}' in a systematics entry; only {} are stored.".format(field, self.table.fields))
+        fieldIdx = self.table.fieldIndex[field]
+        self.table.states[fieldIdx, self.selIdx, self.systIdx] = self.table.isNone if value is None else self.table.isNumber
+        self.table.values[fieldIdx, self.selIdx, self.systIdx] = 0 if value is None else value
+
+    def __delitem__(self, field):
+        raise RuntimeError("Can't remove '{}' from a systematics entry.".format(field))
+
+    def __iter__(self):
+        for fieldIdx, field in enumerate(self.table.fields):
+            if self.table.states[fieldIdx, self.selIdx, self.systIdx] != self.table.notSet:
+                yield field
+
+    def __len__(self):
+        return int((self.table.states[:, self.selIdx, self.systIdx] != self.table.notSet).sum())
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
 class SampleInfo:
     def __init__(self, name, rates, rateErrs, unscaledRates, totalEvents, failRates, failRateErrs, unscaledFailRates, systematics):
         self.sampleName = name
-        self.rates = rates
-        self.rateErrs = rateErrs
-        self.unscaledRates = unscaledRates
+        self.rates = SelectionValues.FromDict(rates)
+        selectionIndex = self.rates.selectionIndex
+        self.rateErrs = SelectionValues.FromDict(rateErrs, selectionIndex)
+        self.unscaledRates = SelectionValues.FromDict(unscaledRates, selectionIndex)
         self.totalEvents = totalEvents
-        self.failRates = failRates
-        self.failRateErrs = failRateErrs
-        self.unscaledFailRates = unscaledFailRates
-        self.systematics = systematics
+        self.failRates = SelectionValues.FromDict(failRates, selectionIndex)
+        self.failRateErrs = SelectionValues.FromDict(failRateErrs, selectionIndex)
+        self.unscaledFailRates = SelectionValues.FromDict(unscaledFailRates, selectionIndex)
+        self.systematics = SystematicsTable.FromDict(systematics, selectionIndex)
         self.systematicsApplied = set()  # we assume the same systematics for every selection
         # self.systNominals = {}
         # self.systNominalErrs = {}
@@ -53,13 +296,13 @@ class SampleInfo:
     def __iadd__(self, other):
         if self.sampleName != other.sampleName:
             raise RuntimeError("Can't add samples named '{}' and '{}'; this only works for samples of the same name but from different years (since uncorrelated systematics have log-normals combined).".format(self.sampleName, other.sampleName))
-        for selection in self.rates.keys():
-            self.rates[selection] += other.rates[selection]
-            self.rateErrs[selection] = math.sqrt(self.rateErrs[selection]**2 + other.rateErrs[selection]**2)
-            self.unscaledRates[selection] += other.unscaledRates[selection]
-            self.failRates[selection] += other.failRates[selection]
-            self.failRateErrs[selection] = math.sqrt(self.failRateErrs[selection]**2 + other.failRateErrs[selection]**2)
-            self.unscaledFailRates[selection] += other.unscaledFailRates[selection]
+        selectionIndex = self.rates.selectionIndex
+        self.rates.values += other.rates.ValuesInOrder(selectionIndex)
+        self.rateErrs.values = np.sqrt(self.rateErrs.values**2 + other.rateErrs.ValuesInOrder(selectionIndex)**2)
+        self.unscaledRates.values += other.unscaledRates.ValuesInOrder(selectionIndex)
+        self.failRates.values += other.failRates.ValuesInOrder(selectionIndex)
+        self.failRateErrs.values = np.sqrt(self.failRateErrs.values**2 + other.failRateErrs.ValuesInOrder(selectionIndex)**2)
+        self.unscaledFailRates.values += other.unscaledFailRates.ValuesInOrder(selectionIndex)
         self.systematics = self.CheckAndAddSystematics(other)
         for syst in other.systematics.keys():
             self.systematicsApplied.add(syst)
@@ -67,81 +310,113 @@ class SampleInfo:
         return self
 
     def CheckAndAddSystematics(self, other):
-        systDictSelf = self.systematics
-        systDictOther = other.systematics
-        systDictSelfOrig = copy.deepcopy(systDictSelf)
+        systsSelf = self.systematics
+        systsOther = other.systematics
+        yieldIdx = SystematicsTable.fieldIndex["yield"]
+        preselIdx = SystematicsTable.fieldIndex["preselYield"]
+        kEffIdx = SystematicsTable.fieldIndex["kEff"]
+        # only the nominal yields of self from before the addition are needed below
+        nominalYieldsSelfOrig = systsSelf.values[yieldIdx, :, systsSelf.systIndex["nominal"]].copy() if "nominal" in systsSelf else None
         # if sorted(systDictSelf.keys()) != sorted(systDictOther.keys()):
         #     systsSample1 = [x for x in sorted(systDictSelf.keys()) if x not in sorted(systDictOther.keys())]
         #     systsSample2 = [x for x in sorted(systDictOther.keys()) if x not in sorted(systDictSelf.keys())]
         #     raise RuntimeError("systematics dicts for sample={} and sample={} have different systematics: \n'{}'\npresent in sample1 and not in 2 while \n'{}'\npresent in sample2 and not in 1. Cannot add the systematics.".format(
         #         self.sampleName, other.sampleName, systsSample1, systsSample2))
-        for syst in set(systDictSelf.keys()) & set(systDictOther.keys()):
-            for selection in systDictSelf[syst].keys():
-                if selection not in list(systDictOther[syst].keys()):
-                    raise RuntimeError("cannot find selection '{}' in sample={}; systematics dicts for sample={} and sample={} have different selections for syst={}: '{}' vs. '{}'. Cannot add them.".format(
-                        selection, other.sampleName, self.sampleName, other.sampleName, syst, list(systDictSelf[syst].keys()), list(systDictOther[syst].keys())))
-                if "branchTitles" not in selection:
-                    systNameBase = syst.replace("Up", "").replace("Down", "")
-                    if systNameBase in uncorrelatedSysts:
-                        symmetrize = True
-                        verbose = False
-                        if "ptBinned" in self.sampleName and "EER" in syst and selection == "preselection":
-                            verbose = True
-                            print("SICINFO CheckAndAddSystematics(): for sample={}, selection={}, syst={}, systDictSelf[syst][selection]={}".format(self.sampleName, selection, syst, systDictSelf[syst][selection]))
-                        entry, deltaNomUp, deltaNomDown, symmetric, nominal, newSelection = other.CalculateUpDownSystematic(systNameBase, selection, verbose, symmetrize, False)
-                        if "kEff" in systDictSelf[syst][selection].keys():
-                            mu, keffComb = self.CombineLognormals(systDictSelf[syst][selection]["yield"], systDictSelf[syst][selection]["kEff"], nominal, float(entry))
-                        else:
-                            mu, keffComb = self.CombineLognormals(0, 0, nominal, float(entry))
-                        # we are doing this for both up and down variations, which will be the same if we are symmetrizing
-                        systDictSelf[syst][selection]["kEff"] = keffComb
-                        if "ptBinned" in self.sampleName and "EER" in syst and selection == "preselection":
-                            print("SICINFO CheckAndAddSystematics(): DONE for sample={}, selection={}, syst={}, keffComb={}".format(self.sampleName, selection, syst, keffComb))
-                    # if "nominal" in syst.lower() and "selection" in selection.lower():
-                    # if "JES" in syst and ("LQ2700" in selection or "LQ2800" in selection):
-                    #     print("SIC DEBUG: CheckAndAddSystematics() - sample={}, other={}, systDictSelf[{}][{}]={}".format(self.sampleName, other.sampleName, syst, selection, systDictSelf[syst][selection]))
-                    #     print("SIC DEBUG: CheckAndAddSystematics() - sample={}, other={}, systDictOther[{}][{}]={}".format(self.sampleName, other.sampleName, syst, selection, systDictOther[syst][selection]))
-                    systDictSelf[syst][selection]["yield"] += systDictOther[syst][selection]["yield"]
-                    if systDictSelf[syst][selection]["preselYield"] is None and systDictOther[syst][selection]["preselYield"] is not None:
-                        systDictSelf[syst][selection]["preselYield"] = systDictOther[syst][selection]["preselYield"]
-                    elif systDictSelf[syst][selection]["preselYield"] is not None and systDictOther[syst][selection]["preselYield"] is not None:
-                        systDictSelf[syst][selection]["preselYield"] += systDictOther[syst][selection]["preselYield"]
-                        # if "lumicorrelated" in syst.lower() and selection == "preselection":
-                        #     nominal = systDictSelf["nominal"][selection]["yield"]
-                        #     print("SIC DEBUG: CheckAndAddSystematics() - AFTER ADDING - sample={}, other={}, systDictSelf[{}][{}]={}, entry/nominal - 1 (if nominal != 0)".format(self.sampleName, other.sampleName, syst, selection, systDictSelf[syst][selection], systDictSelf[syst][selection]["yield"]/nominal-1 if nominal != 0 else 0))
-                else:
-                    # if the branch titles are different, then we just glom them together here
-                    # again, for composite samples, this might make no sense
-                    if "lhepdf" in syst.lower() and len(systDictOther[syst][selection]) > 1:
-                        raise RuntimeError("Not sure how to handle systDictOther for sampleName={} branchTitles={} which have more than 1 entry".format(other.sampleName, systDictOther[syst][selection]))
-                    elif len(systDictOther[syst][selection]) == 0:
-                        continue
-                    if systDictOther[syst][selection][0] not in systDictSelf[syst][selection]:
-                        systDictSelf[syst][selection].extend(systDictOther[syst][selection])
-                # print("SIC DEBUG: sample={}, systDictSelf[{}][{}]={}".format(self.sampleName, syst, selection, systDictSelf[syst][selection]))
+        commonSysts = [syst for syst in systsSelf.keys() if syst in systsOther]
+        selfSystIdxs = np.array([systsSelf.systIndex[syst] for syst in commonSysts], dtype=int)
+        otherSystIdxs = np.array([systsOther.systIndex[syst] for syst in commonSysts], dtype=int)
+        # index of each selection of self in other, -1 where other doesn't have it
+        otherSelIdxs = systsOther.SelectionIdxsIn(systsSelf.selectionIndex)
+        missing = systsSelf.hasSelection[:, selfSystIdxs] & ~systsOther.HasEntriesFor(systsSelf.selectionIndex, otherSystIdxs)
+        if missing.any():
+            selIdx, commonIdx = np.argwhere(missing)[0]
+            selection = list(systsSelf.selectionIndex)[selIdx]
+            syst = commonSysts[commonIdx]
+            raise RuntimeError("cannot find selection '{}' in sample={}; systematics dicts for sample={} and sample={} have different selections for syst={}: '{}' vs. '{}'. Cannot add them.".format(
+                selection, other.sampleName, self.sampleName, other.sampleName, syst, list(systsSelf[syst].keys()), list(systsOther[syst].keys())))
+        # combine log-normals of uncorrelated systs, for all selections of a syst at once
+        # the up/down effect of other only depends on the syst base name, so it is computed once for both the Up and Down variations
+        upDownEffectsOther = {}
+        for syst, systIdx in zip(commonSysts, selfSystIdxs):
+            systNameBase = syst.replace("Up", "").replace("Down", "")
+            if systNameBase not in uncorrelatedSysts:
+                continue
+            selIdxs = np.nonzero(systsSelf.hasSelection[:, systIdx])[0]
+            selections = [list(systsSelf.selectionIndex)[selIdx] for selIdx in selIdxs]
+            if systNameBase not in upDownEffectsOther:
+                entries = np.zeros(len(selections))
+                nominals = np.zeros(len(selections))
+                for idx, selection in enumerate(selections):
+                    symmetrize = True
+                    verbose = False
+                    if "ptBinned" in self.sampleName and "EER" in systNameBase and selection == "preselection":
+                        verbose = True
+                    entry, deltaNomUp, deltaNomDown, symmetric, nominals[idx], newSelection = other.CalculateUpDownSystematic(systNameBase, selection, verbose, symmetrize, False)
+                    entries[idx] = float(entry)
+                upDownEffectsOther[systNameBase] = (entries, nominals)
+            entries, nominals = upDownEffectsOther[systNameBase]
+            hasKEff = systsSelf.states[kEffIdx, selIdxs, systIdx] == SystematicsTable.isNumber
+            muAcc = np.where(hasKEff, systsSelf.values[yieldIdx, selIdxs, systIdx], 0.0)
+            kAcc = np.where(hasKEff, systsSelf.values[kEffIdx, selIdxs, systIdx], 0.0)
+            mu, keffsComb = self.CombineLognormals(muAcc, kAcc, nominals, entries)
+            # we are doing this for both up and down variations, which will be the same if we are symmetrizing
+            systsSelf.values[kEffIdx, selIdxs, systIdx] = keffsComb
+            systsSelf.states[kEffIdx, selIdxs, systIdx] = SystematicsTable.isNumber
+            if "ptBinned" in self.sampleName and "EER" in syst and "preselection" in selections:
+                print("SICINFO CheckAndAddSystematics(): DONE for sample={}, selection={}, syst={}, keffComb={}".format(self.sampleName, "preselection", syst, systsSelf[syst]["preselection"]["kEff"]))
+        # add the yields of all common systs at once; the preselection yields of other are added where self has one, and taken over where self has None
+        selIdxs, commonIdxs = np.nonzero(systsSelf.hasSelection[:, selfSystIdxs])
+        systIdxs = selfSystIdxs[commonIdxs]
+        otherSelIdxsToAdd = otherSelIdxs[selIdxs]
+        otherSystIdxsToAdd = otherSystIdxs[commonIdxs]
+        systsSelf.values[yieldIdx, selIdxs, systIdxs] += systsOther.values[yieldIdx, otherSelIdxsToAdd, otherSystIdxsToAdd]
+        selfHasPresel = systsSelf.states[preselIdx, selIdxs, systIdxs] == SystematicsTable.isNumber
+        otherHasPresel = systsOther.states[preselIdx, otherSelIdxsToAdd, otherSystIdxsToAdd] == SystematicsTable.isNumber
+        preselYieldsOther = systsOther.values[preselIdx, otherSelIdxsToAdd, otherSystIdxsToAdd]
+        systsSelf.values[preselIdx, selIdxs, systIdxs] = np.where(otherHasPresel, np.where(selfHasPresel, systsSelf.values[preselIdx, selIdxs, systIdxs], 0) + preselYieldsOther,
+                                                                  systsSelf.values[preselIdx, selIdxs, systIdxs])
+        systsSelf.states[preselIdx, selIdxs, systIdxs] = np.where(otherHasPresel, SystematicsTable.isNumber, systsSelf.states[preselIdx, selIdxs, systIdxs])
+        for syst in commonSysts:
+            if syst not in systsSelf.branchTitles:
+                continue
+            # if the branch titles are different, then we just glom them together here
+            # again, for composite samples, this might make no sense
+            branchTitlesOther = systsOther.branchTitles[syst]
+            if "lhepdf" in syst.lower() and len(branchTitlesOther) > 1:
+                raise RuntimeError("Not sure how to handle systDictOther for sampleName={} branchTitles={} which have more than 1 entry".format(other.sampleName, branchTitlesOther))
+            elif len(branchTitlesOther) == 0:
+                continue
+            if branchTitlesOther[0] not in systsSelf.branchTitles[syst]:
+                systsSelf.branchTitles[syst].extend(branchTitlesOther)
         # handle systs only appearing in sample 2
-        systsSample2 = [x for x in sorted(systDictOther.keys()) if x not in systDictSelf.keys()]
-        for syst in systsSample2:
-            systDictSelf[syst] = systDictOther[syst]
+        systsSample2 = [x for x in sorted(systsOther.keys()) if x not in systsSelf]
+        systsSample1 = [x for x in sorted(systsSelf.keys()) if x not in systsOther]
+        if len(systsSample2):
+            systsSelf.CopySysts(systsOther, systsSample2)
             # need to add nominal of self onto this
-            for sel in systDictSelf[syst].keys():
-                if "branchTitles" not in sel:
-                    systDictSelf[syst][sel]["yield"] += systDictSelfOrig["nominal"][sel]["yield"]
+            if nominalYieldsSelfOrig is None or len(nominalYieldsSelfOrig) != len(systsSelf.selectionIndex):
+                raise RuntimeError("Can't add the systs {} of sample={} to sample={}, as the latter has no nominal yields for all their selections".format(systsSample2, other.sampleName, self.sampleName))
+            systIdxs = np.array([systsSelf.systIndex[syst] for syst in systsSample2], dtype=int)
+            systsSelf.values[yieldIdx][:, systIdxs] += np.where(systsSelf.hasSelection[:, systIdxs], nominalYieldsSelfOrig[:, None], 0)
         # handle systs only appearing in sample 1
-        systsSample1 = [x for x in sorted(systDictSelf.keys()) if x not in systDictOther.keys()]
-        for syst in systsSample1:
+        if len(systsSample1):
             # need to add nominal of other onto this
-            for sel in systDictSelf[syst].keys():
-                if "branchTitles" not in sel:
-                    systDictSelf[syst][sel]["yield"] += systDictOther["nominal"][sel]["yield"]
-        return systDictSelf
+            systIdxs = np.array([systsSelf.systIndex[syst] for syst in systsSample1], dtype=int)
+            hasSelection = systsSelf.hasSelection[:, systIdxs]
+            otherNominalIdx = systsOther.systIndex["nominal"]
+            otherHasNominal = systsOther.HasEntriesFor(systsSelf.selectionIndex, [otherNominalIdx])[:, 0]
+            if np.any(hasSelection.any(axis=1) & ~otherHasNominal):
+                raise RuntimeError("Can't add the nominal yields of sample={} to the systs {} of sample={}, as it doesn't have all their selections".format(other.sampleName, systsSample1, self.sampleName))
+            nominalYieldsOther = np.zeros(len(otherSelIdxs))
+            nominalYieldsOther[otherHasNominal] = systsOther.values[yieldIdx, otherSelIdxs[otherHasNominal], otherNominalIdx]
+            systsSelf.values[yieldIdx][:, systIdxs] += np.where(hasSelection, nominalYieldsOther[:, None], 0)
+        return systsSelf
 
     def VarThetaFromK(self, k):
-        if k != 0:
-            sigma = np.log(k)
-            return np.exp(2*sigma**2) - np.exp(sigma**2)
-        else:
-            return 0
+        # works element-wise on arrays of k
+        k = np.asarray(k, dtype=np.float64)
+        sigma = np.log(np.where(k != 0, k, 1.0))
+        return np.where(k != 0, np.exp(2*sigma**2) - np.exp(sigma**2), 0.0)
     
     def ReconstructAccumulator(self, mu_acc, k_acc):
         var_theta = self.VarThetaFromK(k_acc)
@@ -165,10 +440,11 @@ class SampleInfo:
         if verbose:
             print("CombineLognormals - mu_new={}, V_new={}".format(mu_new, V_new))
         # convert back to effective log-normal
-        a = V_new / mu_new**2 if mu_new != 0 else 0
+        mu_new = np.asarray(mu_new, dtype=np.float64)
+        a = np.where(mu_new != 0, V_new / np.where(mu_new != 0, mu_new, 1.0)**2, 0.0)
         y = 0.5 * (1 + np.sqrt(1 + 4*a))
         sigma_new = np.sqrt(np.log(y))
-        k_new = np.exp(sigma_new) if sigma_new != 0 else 1
+        k_new = np.where(sigma_new != 0, np.exp(sigma_new), 1.0)
         if verbose:
             print("CombineLognormals - a={}, y={}, sigma_new={}, k_new={}".format(a, y, sigma_new, k_new))
         return mu_new, k_new
@@ -343,7 +619,7 @@ class SampleInfo:
         try:
             nominal = systDict["nominal"][selection]["yield"]
         except KeyError as e:
-            raise RuntimeError("Could not find key 'nominal' in systDict for sampleName={}; systDict.keys()={}".format(sampleName, systDict.keys()))
+            raise RuntimeError("Could not find key 'nominal' in systDict for sampleName={}; systDict.keys()={}".format(sampleName, list(systDict.keys())))
         except Exception as e:
             raise RuntimeError("Got exception accessing systDict[{}][{}][{}] for sampleName={}; systDict[{}]={}".format("nominal", selection, "yield", sampleName, "nominal", systDict["nominal"]))
         if not DoesSystematicApply(systName, self.sampleName, applicableSystematics):
@@ -582,7 +858,7 @@ class SampleInfo:
                 print("INFO: sample {} hasPreselSystYield for systName={}, selection={}, up={}; systDict[{}]={}".format(self.sampleName, systName, selection, up, systName, systDict[systName]))
             preselSystYield = systDict[systName][selection]["preselYield"]
         elif verbose:
-            print("INFO: sample {} hasPreselSystYield [systName not in systDict keys] for systName={}, selection={}, up={}; systDict.keys={}".format(self.sampleName, systName, selection, up, systName, systDict.keys()))
+            print("INFO: sample {} hasPreselSystYield [systName not in systDict keys] for systName={}, selection={}, up={}; systDict.keys={}".format(self.sampleName, systName, selection, up, systName, list(systDict.keys())))
         if preselSystYield is not None:
             return True, preselSystYield
         else:
@@ -742,54 +1018,51 @@ def GetStatErrorsFromDatacard(dictEntry, nevts):
         raise RuntimeError("Could not GetStatErrorsFromDatacard: didn't understand dictEntry={}".format(dictEntry))
 
 
-# returns dict like systDict[systName][selection] = yield
+# returns a SystematicsTable, reading like systDict[systName][selection]["yield"]
 def GetSystematicsDict(rootFile, sampleName, selections, year, verbose=False):
     systHistName = "histo2D__{}__systematics".format(sampleName)
     systHist = rootFile.Get(systHistName)
-    systDict = {}
-    systDict["branchTitles"] = {}
-    xBinPresel = systHist.GetXaxis().FindFixBin("preselection")
+    # read the hist once; the yields of all (selection, syst) pairs are then taken out of it in one go
+    systYields = np.array(cc.GetHistoContentArray(systHist), dtype=np.float64).reshape(systHist.GetNbinsY()+2, systHist.GetNbinsX()+2)
+    xBinByLabel = {}
+    for xBin in range(1, systHist.GetNbinsX()+1):
+        xBinByLabel.setdefault(systHist.GetXaxis().GetBinLabel(xBin), xBin)
+    ySystNames = [systHist.GetYaxis().GetBinLabel(yBin) for yBin in range(systHist.GetNbinsY()+1)]
+    preselYieldBin = systHist.GetYaxis().FindFixBin("LHEScaleWeight_preselYield")
+    xBins = []
     for selection in selections:
         # expect that selections are either "preselection" or "LQXXXX"
         finalSelection = cc.GetFinalSelection(selection)
-        systDict[selection] = {}
-        xBin = systHist.GetXaxis().FindFixBin(finalSelection)
+        xBin = xBinByLabel.get(finalSelection, -1)
         if xBin < 1:
             raise RuntimeError("Could not find requested selection name '{}' in hist {} in file {}".format(finalSelection, systHistName, rootFile.GetName()))
-        lheScaleYBin = None
-        for yBin in range(1, systHist.GetNbinsY()+1):
-            systName = systHist.GetYaxis().GetBinLabel(yBin)
-            preselYield = None
-            # if "LHEPdfWeight" in systName or "LHEScaleWeight" in systName:
-            #     continue
-            # if "LHEPdf" in systName or "LHEScale" in systName:
-            #     systName = systName.replace("_UpComb", "CombUp").replace("_DownComb", "CombDown")
-            #     if "LHEScale" in systName:
-            #         preselYieldBin = systHist.GetYaxis().FindFixBin("LHEScaleWeight_preselYield")
-            #         preselYield = systHist.GetBinContent(xBin, preselYieldBin)
-                    # print("DEBUG: for systName={}, selection={}, sampleName={}, with xBinPresel={}, preselYieldBin={}; preselYield={}".format(
-                    #     systName, selection, sampleName, xBinPresel, preselYieldBin, preselYield))
-            if "lumi" in systName.lower() or "dynorm" in systName.lower() or "ttbarnorm" in systName.lower():
-                continue # TODO modify lumi (and possibly other flat systs) handling later
-            if "LHEPdf" in systName or "LHEScale" in systName:
-                if "comb" in systName.lower():
-                    systName = systName.replace("_UpComb", "CombUp").replace("_DownComb", "CombDown")
-                if "LHEScale" in systName:
-                    preselYieldBin = systHist.GetYaxis().FindFixBin("LHEScaleWeight_preselYield")
-                    preselYield = systHist.GetBinContent(xBin, preselYieldBin)
-            systDict[selection][systName] = {}
-            systDict[selection][systName]["yield"] = systHist.GetBinContent(xBin, yBin)
-            systDict[selection][systName]["preselYield"] = preselYield
-            # print("DEBUG: ASSIGNED for systName={}, selection={}, preselYield={}".format(systName, selection, preselYield))
-            # if "ZJet" in sampleName and "LQ3000" in selection:
-            #     print("INFO: for sampleName={} and selection={}, xBin={} yBin={} ({}), got content={}".format(sampleName, selection, xBin, yBin, systName, systDict[selection][systName]))
-        # add flat systematics here
-        for systName, effect in d_flatSystematics[year].items():
-            systDict[selection][systName] = {}
-            systDict[selection][systName]["yield"] = (effect+1) * systDict[selection]["nominal"]["yield"]  # effect being deltaX/X = (X'-X)/X = X'/X - 1
-            # print("INFO: flat syst: year={}, systName={}, effect={}, nominal={}, x'={}".format(year, systName, effect, systDict[selection]["nominal"]["yield"], (effect+1) * systDict[selection]["nominal"]["yield"]))
-            systDict[selection][systName]["preselYield"] = None
-            systDict["branchTitles"][systName] = []
+        xBins.append(xBin)
+    # y bin of each syst; for a repeated label, the last bin is used
+    yBinBySyst = {}
+    for yBin in range(1, systHist.GetNbinsY()+1):
+        systName = ySystNames[yBin]
+        # if "LHEPdfWeight" in systName or "LHEScaleWeight" in systName:
+        #     continue
+        if "lumi" in systName.lower() or "dynorm" in systName.lower() or "ttbarnorm" in systName.lower():
+            continue # TODO modify lumi (and possibly other flat systs) handling later
+        if "LHEPdf" in systName or "LHEScale" in systName:
+            if "comb" in systName.lower():
+                systName = systName.replace("_UpComb", "CombUp").replace("_DownComb", "CombDown")
+        yBinBySyst[systName] = yBin
+    systNames = list(yBinBySyst.keys())
+    yBins = list(yBinBySyst.values())
+    systematics = SystematicsTable(selections)
+    hasPreselYield = np.array(["LHEScale" in systName for systName in systNames], dtype=bool)
+    preselYields = np.where(hasPreselYield[None, :], systYields[preselYieldBin, xBins][:, None], np.nan)
+    systematics.SetSystYields(systNames, systYields[np.ix_(yBins, xBins)].T, preselYields)
+    # add flat systematics here
+    nominalYields = systematics.values[SystematicsTable.fieldIndex["yield"], :, systematics.systIndex["nominal"]]
+    flatSystNames = list(d_flatSystematics[year].keys())
+    effects = np.array([d_flatSystematics[year][systName] for systName in flatSystNames], dtype=np.float64)
+    # effect being deltaX/X = (X'-X)/X = X'/X - 1
+    systematics.SetSystYields(flatSystNames, (effects[None, :]+1) * nominalYields[:, None], np.full((len(selections), len(flatSystNames)), np.nan))
+    for systName in flatSystNames:
+        systematics.branchTitles[systName] = []
     # add special entry for branch titles
     tmapName = "tmap__{}__systematicNameToBranchesMap".format(sampleName)
     tmap = rootFile.Get(tmapName)
@@ -804,7 +1077,7 @@ def GetSystematicsDict(rootFile, sampleName, selections, year, verbose=False):
     #         raise RuntimeError("Could not find TMap '{}' in file {}".format(tmapName, rootFile.GetName()))
     for yBin in range(1, systHist.GetNbinsY()+1):
         branchTitleList = []
-        systName = systHist.GetYaxis().GetBinLabel(yBin)
+        systName = ySystNames[yBin]
         # for branch titles, because of how we combine the samples, the TMap is just taken from the first file in the first sample
         #   so it's not necessarily correct for composite samples!
         systNameForLookup = systName
@@ -818,7 +1091,7 @@ def GetSystematicsDict(rootFile, sampleName, selections, year, verbose=False):
                     systNameForLookup = "LHEScaleWeight"
             else:
                 systName = systName.replace("_UpComb", "CombUp").replace("_DownComb", "CombDown")
-                systDict["branchTitles"][systName] = [systName]
+                systematics.branchTitles[systName] = [systName]
                 continue
         mapObject = tmap.FindObject(systNameForLookup)
         if not mapObject:
@@ -833,32 +1106,11 @@ def GetSystematicsDict(rootFile, sampleName, selections, year, verbose=False):
         while branchTitle:
             branchTitleList.append(branchTitle.GetName())
             branchTitle = branchTitleListItr.Next()
-        systDict["branchTitles"][systName] = branchTitleList
-        # print("INFO: sampleName={}, systDict[\"branchTitles\"][{}] = {}".format(sampleName, systName, branchTitleList))
-
-    #if verbose:
-    # print("sampleName={}: systDict['LQ300']={}".format(sampleName, systDict["LQ300"]))
-
-    # print("DEBUG: sampleName={}: systDict.keys()={}".format(sampleName, systDict.keys()))
-    # print("DEBUG: sampleName={}: systDict[systDict.keys()[0]].keys()={}".format(sampleName, systDict[list(systDict.keys())[0]].keys()))
-    # print("DEBUG: sampleName={}: list(systDict[selections[0]].keys())={}".format(sampleName, list(systDict[selections[0]].keys())))
-    # for syst in list(systDict[selections[0]].keys()):
-    #     print("DEBUG: syst={}".format(syst))
-    #     for sel in systDict:
-    #         print("\tDEBUG: syst={}, sel={}, systDict[sel].keys()={}".format(syst, sel, systDict[sel].keys()))
-    #         print("\t\tDEBUG2:  systDict[sel][syst]={}".format(systDict[sel][syst]))
-
-        
-    
-    # reindex by syst name
-    systDict = {syst: {sel: systDict[sel][syst] for sel in systDict} for syst in list(systDict[selections[0]].keys())}
-    # print("sampleName={}: systDict=".format(sampleName), systDict)
-    # if verbose:
-    #     print "sampleName={}: systDict=".format(sampleName)
-    #     for systName, selYieldDicts in systDict.items():
-    #         print "{} : {}".format(systName, selYieldDicts["LQ300"]),
-    #     print
-    return systDict
+        systematics.branchTitles[systName] = branchTitleList
+        # print("INFO: sampleName={}, branchTitles[{}] = {}".format(sampleName, systName, branchTitleList))
+
+    # print("sampleName={}: systematics=".format(sampleName), systematics)
+    return systematics
 
 
 def GetSystYield(deltaOverNom, systNomYield):
@@ -1212,6 +1464,7 @@ def FillDicts(rootFilepath, sampleNames, bkgType, dictSavedSamples, dictSamplesC
         if not scaledRootFile or scaledRootFile.IsZombie():
             raise RuntimeError("Could not open root file: {}".format(scaledRootFile.GetName()))
         unscaledTotalEvts = cc.GetUnscaledTotalEvents(scaledRootFile, sampleName)
+        eventsPassingCuts = cc.EventsPassingCutsArrays(scaledRootFile, sampleName)
         if unscaledTotalEvts < 0:
             print(colored("WARN: for sample {}, found negative sampleUnscaledTotalEvents: {}; set to zero.".format(sampleName, unscaledTotalEvts), "red"))
             unscaledTotalEvts = 0.0
@@ -1228,21 +1481,8 @@ def FillDicts(rootFilepath, sampleNames, bkgType, dictSavedSamples, dictSamplesC
             for i_mass_point, mass_point in enumerate(selectionPoints):
                 selectionName = selectionNames[i_mass_point]
                 # print '------>Call GetRatesAndErrors for sampleName=',bkgSample
-                sampleRate, sampleRateErr, sampleUnscaledRate = cc.GetRatesAndErrors(
-                    scaledRootFile,
-                    sampleName,
-                    selectionName,
-                    isData,
-                    bkgType == "TTData"
-                )
-                sampleFailRate, sampleFailRateErr, sampleFailUnscaledRate = cc.GetFailingRatesAndErrors(
-                    scaledRootFile,
-                    sampleName,
-                    selectionName,
-                    trainingSelectionCutName,
-                    isData,
-                    bkgType == "TTData"
-                )
+                sampleRate, sampleRateErr, sampleUnscaledRate = eventsPassingCuts.GetRatesAndErrors(selectionName)
+                sampleFailRate, sampleFailRateErr, sampleFailUnscaledRate = eventsPassingCuts.GetFailingRatesAndErrors(selectionName, trainingSelectionCutName)
                 # print '------>rate=',rate,'rateErr=',rateErr,'unscaledRate=',unscaledRate
                 # if isQCD:
                 #  print 'for sample:',bkgSample,'got unscaled entries=',unscaledRate
@@ -1614,7 +1854,7 @@ def RecomputeLHESystematics(systName, sampleInfos, doBackground=True):
             # print("RecomputeLHESystematics() - SICDEBUG: sample={}, preselection, hessian pdf keys=".format(sample), pdfKeys)
             # print("RecomputeLHESystematics() - SICDEBUG: sample={}, preselection, hessian pdf yields=".format(sample), pdfYields)
             selection = "preselection"
-            print("SICDEBUG: systematics keys=", sampleInfos[sample].systematics.keys())
+            print("SICDEBUG: systematics keys=", list(sampleInfos[sample].systematics.keys()))
             print("SICDEBUG: BEFORE RecomputeLHESystematics - selection={}, systName={}, yieldUp={}, yieldDown={}".format(selection, systName, sampleInfos[sample].systematics["LHEPdfCombUp"][selection]["yield"],
                                                                                                                  sampleInfos[sample].systematics["LHEPdfCombDown"][selection]["yield"]))
         if "LHEScaleWeight" == systName:
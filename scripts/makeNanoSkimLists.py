@@ -1,59 +1,9 @@
 #/usr/bin/env python3
 
-import subprocess
-import shlex
 import sys
 import os
-import collections
 from optparse import OptionParser
-
-
-def GetFileNamesAndNEvents(dataset):
-    query="\"file dataset={} | grep file.name, file.nevents\"".format(dataset)
-    fullCommand = "dasgoclient --query="+query
-    fullCommand += " --limit=0"
-    rawOut = subprocess.run(shlex.split(fullCommand), check=True, stdout=subprocess.PIPE).stdout
-    out = rawOut.decode(sys.stdout.encoding).split("\n")
-    fileNameToEventsDict = dict()
-    for line in out:
-        if len(line) <= 0:
-            continue
-        lineSplit = line.split()
-        fileNameToEventsDict[lineSplit[0]] = lineSplit[1]
-    if len(fileNameToEventsDict) <= 0:
-        firstCommand = fullCommand
-        # if no files found in 'prod' instance, try phys03 instance
-        query="\"file dataset={} instance=prod/phys03 | grep file.name, file.nevents\"".format(dataset)
-        fullCommand = "dasgoclient --query="+query
-        fullCommand += " --limit=0"
-        rawOut = subprocess.run(shlex.split(fullCommand), check=True, stdout=subprocess.PIPE).stdout
-        out = rawOut.decode(sys.stdout.encoding).split("\n")
-        fileNameToEventsDict = dict()
-        for line in out:
-            if len(line) <= 0:
-                continue
-            lineSplit = line.split()
-            fileNameToEventsDict[lineSplit[0]] = lineSplit[1]
-        if len(fileNameToEventsDict) <= 0:
-            raise RuntimeError("Did not find any files for the dataset '{}' by running the command '{}', nor the command '{}'.  Please correct or remove this dataset from the inputlist file.".format(dataset, firstCommand, fullCommand))
-    fileNameToEventsDict = collections.OrderedDict(sorted(fileNameToEventsDict.items()))
-    # sortedFileNameToSizes = sorted(fileNameToSizeDict.items(), key=lambda kv: int(kv[1]))
-    # sortedFileNameToSizesDict = collections.OrderedDict(sortedFileNameToSizes)
-    # # look at the sorted dict
-    # # i = 0
-    # # for key in sortedFileNameToSizesDict.keys():
-    # #     print(key, sortedFileNameToSizesDict[key])
-    # #     i += 1
-    # #     if i > 5:
-    # #         break
-    # de = collections.deque(sortedFileNameToSizesDict.keys())
-    # fileList = list()
-    # while de:
-    #     fileList.append(de.pop())  # largest
-    #     if de:
-    #       fileList.append(de.popleft())
-    # return fileList
-    return fileNameToEventsDict
+from dasResolver import DasResolver, DasClientBackend, JsonBackend, GetDefaultCachePath
 
 
 def ReadDatasetList(datasetFile):
@@ -106,6 +56,48 @@ parser.add_option(
     action="store",
     help="Specifies the output directory where the .txt list files will be stored. Please use the full path",
 )
+parser.add_option(
+    "-c",
+    "--cache",
+    dest="cache",
+    default=GetDefaultCachePath(),
+    help="SQLite cache of DAS answers, so that regenerating the lists does not query DAS again; defaults to ~/.cache/dasResolver.sqlite",
+    metavar="CACHE",
+)
+parser.add_option(
+    "-t",
+    "--ttl",
+    dest="ttl",
+    type=float,
+    default=None,
+    help="hours after which cached DAS answers are queried again; by default they are kept",
+    metavar="HOURS",
+)
+parser.add_option(
+    "-r",
+    "--refresh",
+    dest="refresh",
+    action="store_true",
+    default=False,
+    help="query DAS again for all datasets in the inputlist",
+)
+parser.add_option(
+    "-b",
+    "--backendJson",
+    dest="backendJson",
+    default=None,
+    help="JSON file of {dataset: {fileName: nEvents}} to use instead of DAS",
+    metavar="JSON",
+)
+parser.add_option(
+    "-j",
+    "--nThreads",
+    dest="nThreads",
+    type=int,
+    default=6,
+    help="number of concurrent DAS queries",
+    metavar="NTHREADS",
+)
 (options, args) = parser.parse_args()
 
 if (
@@ -131,22 +123,34 @@ print(progressString, end=" ")
 print("\b"*(len(progressString)-3), end=" ")
 sys.stdout.flush()
 
+
+def PrintProgress(dataset):
+    print("\b.", end=" ")
+    sys.stdout.flush()
+
+
+backend = JsonBackend(options.backendJson) if options.backendJson is not None else DasClientBackend()
+resolver = DasResolver(options.cache, backend, options.nThreads, options.ttl)
+if options.refresh:
+    resolver.Invalidate(datasetList)
+datasetToFilesDict = resolver.Resolve(datasetList, PrintProgress)
+resolver.Close()
+print("\b] 100%")
+print("INFO: Queried DAS for {} datasets; took {} from the cache".format(resolver.nQueried, resolver.nCached))
+
 with open(outputFileName, "w") as mainInputList:
     for dataset in datasetList:
         # dataset="/DYJetsToLL_LHEFilterPtZ-0To50_MatchEWPDG20_TuneCP5_13TeV-amcatnloFXFX-pythia8/RunIISummer20UL16NanoAODv9-106X_mcRun2_asymptotic_v17-v1/NANOAODSIM"
-        fileNamesToNEventsDict = GetFileNamesAndNEvents(dataset)
+        fileNamesToNEventsDict = datasetToFilesDict[dataset]
         fileName = outputDir+GetTxtFileNameFromDataset(dataset)
         with open(fileName, "w") as outFile:
             nEventsFilename = fileName.replace(".txt", "_nevents.txt")
             with open(nEventsFilename, "w") as eventsFile:
                 for fName, nEvents in fileNamesToNEventsDict.items():
                     outFile.write(prefix+fName+"\n")
-                    eventsFile.write(nEvents+"\n")
+                    eventsFile.write(str(nEvents)+"\n")
         datasetFilename = fileName.replace(".txt", "_dataset.txt")
         with open(datasetFilename, "w") as datasetFile:
             datasetFile.write(dataset)
         mainInputList.write(fileName + "\n")
-        print("\b.", end=" ")
-        sys.stdout.flush()
-print("\b] 100%")
 print("INFO: Wrote {} dataset file lists into {}".format(len(datasetList), outputFileName))
@@ -9,7 +9,7 @@ from pathlib import Path
 from optparse import OptionParser
 import re
 
-from combineCommon import WriteTable
+from combineCommon import WriteTable, SubtractHistosWithLimit, CheckAndFixNegativeBinContents
 
 from ROOT import TFile, gROOT, SetOwnership
 
@@ -123,58 +123,6 @@ def DoHistoSubtraction(singleFRQCDHistos, doubleFRQCDHistos, dyjSingleFRHistos):
     return subHistos
 
 
-def SubtractHistosWithLimit(singleFRHisto, doubleFRHisto, verbose = False):
-    limit = 0.5
-    isProfile = False
-    if singleFRHisto.ClassName() == "TProfile":
-        isProfile = True
-        verbose = True
-    doubleFRHistoNew = copy.deepcopy(doubleFRHisto.Clone())
-    for globalBin in range(0, singleFRHisto.GetNcells()+1):
-        singleBinContent = singleFRHisto.GetBinContent(globalBin)
-        if isProfile:
-            singleBinContent *= singleFRHisto.GetBinEntries(globalBin)
-        # singleBinErrorSqr = pow(singleFRHisto.GetBinError(globalBin), 2)
-        doubleBinContent = doubleFRHisto.GetBinContent(globalBin)
-        if isProfile:
-            doubleBinContent *= doubleFRHisto.GetBinEntries(globalBin)
-        # doubleBinErrorSqr = pow(doubleFRHisto.GetBinError(globalBin), 2)
-        # doubleBinError = doubleFRHisto.GetBinError(globalBin)
-        if abs(doubleBinContent) > limit*abs(singleBinContent):
-            doubleBinContentNew = limit*singleBinContent
-            if isProfile:
-                doubleBinContentNew = singleFRHisto.GetBinContent(globalBin)*singleFRHisto.GetBinEntries(globalBin) * (1 - limit)
-            doubleFRHistoNew.SetBinContent(globalBin, doubleBinContentNew)
-            # doubleFRHistoNew.SetBinError(globalBin, doubleBinError)
-            if verbose:
-                if isProfile:
-                    doubleBinContentNew *= doubleFRHistoNew.GetBinEntries(globalBin)
-                    sBinContent = singleFRHisto.GetBinContent(globalBin)
-                    sBinEntries = singleFRHisto.GetBinEntries(globalBin)
-                    dBinContent = doubleFRHisto.GetBinContent(globalBin)
-                    dBinEntries = doubleFRHisto.GetBinEntries(globalBin)
-                    print("INFO: limited bin {} in histo {} to 50% of singleFR bin content = {}; singleFR orig content={}, entries={}, nominalYield={}; doubleFR orig content={}, entries={}, nominalYield={}".format(
-                        globalBin, singleFRHisto.GetName(), limit*singleBinContent, sBinContent, sBinEntries, sBinContent*sBinEntries, dBinContent, dBinEntries, dBinContent*dBinEntries))
-                print("INFO: for hist {}: limited bin {} from {} to {}".format(doubleFRHistoNew.GetName(), globalBin, doubleBinContent, doubleBinContentNew), flush=True)
-    if not singleFRHisto.Add(doubleFRHistoNew, -1):
-        print("INFO: {} has {} xbins and {} has {} xbins".format(singleFRHisto.GetName(), singleFRHisto.GetNbinsX(), doubleFRHistoNew.GetName(), doubleFRHistoNew.GetNbinsX()))
-        raise RuntimeError("Add failed for histos {} and {}".format(singleFRHisto.GetName(), doubleFRHistoNew.GetName()))
-    if verbose and isProfile:
-        binToUse = 118
-        content = singleFRHisto.GetBinContent(binToUse)
-        entries = singleFRHisto.GetBinEntries(binToUse)
-        print("INFO: singleFR-DYJ-2FR histo bin {} has content {} and entries {} for a nominal yield = {}".format(binToUse, content, entries, content*entries))
-
-
-def CheckAndFixNegativeBinContents(histo, verbose = False):
-    for globalBin in range(0, histo.GetNcells()+1):
-        singleBinContent = histo.GetBinContent(globalBin)
-        if singleBinContent < 0:
-            histo.SetBinContent(globalBin, 0)
-            if verbose:
-                print("INFO: for hist {}: limited bin {} from {} to {}".format(histo.GetName(), globalBin, singleBinContent, histo.GetBinContent(globalBin)), flush=True)
-
-
 def ParseDatFile(datFilename, sampleName):
     data = {}
     column = []
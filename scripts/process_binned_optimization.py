@@ -6,163 +6,88 @@ import numpy
 from ROOT import TFile, TH1F, TF1, TGraph, TCanvas, gROOT, gSystem, RooStats
 from tabulate import tabulate
 
-from combineCommon import ParseXSectionFile, lookupXSection, GetUnscaledTotalEvents
+from combineCommon import ParseXSectionFile, lookupXSection, GetUnscaledTotalEvents, GetHistoContentArray, GetHistoSumw2Array
 
 gROOT.SetBatch(True)
 # gSystem.Load("libRooFit")
 
 
-def parse_txt_file(verbose=False):
+def get_grid_cache_path(txt_path):
+    return os.path.splitext(txt_path)[0] + "_grid.npz"
+
 
-    txt_file = open(txt_file_path, "r")
+def parse_txt_file(verbose=False):
+    global bin_numbers, cut_bin_indices, bin_number_grid
 
     # -----------------------------------------------------------------
-    # Loop over each line in the file, which corresponds to a bin number,
-    # and a collection of cuts
+    # Reuse the parsed grid if it is newer than the txt file
     # -----------------------------------------------------------------
 
-    totLines = sum(1 for line in txt_file)
-    txt_file.seek(0)
-    for idx, line in enumerate(txt_file):
-        if (idx % 1000) == 0 or idx+1 == totLines:
-            print_str = "Reading line number " + str(idx+1) + " out of " + str(totLines)
-            sys.stdout.write("%s\r" % print_str)
-            sys.stdout.flush()
-
-        if idx == 0:
-            cutsSplit = line.split()
-            cut_info_template = [" ".join(cutsSplit[i:i+2])+" {}" for i in range(0, len(cutsSplit), 2)]
-            n_cuts = len(cut_info_template)
-            continue
-
-        # -----------------------------------------------------------------
-        # First, get the important data from the line
-        # -----------------------------------------------------------------
-        splitLine = line.split()
-
-        bin_number = int(splitLine[0])
-
-        # cut_string = line.split("Bin = " + str(bin_number))[1].strip()
-        # cut_info = cut_string.split()
-        # n_cuts = len(cut_info) / 3  # var, condition, value
-        cutVals = splitLine[1:]
-        cut_string = "\t".join(cut_info_template).format(*cutVals)
-        cut_info = cut_string.split()
-
-        if verbose:
-            print
-            print "n_cuts=", n_cuts
-            print "cutVals=", cutVals
-            print "cut_string=", cut_string
-            print "cut_info=", cut_info
-            print "bin_number=", bin_number
-
-        # -----------------------------------------------------------------
-        # Store the bin number in a list
-        # -----------------------------------------------------------------
-
-        bin_numbers.append(bin_number)
-
-        # -----------------------------------------------------------------
-        # Initialize the dictionaries that use bin number as their first key
-        # -----------------------------------------------------------------
-
-        if bin_number not in d_binNumber_cutVariable_cutValue.keys():
-            d_binNumber_cutVariable_cutValue[bin_number] = {}
-
-        d_binNumber_cutValuesString[bin_number] = cut_string
-        d_cutValuesString_binNumber[cut_string] = bin_number
-
-        # -----------------------------------------------------------------
-        # Loop over the cuts in the line
-        # -----------------------------------------------------------------
-
-        for icut in range(0, n_cuts):
-
-            # -----------------------------------------------------------------
-            # Get the information from the string
-            # -----------------------------------------------------------------
-
-            this_cut_info = cut_info[icut * 3: icut * 3 + 3]
-
-            this_cut_variable = this_cut_info[0]
-            this_cut_requirement = this_cut_info[1]
-            this_cut_value = float(this_cut_info[2])
-
-            # -----------------------------------------------------------------
-            # Store the cut variables
-            # -----------------------------------------------------------------
-
-            if this_cut_variable not in cut_variables:
-                cut_variables.append(this_cut_variable)
-                cut_requirements.append(this_cut_requirement)
-
-            # -----------------------------------------------------------------
-            # Fill the cut variable -> cut values dictionary
-            # -----------------------------------------------------------------
-
-            if this_cut_variable not in d_cutVariable_cutValues.keys():
-                d_cutVariable_cutValues[this_cut_variable] = []
-            if this_cut_value not in d_cutVariable_cutValues[this_cut_variable]:
-                d_cutVariable_cutValues[this_cut_variable].append(this_cut_value)
-
-            continue
-
-            # -----------------------------------------------------------------
-            # Fill the bin number, cut variable -> cut value dictionary
-            # -----------------------------------------------------------------
-
-            if (
-                this_cut_variable
-                not in d_binNumber_cutVariable_cutValue[bin_number].keys()
-            ):
-                d_binNumber_cutVariable_cutValue[bin_number][
-                    this_cut_variable
-                ] = this_cut_value
-            else:
-                print "ERROR: This should never happen!"
-                txt_file.close()
-                sys.exit()
-
-    txt_file.close()
-    return
+    cache_path = get_grid_cache_path(txt_file_path)
+    if os.path.isfile(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(txt_file_path):
+        print "Loading parsed grid from", cache_path
+        cache = numpy.load(cache_path)
+        cut_variables.extend([str(var) for var in cache["cut_variables"]])
+        cut_requirements.extend([str(req) for req in cache["cut_requirements"]])
+        for icut, cut_variable in enumerate(cut_variables):
+            d_cutVariable_cutValues[cut_variable] = list(cache["cut_values_" + str(icut)])
+        bin_numbers = cache["bin_numbers"]
+        cut_bin_indices = cache["cut_bin_indices"]
+        bin_number_grid = cache["bin_number_grid"]
+        return
 
     # -----------------------------------------------------------------
-    # Fill the bin number, cut variable -> cut bin dictionary
+    # The first line has the cut variables and requirements,
+    # then each line corresponds to a bin number and a collection of cut values
     # -----------------------------------------------------------------
 
-    d_binNumber_cutVariable_cutBin = {}
-    d_cutVariable_cutBin_binNumber = {}
-
-    for bin_number in bin_numbers:
-        for cut_variable in cut_variables:
-
-            cut_value = d_binNumber_cutVariable_cutValue[bin_number][cut_variable]
-            cut_bin = d_cutVariable_cutValues[cut_variable].index(cut_value)
+    with open(txt_file_path, "r") as txt_file:
+        cutsSplit = txt_file.readline().split()
+    for i in range(0, len(cutsSplit), 2):
+        cut_variables.append(cutsSplit[i])
+        cut_requirements.append(cutsSplit[i + 1])
+    n_cuts = len(cut_variables)
 
-            if cut_variable not in d_cutVariable_cutBin_binNumber.keys():
-                d_cutVariable_cutBin_binNumber[cut_variable] = {}
+    table = numpy.loadtxt(txt_file_path, skiprows=1, ndmin=2)
+    bin_numbers = table[:, 0].astype(int)
+    cut_bin_indices = numpy.empty((len(bin_numbers), n_cuts), dtype=int)
 
-            if bin_number not in d_binNumber_cutVariable_cutBin.keys():
-                d_binNumber_cutVariable_cutBin[bin_number] = {}
+    # -----------------------------------------------------------------
+    # Cut values of each variable, in the order they first appear,
+    # and the index of each bin's value in that list
+    # -----------------------------------------------------------------
 
-            if cut_variable not in d_binNumber_cutVariable_cutBin[bin_number].keys():
-                d_binNumber_cutVariable_cutBin[bin_number][cut_variable] = cut_bin
-            else:
-                print "ERROR: This should never happen!"
-                sys.exit()
+    for icut, cut_variable in enumerate(cut_variables):
+        unique_values, first_index, inverse = numpy.unique(table[:, icut + 1], return_index=True, return_inverse=True)
+        order = numpy.argsort(first_index)
+        rank = numpy.empty_like(order)
+        rank[order] = numpy.arange(len(order))
+        d_cutVariable_cutValues[cut_variable] = list(unique_values[order])
+        cut_bin_indices[:, icut] = rank[inverse]
+        if verbose:
+            print cut_variable, cut_requirements[icut], "values:", d_cutVariable_cutValues[cut_variable]
 
-            if cut_bin not in d_cutVariable_cutBin_binNumber[cut_variable].keys():
-                d_cutVariable_cutBin_binNumber[cut_variable][cut_bin] = bin_number
+    # -----------------------------------------------------------------
+    # N-dimensional grid of cut indices -> bin number (-1 if not in the txt file)
+    # -----------------------------------------------------------------
 
+    bin_number_grid = numpy.full([len(d_cutVariable_cutValues[var]) for var in cut_variables], -1, dtype=int)
+    bin_number_grid[tuple(cut_bin_indices.T)] = bin_numbers
+
+    numpy.savez(
+        cache_path,
+        cut_variables=numpy.array(cut_variables),
+        cut_requirements=numpy.array(cut_requirements),
+        bin_numbers=bin_numbers,
+        cut_bin_indices=cut_bin_indices,
+        bin_number_grid=bin_number_grid,
+        **{"cut_values_" + str(icut): numpy.array(d_cutVariable_cutValues[var]) for icut, var in enumerate(cut_variables)}
+    )
+    print "Saved parsed grid to", cache_path
     return
 
 
 def parse_root_file(d_input, verbose=False):
-    d_binNumber_nSample = {}
-    d_binNumber_nSampleErr = {}
-    d_binNumber_nEnts = {}
-
     sum_hist = TH1F()
     sum_hist.Sumw2()
     sum_ents_hist = TH1F()
@@ -220,14 +145,15 @@ def parse_root_file(d_input, verbose=False):
     # print 'sum_hist bin 0:',sum_hist.GetBinContent(0)
     # print 'sum_hist bin 1:',sum_hist.GetBinContent(1)
 
-    for ibin in range(0, nbins):
-        d_binNumber_nSample[ibin] = sum_hist.GetBinContent(ibin + 1)
-        d_binNumber_nSampleErr[ibin] = sum_hist.GetBinError(ibin + 1)
-        d_binNumber_nEnts[ibin] = sum_ents_hist.GetBinContent(ibin + 1)
-        # if ibin==5836:
-        #    print 'sum_ents_hist has',sum_ents_hist.GetBinContent(5836),'entries in bin',ibin
+    # arrays indexed by bin number, i.e., hist bin - 1
+    nSample = GetHistoContentArray(sum_hist)[1:nbins + 1].astype(float)
+    nSampleErr = numpy.sqrt(GetHistoSumw2Array(sum_hist)[1:nbins + 1])
+    if sum_ents_hist.GetNbinsX() == nbins:
+        nEnts = GetHistoContentArray(sum_ents_hist)[1:nbins + 1].astype(float)
+    else:
+        nEnts = numpy.zeros(nbins)
 
-    return d_binNumber_nSample, d_binNumber_nSampleErr, d_binNumber_nEnts
+    return nSample, nSampleErr, nEnts
 
 
 def calculateEfficiency(nS, signal_sample, d_signal_totalEvents):
@@ -276,19 +202,47 @@ def evaluation(nS, nB, efficiency, bkgEnts):
     return value
 
 
+def evaluation_arrays(nS, nB, efficiency, bkgEnts):
+    # evaluation() over whole arrays; entries where evaluation() would hit a zero division or domain error are -999
+    if figureOfMerit == "zbi":
+        return numpy.array([evaluation(*vals) for vals in zip(nS, nB, efficiency, bkgEnts)])
+    with numpy.errstate(all="ignore"):
+        tau = bkgEnts / nB
+        zeroDivision = nB == 0
+        if figureOfMerit == "asymptotic":
+            value = numpy.sqrt(2 * ((nS + nB) * numpy.log(1 + nS / nB) - nS))
+        elif figureOfMerit == "punzi":
+            a = 2.0  # nSigmasExclusion
+            b = 5.0  # nSigmasDiscovery
+            smin = a**2/8.0 + 9*b**2/13.0 + a*numpy.sqrt(nB) + (b/2)*numpy.sqrt(b**2 + 4*a*numpy.sqrt(nB) + 4*nB)
+            value = efficiency / smin
+        elif figureOfMerit == "zpl":  # [1], eqn. 25
+            nOff = bkgEnts
+            nOn = nS + nB
+            nTot = nOff + nOn
+            zeroDivision |= (nTot == 0) | (tau == 0)
+            value = numpy.sqrt(2)*numpy.sqrt(nOn*numpy.log(nOn*(1+tau)/nTot) + nOff*numpy.log(nOff*(1+tau)/(nTot*tau)))
+        else:
+            raise RuntimeError("Evaluation of '{}' as figure of merit is not implemented".format(figureOfMerit))
+    domainError = ~numpy.isfinite(value) & ~zeroDivision
+    if domainError.any():
+        print "WARNING: had a domain error calculating the value for", domainError.sum(), "bins"
+    return numpy.where(zeroDivision | domainError, -999, value)
+
+
 def evaluate(bin_number, d_signal, d_background, signal_sample, d_signal_totalEvents, d_backgroundRawEvents):
-    nS = d_signal[bin_number]
-    nB = d_background[bin_number]
-    nBEnts = d_backgroundRawEvents[bin_number]
+    # bin_number can be a single bin number or an array of them
+    nS = numpy.asarray(d_signal[bin_number], dtype=float)
+    nB = numpy.asarray(d_background[bin_number], dtype=float)
+    nBEnts = numpy.asarray(d_backgroundRawEvents[bin_number], dtype=float)
     ## For amc@NLO.
     # if nS < 0:
     #  nS = 0
-    if nB < 0:
-        nB = 0
+    nB = numpy.where(nB < 0, 0.0, nB)
     efficiency = calculateEfficiency(nS, signal_sample, d_signal_totalEvents)
-    v = evaluation(nS, nB, efficiency, nBEnts)
+    v = evaluation_arrays(numpy.atleast_1d(nS), numpy.atleast_1d(nB), numpy.atleast_1d(efficiency), numpy.atleast_1d(nBEnts))
     # print 'value=',v
-    return v
+    return v if nS.ndim else float(v[0])
 
 
 def string_to_bins(cut_string):
@@ -530,13 +484,12 @@ cut_variables = []
 cut_requirements = []
 cut_values = []
 bin_numbers = []
+cut_bin_indices = None  # (number of bins, number of cut variables) array of cut value indices
+bin_number_grid = None  # N-dimensional array of cut value indices -> bin number
 
 d_cutVariable_maxCutValues = {}
 
-d_binNumber_cutValuesString = {}
-d_binNumber_cutVariable_cutValue = {}
 d_cutVariable_cutValues = {}
-d_cutValuesString_binNumber = {}
 
 
 ####################################################################################################
@@ -589,66 +542,41 @@ for signal_sample in d_signal_filepaths_list:
     max_string = ""
     max_eff = -1.0
 
-    for binNumber in bin_numbers:
-        nS = d_binNumber_nS[binNumber]
-        nSErr = d_binNumber_nSErr[binNumber]
-        nB = d_binNumber_nB[binNumber]
-        nBErr = d_binNumber_nBErr[binNumber]
-        nBMCEnts = d_binNumber_nBMCEnts[binNumber]
-        nD = d_binNumber_nD[binNumber]
-        # if nS < 0:
-        #  nS = 0
-        # if nB < 0:
-        #  nB = 0
-        ##XXX ignore any set of cuts with nB<0.01
-        # if nB < 0.01:
-        #  continue
-        ##XXX ignore any cuts with less than 5 background events
-        # if nBMCEnts < 5:
-        #  continue
-        ##XXX ignore any set of cuts with nB < 0
-        if nB < 0:
-            continue
-        ## ignore any set of cuts if the nBErr/nB > 50%
-        # if nBErr/nB > 0.5:
-        #  continue
-        if verbose:
+    # evaluate all the bins at once; the grid of values is used for the jitter lookups below
+    values = evaluate(
+        bin_numbers,
+        d_binNumber_nS,
+        d_binNumber_nB,
+        signal_sample.values()[0][0],
+        d_signal_totalEvents,
+        d_binNumber_nBMCEnts
+    )
+    value_grid = numpy.full(bin_number_grid.shape, -999.0)
+    value_grid[tuple(cut_bin_indices.T)] = values
+    nBs = d_binNumber_nB[bin_numbers]
+    ##XXX ignore any set of cuts with nB < 0
+    # the first bin with the largest value wins, as with a strict > comparison
+    candidates = (nBs >= 0) & (values > max_value)
+    if verbose:
+        for idx, binNumber in enumerate(bin_numbers):
             print "binNumber=", binNumber,
-            print "evaluated to: nS=", nS, "nB=", nB, "MCents=", nBMCEnts, ";",
-        value = evaluate(
-            binNumber,
-            d_binNumber_nS,
-            d_binNumber_nB,
-            signal_sample.values()[0][0],
-            d_signal_totalEvents,
-            d_binNumber_nBMCEnts
+            print "evaluated to: nS=", d_binNumber_nS[binNumber], "nB=", nBs[idx], "MCents=", d_binNumber_nBMCEnts[binNumber], ";",
+            print "value=", values[idx], bins_to_string(cut_bin_indices[idx])
+    if candidates.any():
+        max_idx = numpy.argmax(numpy.where(candidates, values, -numpy.inf))
+        max_value = values[max_idx]
+        max_bin = bin_numbers[max_idx]
+        max_nS = d_binNumber_nS[max_bin]
+        max_nB = d_binNumber_nB[max_bin]
+        max_nBMCEnts = d_binNumber_nBMCEnts[max_bin]
+        max_nD = d_binNumber_nD[max_bin]
+        max_string = bins_to_string(cut_bin_indices[max_idx])
+        max_eff = calculateEfficiency(
+            max_nS, signal_sample.values()[0][0], d_signal_totalEvents
         )
         if verbose:
-            # print 'final evaluation: nS=',nS,'nB=',nB,'value=',value,
-            print "value=", value,
-            print "eff=", calculateEfficiency(
-                nS, signal_sample.values()[0][0], d_signal_totalEvents
-            )
-            print d_binNumber_cutValuesString[binNumber]
-        # mejHisto.SetBinContent(binNumber,value)
-
-        if value > max_value:
-            max_value = value
-            max_bin = binNumber
-            max_nS = nS
-            max_nB = nB
-            max_nBMCEnts = nBMCEnts
-            max_nD = nD
-            max_string = d_binNumber_cutValuesString[max_bin]
-            max_eff = calculateEfficiency(
-                nS, signal_sample.values()[0][0], d_signal_totalEvents
-            )
-            if verbose:
-                print "---> NEW MAX FOUND: bin=", max_bin, "cut info=", max_string, "max value=", max_value, "eff=", max_eff
-                print "     evaluated to: nS=", nS, "nB=", nB, "nBMCEnts=", nBMCEnts
-                print "     d_binNumber_nBMCEnts [ max_bin ] =", d_binNumber_nBMCEnts[
-                    max_bin
-                ]
+            print "---> MAX FOUND: bin=", max_bin, "cut info=", max_string, "max value=", max_value, "eff=", max_eff
+            print "     evaluated to: nS=", max_nS, "nB=", max_nB, "nBMCEnts=", max_nBMCEnts
 
     print signal_sample.keys()[0], ": Bin with best value was bin #" + str(
         max_bin
@@ -666,16 +594,19 @@ for signal_sample in d_signal_filepaths_list:
     selectedValueByLQMass.append(max_value)
     lqMasses.append(signalSampleMass)
 
-    max_bins = string_to_bins(max_string)
+    if not candidates.any():
+        # max_idx is unset (or left over from the previous signal sample)
+        print "ERROR: no set of cuts with nB >= 0 found for", signal_sample.keys()[0]
+        sys.exit()
+    max_bins = list(cut_bin_indices[max_idx])
     test_max_string = bins_to_string(max_bins)
     print "max_bins=", max_bins, "test_max_string=", test_max_string
-    test_binNumber = d_cutValuesString_binNumber[test_max_string]
 
-    if test_max_string != max_string:
+    if string_to_bins(max_string) != max_bins:
         print "ERROR: Something is wrong with how you map strings to bins (string test)"
         sys.exit()
 
-    if test_binNumber != max_bin:
+    if bin_number_grid[tuple(max_bins)] != max_bin:
         print "ERROR: Something is wrong with how you map strings to bins (bin test)"
         sys.exit()
 
@@ -693,39 +624,10 @@ for signal_sample in d_signal_filepaths_list:
         lower_jitter_bin = max(0, this_bin - jitter)
         upper_jitter_bin = min(n_bins - 1, this_bin + jitter)
 
-        new_max_bins_lower_jitter = (
-            max_bins[:i] + [lower_jitter_bin] + max_bins[i + 1:]
-        )
-        new_max_bins_upper_jitter = (
-            max_bins[:i] + [upper_jitter_bin] + max_bins[i + 1:]
-        )
-
-        new_max_string_lower_jitter = bins_to_string(new_max_bins_lower_jitter)
-        new_max_string_upper_jitter = bins_to_string(new_max_bins_upper_jitter)
-
-        new_max_binNumber_lower_jitter = d_cutValuesString_binNumber[
-            new_max_string_lower_jitter
-        ]
-        new_max_binNumber_upper_jitter = d_cutValuesString_binNumber[
-            new_max_string_upper_jitter
-        ]
-
-        new_value_lower_jitter = evaluate(
-            new_max_binNumber_lower_jitter,
-            d_binNumber_nS,
-            d_binNumber_nB,
-            signal_sample.values()[0][0],
-            d_signal_totalEvents,
-            d_binNumber_nBMCEnts
-        )
-        new_value_upper_jitter = evaluate(
-            new_max_binNumber_upper_jitter,
-            d_binNumber_nS,
-            d_binNumber_nB,
-            signal_sample.values()[0][0],
-            d_signal_totalEvents,
-            d_binNumber_nBMCEnts
-        )
+        # values along this cut variable through the max point
+        jitter_slice = value_grid[tuple(max_bins[:i]) + (slice(None),) + tuple(max_bins[i + 1:])]
+        new_value_lower_jitter = jitter_slice[lower_jitter_bin]
+        new_value_upper_jitter = jitter_slice[upper_jitter_bin]
 
         lower_jitter_percent_change = (
             100.0 * (new_value_lower_jitter - max_value) / max_value
@@ -1,23 +1,19 @@
 #!/usr/bin/env python3
 import ROOT
 import copy
+import os
+from eventIndex import EventIndex, GetIndexFileName
 
 
-#@ROOT.Numba.Declare(["unsigned int","unsigned int","unsigned long"], "bool")
-def IsMatchingEvent(run, ls, event):
-    for selEvt in selectedEvents:
-        selEvtSplit = selEvt.split(":")
-        selRun = int(selEvtSplit[0])
-        selLs = int(selEvtSplit[1])
-        selEvt = int(selEvtSplit[2])
-        if run!=selRun:
-            continue
-        if ls!=selLs:
-            continue
-        if event!=selEvt:
-            continue
-        return True
-    return False
+def GetSelectedEntries(chain, fileNames):
+    # chain entries of the selectedEvents, looked up in an index of the files instead of scanning every event
+    # the index is kept in a sidecar file next to where this runs, and only rebuilt when the files change
+    index = EventIndex.LoadOrBuild(GetIndexFileName("readNanoAOD"), fileNames, "Events", min(len(fileNames), os.cpu_count()))
+    positions = index.FindIndices(selectedEvents)
+    positions = positions[positions >= 0]
+    chain.GetEntries()  # fills the tree offsets
+    treeOffsets = chain.GetTreeOffset()
+    return sorted(treeOffsets[int(index.fileIdx[pos])] + int(index.entries[pos]) for pos in positions)
 
 
 ROOT.gInterpreter.Declare('''
@@ -63,14 +59,17 @@ for tfile in filesInclusive:
     tree.Add(tfile)
 hltBranchNames = [branch.GetName() for branch in tree.GetListOfBranches() if "HLT" in branch.GetName()]
 nevents = tree.GetEntries()
-for iev, event in enumerate(tree):
+entriesToRead = range(nevents)
+if len(selectedEvents) > 0:
+    entriesToRead = GetSelectedEntries(tree, filesInclusive)
+    print("Found {} of {} selected events".format(len(entriesToRead), len(selectedEvents)))
+for iev in entriesToRead:
     if maxEvents > 0 and iev >= maxEvents:
         break
     if iev < 10 or iev % 10000 == 0:
         print("event {}/{}".format(iev, nevents))
-    if len(selectedEvents) > 0:
-        if not IsMatchingEvent(event.run, event.luminosityBlock, event.event):
-            continue
+    tree.GetEntry(iev)
+    event = tree
     # selections
     if event.nElectron <= 0 or event.Electron_pt[0] < 35 or event.HLT_Photon175:
         continue
@@ -19,7 +19,7 @@ import tempfile
 import subprocess
 from optparse import OptionParser
 from tabulate import tabulate
-from combineCommon import ParseXSectionFile, lookupXSection
+from combineCommon import ParseXSectionFile, lookupXSection, GetHistoContentArray, GetHistoSumw2Array
 
 import ROOT
 from ROOT import TMVA, TFile, TString, TCut, TChain, TFileCollection, gROOT, gDirectory, gInterpreter, TEntryList, TH1D, TProfile, RDataFrame, TCanvas, TLine, kRed, kBlue, kSpring, TGraph, TGraphErrors, TMultiGraph, gPad, RooStats, TColor, TPaveText, gStyle, gSystem
@@ -106,8 +106,70 @@ def LoadChainFromTxtFile(txtFile, console=None):
     #     print(logString)
     return ch
 
+gInterpreter.Declare('''
+namespace TrainTestSplit {
+  // splitmix64 finalizer
+  inline ULong64_t Mix(ULong64_t x) {
+    x += 0x9e3779b97f4a7c15ULL;
+    x = (x ^ (x >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    x = (x ^ (x >> 27)) * 0x94d049bb133111ebULL;
+    return x ^ (x >> 31);
+  }
+  // depends only on the event id, so the split is reproducible and independent of the entry order and of the threading
+  bool IsTrainingEvent(ULong64_t run, ULong64_t ls, ULong64_t event) {
+    return (Mix(Mix(Mix(run) ^ ls) ^ event) & 1) == 0;
+  }
+}
+''')
+
+
+# name of the split made by DefineTrainingSplit(); written next to the weight files trained with it, since the test events used in the
+# optimization must be selected by the same split (weights from the earlier entry-range split need retraining)
+trainTestSplitName = "runLsEventHash"
+
+
+def DefineTrainingSplit(df):
+    return df.Define("isTrainingEvent", "TrainTestSplit::IsTrainingEvent((ULong64_t)run, (ULong64_t)ls, (ULong64_t)event)")
+
+
+def GetTrainTestSplitFileName(bdtWeightFileName):
+    return bdtWeightFileName.replace(".weights.xml", ".split.txt")
+
+
+def WriteTrainTestSplit(bdtWeightFileName):
+    with open(GetTrainTestSplitFileName(bdtWeightFileName), "w") as splitFile:
+        splitFile.write(trainTestSplitName+"\n")
+
+
+def CheckTrainTestSplit(bdtWeightFileName):
+    splitFileName = GetTrainTestSplitFileName(bdtWeightFileName)
+    split = "entryRange"  # weights written before the split was recorded
+    if os.path.isfile(splitFileName):
+        with open(splitFileName) as splitFile:
+            split = splitFile.read().strip()
+    elif allowUnrecordedSplit:
+        print("WARNING: no train/test split recorded for BDT weight file {}; assuming the '{}' split as requested, but if it was trained with the earlier '{}' split, some test events were used in the training.".format(
+            bdtWeightFileName, trainTestSplitName, split), flush=True)
+        return
+    if split != trainTestSplitName:
+        raise RuntimeError("BDT weight file {} was trained with the '{}' train/test split, but the test events are now selected with the '{}' split, so some of them were used in the training; please retrain.".format(
+            bdtWeightFileName, split, trainTestSplitName))
+
+
 def PrepareCustomTestAndTrainTrees(tchain, weight, key, datasetName, ZJetTrainingSample, testOutputTree, trainOutputTree, lqMass, eosDir, year):
-    ROOT.DisableImplicitMT() #I need rdataframe Range, which doesn't work with implicit mt
+    # implicit MT only for the event loops made here
+    enabledImplicitMT = False
+    if trainingTreeThreads > 1 and not ROOT.IsImplicitMTEnabled():
+        ROOT.EnableImplicitMT(trainingTreeThreads)
+        enabledImplicitMT = True
+    try:
+        WriteCustomTestAndTrainTrees(tchain, weight, key, datasetName, ZJetTrainingSample, testOutputTree, trainOutputTree, lqMass, eosDir, year)
+    finally:
+        if enabledImplicitMT:
+            ROOT.DisableImplicitMT()
+
+
+def WriteCustomTestAndTrainTrees(tchain, weight, key, datasetName, ZJetTrainingSample, testOutputTree, trainOutputTree, lqMass, eosDir, year):
     #if not os.path.isdir(eosDir+"/perSampleTrainingTrees"):
     #    os.mkdir(eosDir+"/perSampleTrainingTrees")
     #if not os.path.isdir(eosDir+"/perSampleTrainingTrees/"+str(lqMass)):
@@ -124,7 +186,6 @@ def PrepareCustomTestAndTrainTrees(tchain, weight, key, datasetName, ZJetTrainin
         df = df.Filter("Meejj > "+str(lqMass))
         filename = eosDir+"/perSampleTrainingTrees/"+str(lqMass)+"/"+year+"/"+datasetName+"_test"+str(lqMass)+".root" 
         df.Snapshot("testTree",filename)
-        time.sleep(2)
         testOutputTree.Add(filename)
     elif ZJetTrainingSample in key and not "amcatnlo" in ZJetTrainingSample: #DY for training. See above comment about training with amcatnlo
         print("Use weight/2 for dataset "+datasetName)
@@ -135,7 +196,6 @@ def PrepareCustomTestAndTrainTrees(tchain, weight, key, datasetName, ZJetTrainin
         df = df.Filter("Meejj > "+str(lqMass))
         filename = eosDir+"/perSampleTrainingTrees/"+str(lqMass)+"/"+year+"/"+datasetName+"_train"+str(lqMass)+".root"
         df.Snapshot("trainTree", filename)
-        time.sleep(2)
         trainOutputTree.Add(filename)
  
     elif "QCDFakes" in key: #QCD always goes only in testing
@@ -147,7 +207,6 @@ def PrepareCustomTestAndTrainTrees(tchain, weight, key, datasetName, ZJetTrainin
         df = df.Filter("Meejj > "+str(lqMass))
         filename = eosDir+"/perSampleTrainingTrees/"+str(lqMass)+"/"+year+"/"+datasetName+"_test"+str(lqMass)+".root"
         df.Snapshot("testTree",filename)
-        time.sleep(3)
         testOutputTree.Add(filename)
     else: #everything else goes in both. Also, amcatnlo should end up going through this part if we train with amcatnlo DY
         tchain.SetWeight(weight,"global")
@@ -155,20 +214,22 @@ def PrepareCustomTestAndTrainTrees(tchain, weight, key, datasetName, ZJetTrainin
         df = df.Define("perSampleWeight", str(weight))
         df = df.Define("fullWeight","perSampleWeight * EventWeight")
         df = df.Filter("Meejj > "+str(lqMass))
-        dfTrain = df.Range(0,0,2) #even entries
-        dfTest = df.Range(1,0,2) #odd entries
+        df = DefineTrainingSplit(df)
+        dfTrain = df.Filter("isTrainingEvent")
+        dfTest = df.Filter("!isTrainingEvent")
         filenameTrain = eosDir+"/perSampleTrainingTrees/"+str(lqMass)+"/"+year+"/"+datasetName+"_train"+str(lqMass)+".root"
         filenameTest = eosDir+"/perSampleTrainingTrees/"+str(lqMass)+"/"+year+"/"+datasetName+"_test"+str(lqMass)+".root"
+        # book both snapshots and the counts before running, so that they are all filled in the same event loop
+        snapshotOptions = ROOT.RDF.RSnapshotOptions()
+        snapshotOptions.fLazy = True
         nTrain = dfTrain.Count()
         nTest = dfTest.Count()
-        dfTrain.Snapshot("trainTree", filenameTrain)
+        snapshotTrain = dfTrain.Snapshot("trainTree", filenameTrain, "", snapshotOptions)
+        snapshotTest = dfTest.Snapshot("testTree", filenameTest, "", snapshotOptions)
         print("Add NEvents {} from {} dataset {} with weight = {} to TRAINING".format(nTrain.GetValue(), key, datasetName, tchain.GetWeight()))
-        dfTest.Snapshot("testTree",filenameTest)
         print("Add NEvents {} from {} dataset {} with weight {} to TESTING".format(nTest.GetValue(), key, datasetName, tchain.GetWeight()))
-        time.sleep(2)
         trainOutputTree.Add(filenameTrain)
         testOutputTree.Add(filenameTest)
-    ROOT.EnableImplicitMT(6) #Turn this back on when we're done
 
 def LoadDatasets(datasetDict, neededBranches, ZJetTrainingSample, eosDir = "", signal=False, loader=None, years=None, lqMass=None, nLQPoints=1):
     #print("loadDatasets for dict: ")
@@ -389,6 +450,7 @@ def TrainBDT(args):
                 #"!H:!V:BoostType=Grad:DoBoostMonitor:NegWeightTreatment=IgnoreNegWeightsInTraining:SeparationType=GiniIndex:NTrees=1000:MinNodeSize=5%:Shrinkage=0.01:UseBaggedBoost:BaggedSampleFraction=0.5:nCuts=20:MaxDepth=4:CreateMVAPdfs:NbinsMVAPdf=20" )#comparing negative weight options with smaller nodes, more depth
         factory.TrainAllMethods()
         if not drawTrees:
+            WriteTrainTestSplit("dataset/weights/TMVAClassification_"+signalDatasetName+"_BDTG.weights.xml")
             factory.TestAllMethods()
             factory.EvaluateAllMethods()
             
@@ -610,12 +672,319 @@ def EvaluateFigureOfMerit(nS, nB, efficiency, bkgEnts, figureOfMerit):
     return value
 
 
-def OptimizeBDTCut(args):
+def EvaluateFigureOfMeritArrays(nS, nB, efficiency, bkgEnts, figureOfMerit):
+    # element-wise version of EvaluateFigureOfMerit
+    # entries where the scalar version hits a zero division or a domain error are set to -999
+    nS, nB, efficiency, bkgEnts = (np.asarray(vals, dtype=np.float64) for vals in (nS, nB, efficiency, bkgEnts))
+    if figureOfMerit == "zbi":
+        return np.array([EvaluateFigureOfMerit(*vals, figureOfMerit) for vals in zip(nS, nB, efficiency, bkgEnts)])
+    with np.errstate(all="ignore"):
+        zeroDivision = (bkgEnts != 0) & (nB == 0)
+        tau = bkgEnts / nB
+        if figureOfMerit == "asymptotic":
+            zeroDivision |= nB == 0
+            value = np.sqrt(2 * ((nS + nB) * np.log(1 + nS / nB) - nS))
+        elif figureOfMerit == "punzi":
+            a = 2  # nSigmasExclusion
+            b = 5  # nSigmasDiscovery
+            smin = a**2/8 + 9*b**2/13 + a*np.sqrt(nB) + (b/2)*np.sqrt(b**2 + 4*a*np.sqrt(nB) + 4*nB)
+            zeroDivision |= smin == 0
+            value = efficiency / smin
+        elif figureOfMerit == "zpl":  # [1], eqn. 25
+            nOff = bkgEnts
+            nOn = nS + nB
+            nTot = nOff + nOn
+            zeroDivision |= (nB == 0) | (nTot == 0) | (nTot*tau == 0)
+            value = np.sqrt(2)*np.sqrt(nOn*np.log(nOn*(1+tau)/nTot) + nOff*np.log(nOff*(1+tau)/(nTot*tau)))
+        elif figureOfMerit == "ssb":
+            zeroDivision |= nS + nB == 0
+            value = nS / np.sqrt(nS+nB)
+        else:
+            raise RuntimeError("Evaluation of '{}' as figure of merit is not implemented".format(figureOfMerit))
+    domainError = ~np.isfinite(value) & ~zeroDivision
+    if np.any(domainError):
+        print("WARNING: had a domain error calculating the value with nS=", nS[domainError], "and nB=", nB[domainError])
+    return np.where(zeroDivision | domainError, -999, value)
+
+
+def GetTailIntegralArrays(hist):
+    # hist.IntegralAndError(iBin, nBins) for every iBin in [1, nBins] at once (overflow excluded)
+    # returns the integrals and the squared errors
+    nBins = hist.GetNbinsX()
+    contents = GetHistoContentArray(hist)[1:nBins+1].astype(np.float64)
+    sumw2 = GetHistoSumw2Array(hist)[1:nBins+1]
+    return np.cumsum(contents[::-1])[::-1], np.cumsum(sumw2[::-1])[::-1]
+
+
+def ScanBDTCut(histSig, sumSigWeights, bkgHistsDict, bkgTotalUnweighted, includeQCD, figureOfMerit="asymptotic", minNB=0.5, qcd2FRLimit=0.5):
+    # evaluate the figure of merit for a cut at the low edge of every BDT bin in one go
+    # all returned arrays are indexed by iBin-1
+    nBins = histSig.GetNbinsX()
+    nS, nSErrSq = GetTailIntegralArrays(histSig)
+    nSErr = np.sqrt(nSErrSq)
+    nB = np.zeros(nBins)
+    nBErrSq = np.zeros(nBins)
+    skipFOMCalc = np.zeros(nBins, dtype=bool)
+    for sample, hist in bkgHistsDict.items():
+        if "qcd" in sample.lower():
+            continue
+        nBThisProcess, nBThisProcessErrSq = GetTailIntegralArrays(hist)
+        nB += np.where(nBThisProcess < 0, 0, nBThisProcess)
+        nBErrSq += nBThisProcessErrSq
+    if includeQCD:
+        qcd1FRDataYield, qcd1FRDataErrSq = GetTailIntegralArrays(bkgHistsDict["QCDFakes_DATA"])
+        qcd1FRDYJYield, qcd1FRDYJErrSq = GetTailIntegralArrays(bkgHistsDict["QCDFakes_DYJ"])
+        qcd2FRDataYield, qcd2FRDataErrSq = GetTailIntegralArrays(bkgHistsDict["QCDFakes_DATA_2FR"])
+        qcd1FRYield = qcd1FRDataYield+qcd1FRDYJYield
+        qcd1FRYield = np.where(qcd1FRYield < 0, 0, qcd1FRYield)
+        qcd2FRDataYield = np.where(np.abs(qcd2FRDataYield) > qcd2FRLimit*qcd1FRYield, -1*qcd2FRLimit*qcd1FRYield, qcd2FRDataYield)
+        nB += qcd2FRDataYield+qcd1FRYield
+        # after we're done adding things to nB, if it's still negative then we need to not do the FOM calc.
+        skipFOMCalc |= nB < 0
+        nBErrSq += qcd1FRDataErrSq+qcd1FRDYJErrSq+qcd2FRDataErrSq
+    # require minNB background events, except for the cut at zero; if we don't hit minNB by the time the BDT cut becomes negative,
+    # then the only FOM that gets evaluated at all is the one at zero, meaning that it will be the maximum by definition.
+    belowMinNB = nB < minNB
+    belowMinNB[histSig.FindFixBin(0.0)-1] = False
+    skipFOMCalc |= belowMinNB
+    bkgEnts, _ = GetTailIntegralArrays(bkgTotalUnweighted)
+    allFOMs = EvaluateFigureOfMeritArrays(nS, np.where(nB > 0.0, nB, 0.0), nS/sumSigWeights, bkgEnts, figureOfMerit)
+    scan = {}
+    scan["FOM"] = np.where(skipFOMCalc, 0.0, allFOMs)
+    scan["cutVal"] = np.array([histSig.GetBinLowEdge(iBin) for iBin in range(1, nBins+1)])
+    scan["nS"] = nS
+    scan["nSErr"] = nSErr
+    scan["eff"] = nS/sumSigWeights
+    scan["effErr"] = nSErr/sumSigWeights  # assuming sumWeights and signalWeight have zero error
+    scan["nB"] = nB
+    scan["nBErr"] = np.sqrt(nBErrSq)
+    return scan
+
+
+def DeclareBDTReader(lqMassToUse, bdtWeightFileName):
+    if getattr(ROOT, "BDT{}".format(lqMassToUse), None) is not None:
+        return
+    numVars = len(variableList)
+    if normalizeVars:
+        numVars -= 1
+    gInterpreter.ProcessLine(('''
+    TMVA::Experimental::RReader BDT{}("{}");
+    auto computeBDT{} = TMVA::Experimental::Compute<{}, float>(BDT{});
+    ''').format(lqMassToUse, bdtWeightFileName, lqMassToUse, numVars, lqMassToUse))
+
+
+class BackgroundBDTHists:
+    # BDT output hists of the backgrounds for one LQ mass, per year and for the full Run II
+    def __init__(self, lqMassToUse, years, binsToUse, name="BDTG"):
+        self.binsToUse = binsToUse
+        self.histTitle = "Classifier Output on {} background for " + name + ", M_{{LQ}} = " + str(lqMassToUse) + " GeV"
+        self.histName = "BDTOutput{}LQM" + str(lqMassToUse)
+        self.bkgTotal = TH1D(self.histName.format("TotalBackground"), self.histTitle.format("all"), binsToUse, -1, 1)
+        self.bkgTotalUnweighted = TH1D(self.histName.format("TotalBackground")+"Unweighted", self.histTitle.format("all")+" (unweighted)", binsToUse, -1, 1)
+        self.bkgTotalNegWeightsOnly = TH1D(self.histName.format("TotalBackground")+"NegWeightsOnly", self.histTitle.format("all")+" (negative weight events only", binsToUse, -1, 1)
+        self.bkgHists = {"fullRunII": dict()}
+        self.bkgHistsUnweightedUnscaled = {"fullRunII": dict()}
+        self.bkgHistsNegWeights = dict()
+        self.emptySamples = {}
+        for year in years:
+            self.emptySamples[year] = []
+            self.bkgHists[year] = dict()
+            self.bkgHistsUnweightedUnscaled[year] = dict()
+
+    @staticmethod
+    def GetHistKey(sample):
+        # all the QCD fake-rate data samples go into the 1FR or the 2FR hists
+        if "QCDFakes_DATA" in sample:
+            return "QCDFakes_DATA_2FR" if "2FR" in sample else "QCDFakes_DATA"
+        return sample
+
+    def BookSample(self, year, sample):
+        samples = ["QCDFakes_DATA", "QCDFakes_DATA_2FR"] if "QCDFakes_DATA" in sample else [sample]
+        binsToUse = self.binsToUse
+        for s in samples:
+            if not s in self.bkgHists[year]:
+                self.bkgHists[year][s] = TH1D(self.histName.format(s)+"_"+year, self.histTitle.format(s), binsToUse, -1, 1)
+            if not s in self.bkgHists["fullRunII"]:
+                self.bkgHists["fullRunII"][s] = TH1D(self.histName.format(s), self.histTitle.format(s), binsToUse, -1, 1)
+            if not s in self.bkgHistsUnweightedUnscaled[year]:
+                self.bkgHistsUnweightedUnscaled[year][s] = TH1D(self.histName.format(s)+"_unweightedUnscaled_"+year, self.histTitle.format(s)+", unweighted/unscaled", binsToUse, -1, 1)
+            if not s in self.bkgHistsUnweightedUnscaled["fullRunII"]:
+                self.bkgHistsUnweightedUnscaled["fullRunII"][s] = TH1D(self.histName.format(s)+"_unweightedUnscaled", self.histTitle.format(s)+", unweighted/unscaled", binsToUse, -1, 1)
+            if not s in self.bkgHistsNegWeights:
+                self.bkgHistsNegWeights[s] = TH1D(self.histName.format(s)+"_negWeightsOnly", self.histTitle.format(s)+", negative weight events", binsToUse, -1, 1)
+
+    def Add(self, year, sample, histBkg, histBkgUnweighted, histBkgNegWeights):
+        key = self.GetHistKey(sample)
+        self.bkgHists[year][key].Add(histBkg)
+        self.bkgHists["fullRunII"][key].Add(histBkg)
+        self.bkgHistsUnweightedUnscaled[year][key].Add(histBkgUnweighted)
+        self.bkgHistsUnweightedUnscaled["fullRunII"][key].Add(histBkgUnweighted)
+        self.bkgHistsNegWeights[key].Add(histBkgNegWeights)
+        self.bkgTotal.Add(histBkg)
+        self.bkgTotalUnweighted.Add(histBkgUnweighted)
+        self.bkgTotalNegWeightsOnly.Add(histBkgNegWeights)
+
+
+def GroupInputListsByMass(txtFileTemplate, year, lqMasses):
+    # the background input lists are per LQ mass, but makeBDTTrainingTrees.py normally writes the same events of a dataset for every mass,
+    # with only LQCandidateMass differing (which BookBackgroundBDT() redefines per mass); so the masses whose lists have identical contents
+    # can share one event loop
+    # returns an OrderedDict of txtFile --> masses to evaluate on it; masses whose lists differ (or are missing) get their own entry
+    groups = OrderedDict()
+    contentsToTxtFile = {}
+    for lqMass in lqMasses:
+        txtFile = txtFileTemplate.format(year, lqMass)
+        if year=="2016preVFP" and not "SinglePhoton" in txtFile:
+            txtFile = txtFile.replace(".txt", "_APV.txt")
+        if not os.path.isfile(os.path.expandvars(txtFile)):
+            groups[txtFile] = [lqMass]  # LoadChainFromTxtFile will complain
+            continue
+        with open(os.path.expandvars(txtFile)) as listFile:
+            contents = listFile.read()
+        if contents in contentsToTxtFile:
+            groups[contentsToTxtFile[contents]].append(lqMass)
+        else:
+            contentsToTxtFile[contents] = txtFile
+            groups[txtFile] = [lqMass]
+    if len(groups) > 1:
+        print("WARNING: the input lists from {} for year {} differ between LQ masses; evaluating them in {} separate event loops: {}".format(
+            txtFileTemplate, year, len(groups), dict(groups)), flush=True)
+    return groups
+
+
+def BookBackgroundBDT(df, lqMassToUse, histNameBDT, binsToUse, bkgWeight, snapshotFile):
+    # book everything needed from one background dataset for one LQ mass; nothing runs until the first result is accessed
+    df = df.Filter(mycutbDict[str(lqMassToUse)].GetTitle())  # will work for expressions valid in C++
+    if "LQCandidateMass" in variableList:
+        df = df.Define("massInt", str(lqMassToUse))
+        df = df.Redefine("LQCandidateMass", "Numba::GetMassFloat(massInt)")
+    varNames = [v for v in getattr(ROOT, "BDT{}".format(lqMassToUse)).GetVariableNames()]
+    if normalizeVars:
+        l_varn = ROOT.std.vector['std::string']()
+        for i_expr, expr in enumerate(varNames):
+            varname = 'v_{}'.format(i_expr)
+            l_varn.push_back(varname)
+            df = df.Define(varname, '(float)({})'.format(expr))
+        df = df.Define('BDTv', getattr(ROOT, "computeBDT{}".format(lqMassToUse)), l_varn)
+    else:
+        df = df.Define('BDTv', getattr(ROOT, "computeBDT{}".format(lqMassToUse)), varNames)
+    df = df.Define('BDT', 'BDTv[0]')
+    df = df.Define('eventWeight', eventWeightExpression)
+    df = df.Define("fullWeight", "eventWeight * {}".format(bkgWeight))
+    results = {}
+    results["hist"] = df.Histo1D(ROOT.RDF.TH1DModel(histNameBDT, histNameBDT, binsToUse, -1, 1), "BDT", "eventWeight")
+    results["histUnweighted"] = df.Histo1D(ROOT.RDF.TH1DModel(histNameBDT+"_unweighted", histNameBDT+"_unweighted", binsToUse, -1, 1), "BDT")
+    results["histNegWeights"] = df.Filter('eventWeight < 0').Histo1D(ROOT.RDF.TH1DModel(histNameBDT+"_negWeights", histNameBDT+"_negWeights", binsToUse, -1, 1), "BDT")
+    results["sumWeights"] = df.Sum("eventWeight")
+    results["count"] = df.Count()
+    snapshotOptions = ROOT.RDF.RSnapshotOptions()
+    snapshotOptions.fLazy = True
+    results["snapshot"] = df.Snapshot('tree', snapshotFile, "", snapshotOptions)
+    return results
+
+
+def FillBackgroundBDTHists(massToWeightFile, years, binsToUse):
+    # evaluate the BDTs of all the given LQ masses on the backgrounds
+    # each background dataset is read once, in a single event loop, for all the masses
+    lqMasses = list(massToWeightFile.keys())
+    bkgBDTHistsByMass = OrderedDict()
+    for lqMass in lqMasses:
+        DeclareBDTReader(lqMass, massToWeightFile[lqMass])
+        bkgBDTHistsByMass[lqMass] = BackgroundBDTHists(lqMass, years, binsToUse)
+        tempDir = optimizationTempDir.format(lqMass)
+        if not os.path.isdir(tempDir):
+            os.mkdir(tempDir)
+    for year in years:
+        intLumi = intLumiDict[year]
+        for sample in backgroundDatasetsDict.keys():
+            if "QCDFakes_DATA" in sample and not year in sample:
+                continue
+            if "ZJet" in sample and not "amcatnlo" in sample:
+                continue #use only amcatnlo DY for optimization
+            for lqMass in lqMasses:
+                bkgBDTHistsByMass[lqMass].BookSample(year, sample)
+            bkgSampleIntegral = dict.fromkeys(lqMasses, 0)
+            bkgSampleIntegralHist = dict.fromkeys(lqMasses, 0)
+            xsectionFile = xsectionFiles[year]
+            ParseXSectionFile(xsectionFile)
+            for idx, txtFileTemplate in enumerate(backgroundDatasetsDict[sample]):
+                for txtFile, groupMasses in GroupInputListsByMass(txtFileTemplate, year, lqMasses).items():
+                    tchainBkg = LoadChainFromTxtFile(txtFile)
+                    if tchainBkg is None:
+                        continue
+                    datasetName = os.path.basename(txtFile).replace(".txt", "")
+                    if "data" not in sample.lower():
+                        sumWeights = GetBackgroundSumWeights(datasetName, txtFile)
+                        bkgWeight = CalcWeight(datasetName, intLumi, sumWeights)
+                    else:
+                        bkgWeight = 1.0
+                    fileToWrite = datasetName
+                    if year=='2016preVFP':
+                        fileToWrite = fileToWrite.replace("_APV","")
+                    if sample == "QCDFakes_DYJ":
+                        fileToWrite += "_QCD"
+                    if "_2FR" in sample:
+                        fileToWrite += "_2FR"
+                    df = RDataFrame(tchainBkg)
+                    bookedResults = OrderedDict()
+                    for lqMass in groupMasses:
+                        histNameBDT = "BDTVal_{}_{}_{}_LQM{}".format(sample, idx, year, lqMass)
+                        snapshotFile = optimizationTempDir.format(lqMass)+'/{}_{}_{}.root'.format(fileToWrite, lqMass, year)
+                        bookedResults[lqMass] = BookBackgroundBDT(df, lqMass, histNameBDT, binsToUse, bkgWeight, snapshotFile), snapshotFile
+                    print("INFO: evaluating BDTs for LQ masses {} on subsample={} in one event loop".format(groupMasses, txtFile), flush=True)
+                    for lqMass, (results, snapshotFile) in bookedResults.items():
+                        # the first access runs the event loop for all the masses
+                        histBkg = results["hist"].GetValue()
+                        histBkg.Scale(bkgWeight)
+                        histBkgUnweighted = results["histUnweighted"].GetValue()
+                        for h in [histBkg, histBkgUnweighted]:
+                            nBins = h.GetNbinsX()
+                            overflow = h.GetBinContent(nBins+1)
+                            h.SetBinContent(nBins, h.GetBinContent(nBins)+overflow)
+                            if "QCD" in sample:
+                                continue
+                            for ibin in range(1,nBins+1):
+                                if h.GetBinContent(ibin) < 0:
+                                    h.SetBinContent(ibin, 0)
+                        bkgBDTHists = bkgBDTHistsByMass[lqMass]
+                        bkgBDTHists.Add(year, sample, histBkg, histBkgUnweighted, results["histNegWeights"].GetValue())
+                        dfSumWeights = results["sumWeights"].GetValue()
+                        dfEntries = results["count"].GetValue()
+                        bkgIntegral = dfSumWeights*bkgWeight
+                        print("LQM{}: subsample={}, bkgWeight={}".format(lqMass, txtFile, bkgWeight), flush=True)
+                        print("LQM{}: subsample={}, entries = {}, integral unweighted = {}, integral weighted = {}".format(lqMass, txtFile, histBkg.GetEntries(), histBkg.Integral()/bkgWeight, histBkg.Integral()), flush=True)
+                        print("LQM{}: subsample={}, df entries = {}, df integral unweighted = {}, df integral weighted = {}".format(lqMass, txtFile, dfEntries, dfSumWeights, bkgIntegral), flush=True)
+                        if dfEntries <= 0:
+                            print("INFO LQM{}: found empty sample after Meejj cut {} ({})".format(lqMass, datasetName, year))
+                            bkgBDTHists.emptySamples[year].append(fileToWrite)
+                        elif bkgIntegral < 0 and not "QCD" in sample:
+                            print("INFO LQM{}: found negative yield after Meejj cut = {} for dataset {} ({})".format(lqMass, bkgIntegral, datasetName, year))
+                            bkgBDTHists.emptySamples[year].append(fileToWrite)
+                        if fileToWrite in bkgBDTHists.emptySamples[year] and os.path.isfile(snapshotFile):
+                            os.remove(snapshotFile)
+                        bkgSampleIntegral[lqMass] += bkgIntegral
+                        bkgSampleIntegralHist[lqMass] += histBkg.Integral()
+                    sys.stdout.flush()
+            for lqMass in lqMasses:
+                print("LQM{}: sample={}, events = {} [df], from hist = {}".format(lqMass, sample, bkgSampleIntegral[lqMass], bkgSampleIntegralHist[lqMass]), flush=True)
+    return bkgBDTHistsByMass
+
+
+def OptimizeBDTCutsForMasses(args):
+    # optimize the BDT cuts of several LQ masses, evaluating all their BDTs on the backgrounds in a single pass
+    massToWeightFile, sharedOptValsDict, sharedOptHistsDict, sharedFOMInfoDict, years = args
+    bkgBDTHistsByMass = FillBackgroundBDTHists(massToWeightFile, years, optimizationBins)
+    for lqMass, weightFile in massToWeightFile.items():
+        OptimizeBDTCut([weightFile, lqMass, sharedOptValsDict, sharedOptHistsDict, sharedFOMInfoDict, years], bkgBDTHists=bkgBDTHistsByMass[lqMass])
+    return True
+
+
+def OptimizeBDTCut(args, bkgBDTHists=None):
+    # bkgBDTHists: background hists already filled for this mass by OptimizeBDTCutsForMasses(), if any
     bdtWeightFileName, lqMassToUse, sharedOptValsDict, sharedOptHistsDict, sharedFOMInfoDict, years = args
     startTime = time.time()
     try:
         mycuts = mycutsDict[str(lqMassToUse)]
-        mycutb = mycutbDict[str(lqMassToUse)]
         signalDatasetsDict = {}
         signalDatasetName = signalNameTemplate.format(lqMassToUse)
         signalDatasetsDict[signalDatasetName] = allSignalDatasetsDict[signalDatasetName]
@@ -631,11 +1000,10 @@ def OptimizeBDTCut(args):
         # methodNames = [name]
         # print("name={}, bdtWeightFileName={}".format(name, bdtWeightFileName))
         # reader.BookMVA(name, bdtWeightFileName )
-        tempDir = "/tmp/LQM{}".format(lqMassToUse)
-        #tempDir = "LQM{}".format(lqMassToUse) #Can use this to save optimization trees to afs space. But only for a couple of masses at a time before you run out of storage space.
+        tempDir = optimizationTempDir.format(lqMassToUse)
         if not os.path.isdir(tempDir):
             os.mkdir(tempDir)
-        binsToUse = 200 #100 # 10000
+        binsToUse = optimizationBins
         hname = "hsig_" + name + "_" + str(lqMassToUse)
         htitle = "Classifier Output on signal for " + name + ", M_{LQ} = " + str(lqMassToUse) + " GeV"
         hsig = TH1D(hname,htitle,binsToUse,-1,1)
@@ -643,217 +1011,18 @@ def OptimizeBDTCut(args):
         #hname = "hbkg_" + name + "_" + lqMassToUse
         #hbkg = ROOT.RDF.TH1DModel(hname,htitle,binsToUse,-1,1)
 
-        numVars = len(variableList)
-        if normalizeVars:
-            numVars -= 1
-        gInterpreter.ProcessLine(('''
-        TMVA::Experimental::RReader BDT{}("{}");
-        auto computeBDT{} = TMVA::Experimental::Compute<{}, float>(BDT{});
-        ''').format(lqMassToUse, bdtWeightFileName, lqMassToUse, numVars, lqMassToUse))
-        print("auto computeBDT{} = TMVA::Experimental::Compute<{}, float>(BDT{});".format(lqMassToUse, numVars, lqMassToUse))
-        sys.stdout.flush()
-        sys.stderr.flush()
+        if not parametrized:
+            # the parametrized BDT is split by TMVA itself
+            CheckTrainTestSplit(bdtWeightFileName)
+        DeclareBDTReader(lqMassToUse, bdtWeightFileName)
         # backgrounds
-        histTitle = "Classifier Output on {} background for " + name + ", M_{{LQ}} = " + str(lqMassToUse) + " GeV"
-        histName = "BDTOutput{}LQM" + str(lqMassToUse)
-        bkgTotal = TH1D(histName.format("TotalBackground"), histTitle.format("all"), binsToUse, -1, 1)
-        bkgTotalUnweighted = TH1D(histName.format("TotalBackground")+"Unweighted", histTitle.format("all")+" (unweighted)", binsToUse, -1, 1)
-        bkgTotalNegWeightsOnly = TH1D(histName.format("TotalBackground")+"NegWeightsOnly",histTitle.format("all")+" (negative weight events only", binsToUse, -1,1)
-        bkgHists = dict()
-        bkgHists["fullRunII"] = dict()
-        bkgHistsUnweightedUnscaled = dict()
-        bkgHistsUnweightedUnscaled["fullRunII"] = dict()
-        bkgHistsNegWeights = dict()
-        emptySamples = {}
-        bkgTotIntegralOverCut = 0
-        cutValForIntegral = 0.9940
-        for year in years:
-            emptySamples[year] = []
-            bkgHists[year] = dict()
-            bkgHistsUnweightedUnscaled[year] = dict()
-            for sample in backgroundDatasetsDict.keys():
-                if "QCDFakes_DATA" in sample and not year in sample:
-                    continue
-                if "ZJet" in sample and not "amcatnlo" in sample:
-                    continue #use only amcatnlo DY for optimization
-                bkgSampleIntegralOverCut = 0
-                bkgSampleIntegral = 0
-                bkgSampleIntegralHist = 0
-                if "QCDFakes_DATA" in sample:
-                    for s in ["QCDFakes_DATA", "QCDFakes_DATA_2FR"]:
-                        if not s in bkgHists[year]:
-                            bkgHists[year][s] = TH1D(histName.format(s)+"_"+year, histTitle.format(s), binsToUse, -1, 1)
-                        if not s in bkgHists["fullRunII"]:
-                            bkgHists["fullRunII"][s] = TH1D(histName.format(s), histTitle.format(s), binsToUse, -1, 1)
-                        if not s in bkgHistsUnweightedUnscaled[year]:
-                            bkgHistsUnweightedUnscaled[year][s] = TH1D(histName.format(s)+"_unweightedUnscaled_"+year, histTitle.format(s)+", unweighted/unscaled", binsToUse, -1, 1)
-                        if not s in bkgHistsUnweightedUnscaled["fullRunII"]:
-                            bkgHistsUnweightedUnscaled["fullRunII"][s] = TH1D(histName.format(s)+"_unweightedUnscaled", histTitle.format(s)+", unweighted/unscaled", binsToUse, -1, 1)
-                        if not s in bkgHistsNegWeights:
-                            bkgHistsNegWeights[s] = TH1D(histName.format(s)+"_negWeightsOnly", histTitle.format(s)+", negative weight events", binsToUse, -1, 1)
-                else:
-                    if not sample in bkgHists[year]:
-                        bkgHists[year][sample] = TH1D(histName.format(sample)+"_"+year, histTitle.format(sample), binsToUse, -1, 1)
-                    if not sample in bkgHists["fullRunII"]:
-                        bkgHists["fullRunII"][sample] = TH1D(histName.format(sample), histTitle.format(sample), binsToUse, -1, 1)
-                    if not sample in bkgHistsUnweightedUnscaled[year]:
-                        bkgHistsUnweightedUnscaled[year][sample] = TH1D(histName.format(sample)+"_unweightedUnscaled_"+year, histTitle.format(sample)+", unweighted/unscaled", binsToUse, -1, 1)
-                    if not sample in bkgHistsUnweightedUnscaled["fullRunII"]:
-                        bkgHistsUnweightedUnscaled["fullRunII"][sample] = TH1D(histName.format(sample)+"_unweightedUnscaled", histTitle.format(sample)+", unweighted/unscaled", binsToUse, -1, 1)
-                    if not sample in bkgHistsNegWeights:
-                        bkgHistsNegWeights[sample] = TH1D(histName.format(sample)+"_negWeightsOnly", histTitle.format(sample)+", negative weight events", binsToUse, -1, 1)
-                intLumi = intLumiDict[year]
-                xsectionFile = xsectionFiles[year]
-                ParseXSectionFile(xsectionFile)
-                for idx, txtFile in enumerate(backgroundDatasetsDict[sample]):
-                    txtFile = txtFile.format(year, lqMassToUse)
-                    if year=="2016preVFP" and not "SinglePhoton" in txtFile:
-                       txtFile = txtFile.replace(".txt", "_APV.txt")
-                    #tchainBkg = LoadChainFromTxtFile(txtFile.format(lqMassToUse))
-                    tchainBkg = LoadChainFromTxtFile(txtFile)
-                    if tchainBkg is None:
-                        continue
-                    df = RDataFrame(tchainBkg)
-                    df = df.Filter(mycutb.GetTitle())  # will work for expressions valid in C++
-                    if "LQCandidateMass" in variableList:
-                        df = df.Define("massInt", str(lqMassToUse))
-                        df = df.Redefine("LQCandidateMass", "Numba::GetMassFloat(massInt)")
-                    varNamesVec = getattr(ROOT, "BDT{}".format(lqMassToUse)).GetVariableNames()
-                    varNames = []
-                    for v in varNamesVec:
-                        varNames.append(v)
-                    if normalizeVars:
-                        # print("{} varNames: {}".format(len(varNames), varNames))
-                        l_varn = ROOT.std.vector['std::string']()
-                        for i_expr, expr in enumerate(varNames):
-                            varname = 'v_{}'.format(i_expr)
-                            l_varn.push_back(varname)
-                            df=df.Define(varname, '(float)({})'.format(expr))
-                        df = df.Define('BDTv', getattr(ROOT, "computeBDT{}".format(lqMassToUse)), l_varn)
-                    else:
-                        print(getattr(ROOT, "computeBDT{}".format(lqMassToUse)))
-                        df = df.Define('BDTv', getattr(ROOT, "computeBDT{}".format(lqMassToUse)), varNames)
-                    df = df.Define('BDT', 'BDTv[0]')
-                    df = df.Define('eventWeight', eventWeightExpression)
-                    histNameBDT = "BDTVal_{}_{}_{}".format(sample, idx, year)
-                    print("Use hist name {}".format(histNameBDT))
-                    hbkg = TH1D(histNameBDT, histNameBDT, binsToUse, -1, 1)
-                    histBkg = df.Histo1D(ROOT.RDF.TH1DModel(hbkg), "BDT", "eventWeight")
-                    hbkgUnweighted =  TH1D(histNameBDT+"_unweighted", histNameBDT+"_unweighted", binsToUse, -1, 1)
-                    histBkgUnweighted = df.Histo1D(ROOT.RDF.TH1DModel(hbkgUnweighted), "BDT")
-                    hbkNegWeights = TH1D(histNameBDT+"_negWeights", histNameBDT+"_negWeights", binsToUse, -1, 1)
-                    histBkgNegWeights = df.Filter('eventWeight < 0').Histo1D(ROOT.RDF.TH1DModel(hbkNegWeights),"BDT")
-                    #bkgWeight = backgroundDatasetsWeightsTimesOneThousand[os.path.basename(txtFile).replace(".txt", "")]/1000.0
-                    #bkgWeight = FindWeight(os.path.basename(txtFile).replace(".txt", ""), backgroundDatasetsWeightsTimesOneThousand)/1000.0
-                    datasetName = os.path.basename(txtFile).replace(".txt", "")
-                    if "data" not in sample.lower():
-                        sumWeights = GetBackgroundSumWeights(datasetName, txtFile)
-                        bkgWeight = CalcWeight(datasetName, intLumi, sumWeights)
-                    else:
-                        bkgWeight = 1.0
-                    df = df.Define("fullWeight", "eventWeight * {}".format(bkgWeight))
-                    histBkg = histBkg.GetValue()
-                    histBkg.Scale(bkgWeight)
-                    histBkgUnweighted = histBkgUnweighted.GetValue()
-                    for h in [histBkg, histBkgUnweighted]:
-                        nBins = h.GetNbinsX()
-                        overflow = h.GetBinContent(nBins+1)
-                        h.SetBinContent(nBins, h.GetBinContent(nBins)+overflow)
-                        if "QCD" in sample:
-                            continue
-                        for ibin in range(1,nBins+1):
-                            if h.GetBinContent(ibin) < 0:
-                                h.SetBinContent(ibin, 0)
-                    if "QCDFakes_DATA" in sample:
-                        if not "2FR" in sample:
-                            bkgHists[year]["QCDFakes_DATA"].Add(histBkg)
-                            bkgHists["fullRunII"]["QCDFakes_DATA"].Add(histBkg)
-                            bkgHistsUnweightedUnscaled[year]["QCDFakes_DATA"].Add(histBkgUnweighted)
-                            bkgHistsUnweightedUnscaled["fullRunII"]["QCDFakes_DATA"].Add(histBkgUnweighted)
-                            bkgHistsNegWeights["QCDFakes_DATA"].Add(histBkgNegWeights.GetValue())
-                        else:
-                            bkgHists[year]["QCDFakes_DATA_2FR"].Add(histBkg)
-                            bkgHists["fullRunII"]["QCDFakes_DATA_2FR"].Add(histBkg)
-                            bkgHistsUnweightedUnscaled[year]["QCDFakes_DATA_2FR"].Add(histBkgUnweighted)
-                            bkgHistsUnweightedUnscaled["fullRunII"]["QCDFakes_DATA_2FR"].Add(histBkgUnweighted)
-                            bkgHistsNegWeights["QCDFakes_DATA_2FR"].Add(histBkgNegWeights.GetValue())
-                    else:
-                        bkgHists[year][sample].Add(histBkg)
-                        bkgHists["fullRunII"][sample].Add(histBkg)
-                        bkgHistsUnweightedUnscaled[year][sample].Add(histBkgUnweighted)
-                        bkgHistsUnweightedUnscaled["fullRunII"][sample].Add(histBkgUnweighted)
-                        bkgHistsNegWeights[sample].Add(histBkgNegWeights.GetValue())
-                    bkgTotal.Add(histBkg)
-                    #bkgTotalUnweighted.Add(histBkgUnweighted.GetPtr())
-                    bkgTotalUnweighted.Add(histBkgUnweighted)
-                    bkgTotalNegWeightsOnly.Add(histBkgNegWeights.GetValue())
-                    #h = df.Histo1D(hbkg, "BDT", "eventWeight")
-                    #h.Draw()
-                    bkgIntegral = df.Sum("eventWeight").GetValue()*bkgWeight
-                    # bkgIntegralOverCut = df.Filter("BDT > {}".format(cutValForIntegral)).Sum("eventWeight").GetValue()*bkgWeight
-                    # bkgEntriesOverCut = df.Filter("BDT > {}".format(cutValForIntegral)).Count().GetValue()
-                    print("subsample={}, bkgWeight={}".format(txtFile, bkgWeight), flush=True)
-                    print("subsample={}, entries = {}, integral unweighted = {}, integral weighted = {}".format(txtFile, histBkg.GetEntries(), histBkg.Integral()/bkgWeight, histBkg.Integral()), flush=True)
-                    print("subsample={}, df entries = {}, df integral unweighted = {}, df integral weighted = {}".format(txtFile, df.Count().GetValue(), df.Sum("eventWeight").GetValue(), df.Sum("eventWeight").GetValue()*bkgWeight), flush=True)
-                    # print("subsample={}, entries with BDT > {} = {}, integral unweighted = {}, integral weighted = {}".format(txtFile, cutValForIntegral, bkgEntriesOverCut, bkgIntegralOverCut/bkgWeight, bkgIntegralOverCut))
-                    fileToWrite = datasetName
-                    if year=='2016preVFP':
-                        fileToWrite = fileToWrite.replace("_APV","")
-                    if sample == "QCDFakes_DYJ":
-                        fileToWrite += "_QCD"
-                    if "_2FR" in sample:
-                        fileToWrite += "_2FR"
-                    if df.Count().GetValue() <= 0:
-                        print("INFO LQM{}: found empty sample after Meejj cut {} ({})".format(lqMassToUse, datasetName, year))
-                        emptySamples[year].append(fileToWrite)
-                    elif bkgIntegral < 0 and not "QCD" in sample:
-                        print("INFO LQM{}: found negative yield after Meejj cut = {} for dataset {} ({})".format(lqMassToUse, bkgIntegral, datasetName, year))
-                        emptySamples[year].append(fileToWrite)
-                    else:
-                        df.Snapshot('tree',tempDir+'/{}_{}_{}.root'.format(fileToWrite,lqMassToUse,year))
-                    sys.stdout.flush()
-                # print some entries
-                # if sample == "QCDFakes_DATA":
-                #     cols = ROOT.vector('string')()
-                #     cols.push_back("run")
-                #     cols.push_back("event")
-                #     cols.push_back("ls")
-                #     # cols.push_back("eventWeight")
-                #     cols.push_back("sT_eejj")
-                #     cols.push_back("PFMET_Type1_Pt")
-                #     cols.push_back("M_e1e2")
-                #     cols.push_back("M_e1j1")
-                #     cols.push_back("M_e1j2")
-                #     cols.push_back("M_e2j1")
-                #     cols.push_back("M_e2j2")
-                #     cols.push_back("Ele1_Pt")
-                #     cols.push_back("Ele2_Pt")
-                #     cols.push_back("MejMin")
-                #     cols.push_back("MejMax")
-                #     cols.push_back("Meejj")
-                #     cols.push_back("BDT")
-                #     df2 = df.Filter("run==276831 && event==2249978927 && ls==1240")
-                #     display = df2.Display(cols, 5, 20)
-                #     # display.Print()
-                #     print(display.AsString(), flush=True)
-                #
-                # if "photon" in txtFile.lower() and bkgIntegralOverCut > 0:
-                #     cols = ROOT.vector('string')()
-                #     cols.push_back("run")
-                #     cols.push_back("ls")
-                #     cols.push_back("event")
-                #     cols.push_back("BDT")
-                #     cols.push_back("eventWeight")
-                #     display = df.Filter("BDT > {}".format(cutValForIntegral)).Display(cols, 20)
-                #     print("subsample={}, entries over BDT cut unweighted = {}".format(txtFile, display.Print()))
-                #     sys.stdout.flush()
-                #bkgTotIntegralOverCut += bkgIntegralOverCut
-                #bkgSampleIntegralOverCut += bkgIntegralOverCut
-                    bkgSampleIntegral += bkgIntegral
-                    bkgSampleIntegralHist += histBkg.Integral()
-                print("sample={}, events = {} [df], from hist = {}".format(sample, bkgSampleIntegral, bkgSampleIntegralHist), flush=True)
-            #print("sample={}, events over BDT cut = {}".format(sample, bkgSampleIntegralOverCut))
-        # print("bkgIntegralOverCut={}".format(bkgIntegralOverCut), flush=True)
+        if bkgBDTHists is None:
+            bkgBDTHists = FillBackgroundBDTHists({lqMassToUse: bdtWeightFileName}, years, binsToUse)[lqMassToUse]
+        bkgTotal = bkgBDTHists.bkgTotal
+        bkgTotalUnweighted = bkgBDTHists.bkgTotalUnweighted
+        bkgTotalNegWeightsOnly = bkgBDTHists.bkgTotalNegWeightsOnly
+        bkgHists = bkgBDTHists.bkgHists
+        emptySamples = bkgBDTHists.emptySamples
 
         # signal
         histSig = copy.deepcopy(hsig)
@@ -866,7 +1035,7 @@ def OptimizeBDTCut(args):
             tchainSig = LoadDatasets(signalDatasetsDict, neededBranches,"ZJet_amcatnlo_ptBinned", signal=True, loader=None, lqMass=lqMassToUse, years=[year])
             dfSig = RDataFrame(tchainSig)
             dfSig = dfSig.Filter("Meejj > "+str(lqMassToUse))
-            dfSig = dfSig.Range(1,0,2) #Match the way events were selected for the testing set, see the "else" in PrepareCustomTestAndTrainTrees()
+            dfSig = DefineTrainingSplit(dfSig).Filter("!isTrainingEvent") #Match the way events were selected for the testing set, see the "else" in PrepareCustomTestAndTrainTrees()
             dfSig = dfSig.Filter(mycuts.GetTitle())  # will work for expressions valid in C++
         # dfSig = dfSig.Define('BDTv', ROOT.computeBDT, ROOT.BDT.GetVariableNames())
         # dfSig = dfSig.Define('BDTv', getattr(ROOT, "computeBDT{}".format(lqMassToUse)), getattr(ROOT, "BDT{}".format(lqMassToUse)).GetVariableNames())
@@ -923,140 +1092,25 @@ def OptimizeBDTCut(args):
         # now optimize
         #totalSignalEventsUnscaled = GetSignalTotalEvents(lqMassToUse)
         #sumWeights = GetSignalSumWeights(lqMassToUse)
-        fomValueToCutInfoDict = {}
-        unusedFOMs = []
-        fomList = []
-        nSList = []
-        effList = []
-        nBList = []
-        cutValList = []
-        nSErrList = []
-        nBErrList = []
-        effErrList = []
-        for iBin in range(1, hbkg.GetNbinsX()+1):
-            skipFOMCalc = False
-            nSErr = ctypes.c_double()
-            nS = histSig.IntegralAndError(iBin, hsig.GetNbinsX(), nSErr)
-            efficiency = nS/(sumSigWeights)
-            effErr = nSErr.value/(sumSigWeights)  # assuming sumWeights and signalWeight have zero error
-            # nBErr = ctypes.c_double()
-            # nB = bkgTotal.IntegralAndError(iBin, hbkg.GetNbinsX(), nBErr)
-            nB = 0
-            nBErr = 0
-            cutVal = histSig.GetBinLowEdge(iBin)
-            for sample, hist in bkgHists["fullRunII"].items():
-                if "qcd" in sample.lower():
-                    continue
-                nBThisProcessErr = ctypes.c_double()
-                nBThisProcess = hist.IntegralAndError(iBin, hist.GetNbinsX(), nBThisProcessErr)
-                nBThisProcessErr = nBThisProcessErr.value
-                if nBThisProcess < 0:
-                    nBThisProcess = 0
-                    #skipFOMCalc = True
-                    #break
-                nB += nBThisProcess
-                nBErr += nBThisProcessErr*nBThisProcessErr
-            if includeQCD:
-                qcd1FRDataErr = ctypes.c_double()
-                qcd1FRDataYield = bkgHists["fullRunII"]["QCDFakes_DATA"].IntegralAndError(iBin, hist.GetNbinsX(), qcd1FRDataErr)
-                # print("INFO: Fot cutVal={}, Got qcd1FRDataYield={} from hist with integral={} and entries={}".format(cutVal, qcd1FRDataYield, bkgHists["QCDFakes_DATA"].Integral(), bkgHists["QCDFakes_DATA"].GetEntries()))
-                qcd1FRDYJErr = ctypes.c_double()
-                qcd1FRDYJYield = bkgHists["fullRunII"]["QCDFakes_DYJ"].IntegralAndError(iBin, hist.GetNbinsX(), qcd1FRDYJErr)
-                qcd2FRDataErr = ctypes.c_double()
-                qcd2FRDataYield = bkgHists["fullRunII"]["QCDFakes_DATA_2FR"].IntegralAndError(iBin, hist.GetNbinsX(), qcd2FRDataErr)
-                qcd1FRYield = qcd1FRDataYield+qcd1FRDYJYield
-                if qcd1FRYield < 0:
-                    # print("INFO: Limiting 1 FR QCD yield for cutVal {} to zero; old qcd1FRYield = 1FRData-DYJ = {} + {} = {}".format(
-                    #     cutVal, qcd1FRDataYield, qcd1FRDYJYield, qcd1FRYield))
-                    qcd1FRYield = 0
-                limit = 0.5
-                if abs(qcd2FRDataYield) > limit*qcd1FRYield:
-                    # print("INFO: Limiting 2 FR QCD yield for cutVal {} to {} from {}; qcd1FRYield = 1FRData-DYJ = {} + {} = {}; qcdYield = qcd2FRYield + qcd1FRYield = {} + {} = {}".format(
-                    #     cutVal, -1*limit*qcd1FRYield, qcd2FRDataYield, qcd1FRDataYield, qcd1FRDYJYield, qcd1FRYield, -1*limit*qcd1FRYield, qcd1FRYield, -1*limit*qcd1FRYield+qcd1FRYield))
-                    qcd2FRDataYield = -1*limit*qcd1FRYield
-                nB += qcd2FRDataYield+qcd1FRYield
-                if nB<0: #after we're done adding things to nB, if it's still negative then we need to not do the FOM calc.
-                    skipFOMCalc = True
-                nBErr += pow(qcd1FRDataErr.value, 2)+pow(qcd1FRDYJErr.value, 2)+pow(qcd2FRDataErr.value, 2)
-            nBErr = math.sqrt(nBErr)
-            # if nB < 3:
-            # if nS < 5:
-            #      fomValueToCutInfoDict[iBin] = [-1.0, cutVal, nS, efficiency, nB]
-            #      continue
-            # if iBin==9963:
-            #     nSUnweightedErr = ctypes.c_double()
-            #     unweightedNs = histSigUnweighted.IntegralAndError(iBin, hsigUnweighted.GetNbinsX(), nSUnweightedErr)
-            #     nBUnweightedErr = ctypes.c_double()
-            #     unweightedNb = bkgTotalUnweighted.IntegralAndError(iBin, hbkgUnweighted.GetNbinsX(), nBUnweightedErr)
-            #     print("Evaluate figure of merit for nS={}, nB={}, unweightedNs={}, unweightedNb={}".format(nS, nB, unweightedNs, unweightedNb), flush=True)
-            #     exit(0)
-            # require at least one background event expected
-            #if "2016" in year:
-            #    minNB = 0.5
-            #else:
-            #minNB = 1
-            #minNB = 0
-            minNB = 0.5
-            if nB < minNB and not iBin==101: #iBin 101 is cut value == 0. This should mean that if we don't hit minNB by the time the BDT cut becomes negative, then the only FOM that gets evaluated at all is bin 101, meaning that it will be the maximum by definition.
-                skipFOMCalc = True
-             
-            if not skipFOMCalc: #use >0.5 for each of 2016pre and post, so that we have 1 total for 2016
-                # fom = EvaluateFigureOfMerit(nS, nB if nB > 0.0 else 0.0, efficiency, bkgTotalUnweighted.Integral(iBin, hbkg.GetNbinsX()), "punzi")
-                fom = EvaluateFigureOfMerit(nS, nB if nB > 0.0 else 0.0, efficiency, bkgTotalUnweighted.Integral(iBin, hbkg.GetNbinsX()), "asymptotic")
-                # fom = EvaluateFigureOfMerit(nS, nB if nB > 0.0 else 0.0, efficiency, bkgTotalUnweighted.Integral(iBin, hbkg.GetNbinsX()), "zpl")
-                # fom = EvaluateFigureOfMerit(nS, nB if nB > 0.0 else 0.0, efficiency, bkgTotalUnweighted.Integral(iBin, hbkg.GetNbinsX()), "zbi")
-                # fom = EvaluateFigureOfMerit(nS, nB if nB > 0.0 else 0.0, efficiency, bkgTotalUnweighted.Integral(iBin, hbkg.GetNbinsX()), "ssb")
-            else:
-                #we want to know if we could have cut tighter without the minimum bkg requirement
-                unusedFOM = EvaluateFigureOfMerit(nS, nB if nB > 0.0 else 0.0, efficiency, bkgTotalUnweighted.Integral(iBin, hbkg.GetNbinsX()), "asymptotic")
-                unusedFOMs.append(unusedFOM)
-                fom = 0.0
-            fomValueToCutInfoDict[iBin] = [fom, cutVal, nS, nSErr.value, efficiency, nB, nBErr]
-            fomList.append(fom)
-            nSList.append(nS)
-            effList.append(efficiency)
-            nBList.append(nB)
-            cutValList.append(cutVal)
-            nSErrList.append(nSErr.value)
-            nBErrList.append(nBErr)
-            effErrList.append(effErr)
-
-        cutValInfoToUse = []
-        '''
-        if lqMassToUse>=1000:
-            infoLastBin = fomValueToCutInfoDict[hbkg.GetNbinsX()]
-            nBLastBin = infoLastBin[5]
-            if nBLastBin > minNB:
-                cutValInfoToUse = [hbkg.GetNbinsX()]+infoLastBin
-            else:
-                nBThisBin=0
-                maxBin = hbkg.GetNbinsX()
-                for i in range(hbkg.GetNbinsX()):
-                    infoThisBin = fomValueToCutInfoDict[maxBin - i]
-                    nBThisBin = infoThisBin[5]
-                    if nBThisBin > minNB:
-                        cutValInfoToUse = [maxBin - i]+infoThisBin
-                        break
-
-        else:
-        '''
-        # sort by FOM
-        print(sorted(fomValueToCutInfoDict.items(), key=lambda t: float(t[1][0]), reverse=True))
-        sortedDict = OrderedDict(sorted(fomValueToCutInfoDict.items(), key=lambda t: float(t[1][0]), reverse=True))
-        # now the max FOM value should be the first entry
-        maxVal = next(iter(sortedDict.items()))
-        cutValInfoToUse = [maxVal[0]]
-        cutValInfoToUse.extend(maxVal[1])
+        scan = ScanBDTCut(histSig, sumSigWeights, bkgHists["fullRunII"], bkgTotalUnweighted, includeQCD, "asymptotic")
+        # scan = ScanBDTCut(histSig, sumSigWeights, bkgHists["fullRunII"], bkgTotalUnweighted, includeQCD, "punzi")
+        # scan = ScanBDTCut(histSig, sumSigWeights, bkgHists["fullRunII"], bkgTotalUnweighted, includeQCD, "zpl")
+        # scan = ScanBDTCut(histSig, sumSigWeights, bkgHists["fullRunII"], bkgTotalUnweighted, includeQCD, "zbi")
+        # scan = ScanBDTCut(histSig, sumSigWeights, bkgHists["fullRunII"], bkgTotalUnweighted, includeQCD, "ssb")
+        fomList = scan["FOM"].tolist()
+        nSList = scan["nS"].tolist()
+        effList = scan["eff"].tolist()
+        nBList = scan["nB"].tolist()
+        cutValList = scan["cutVal"].tolist()
+        nSErrList = scan["nSErr"].tolist()
+        nBErrList = scan["nBErr"].tolist()
+        effErrList = scan["effErr"].tolist()
+        # the max FOM value; argmax picks the first (loosest) cut in case of ties
+        maxIdx = int(np.argmax(scan["FOM"]))
+        cutValInfoToUse = [maxIdx+1, fomList[maxIdx], cutValList[maxIdx], nSList[maxIdx], nSErrList[maxIdx], effList[maxIdx], nBList[maxIdx], nBErrList[maxIdx]]
+        print("For lqMass={}, max FOM: ibin={} with FOM={}, cutVal={}, nS={}, nSErr={}, eff={}, nB={}, nBErr={}".format(lqMassToUse, *cutValInfoToUse))
         #if cutValInfoToUse[2] < 0:
         #    cutValInfoToUse[2] = 0
-        #print("For lqMass={}, max FOM: ibin={} with FOM={}, cutVal={}, nS={}, eff={}, nB={}".format(lqMassToUse, maxVal[0], *maxVal[1]))
-        # testVals=list(fomValueToCutInfoDict.items())
-        # testVal=testVals[9949]
-        # print("test FOM: ibin={} with FOM={}, cutVal={}, nS={}, eff={}, nB={}".format(testVal[0], *testVal[1]))
-        # testVal=testVals[9948]
-        # print("test FOM: ibin={} with FOM={}, cutVal={}, nS={}, eff={}, nB={}".format(testVal[0], *testVal[1]))
-        # testVal=testVals[9950]
-        # print("test FOM: ibin={} with FOM={}, cutVal={}, nS={}, eff={}, nB={}".format(testVal[0], *testVal[1]))
         #valList = cutValInfoToUse
         #valList.extend(cutValInfoToUse)
         #if len(unusedFOMs)>0 and max(unusedFOMs) > valList[1]:
@@ -2293,6 +2347,33 @@ if __name__ == "__main__":
         help="make ROC plots",
         metavar="ROC",
     )
+    parser.add_option(
+        "-s",
+        "--singlePassBackgrounds",
+        action="store_true",
+        dest="singlePassBackgrounds",
+        default=False,
+        help="for the optimization, read each background dataset once and evaluate the BDTs of all LQ masses in the same event loop",
+        metavar="SINGLEPASSBACKGROUNDS",
+    )
+    parser.add_option(
+        "-j",
+        "--nThreads",
+        dest="nThreads",
+        type=int,
+        default=6,
+        help="number of implicit MT threads for writing the per-sample training/testing trees; 1 to disable",
+        metavar="NTHREADS",
+    )
+    parser.add_option(
+        "-u",
+        "--allowUnrecordedSplit",
+        action="store_true",
+        dest="allowUnrecordedSplit",
+        default=False,
+        help="for the optimization, only warn about BDT weight files with no recorded train/test split (.split.txt) instead of requiring a retrain; use only for weights known to be trained with the current split",
+        metavar="ALLOWUNRECORDEDSPLIT",
+    )
     parser.add_option(
         "-d",
         "--dir",
@@ -2335,11 +2416,16 @@ if __name__ == "__main__":
     #xsectionFiles["2018"] = os.getenv("LQANA")+"/"+xsectionTxt.format(xsectionDate,year)
     train = options.train
     optimize = options.optimize
+    trainingTreeThreads = options.nThreads
+    allowUnrecordedSplit = options.allowUnrecordedSplit
     roc = options.roc
     parallelize = True
     parametrized = False
     includeQCD = True
     normalizeVars = False
+    optimizationBins = 200 #100 # 10000
+    optimizationTempDir = "/tmp/LQM{}"
+    #optimizationTempDir = "LQM{}" #Can use this to save optimization trees to afs space. But only for a couple of masses at a time before you run out of storage space.
     drawTrainingTrees = False
     # normTo = "Meejj"
     #lqMassesToUse = [2700,2800,2900,3000]
@@ -2446,26 +2532,36 @@ if __name__ == "__main__":
         dictOptValues = manager.dict()
         dictOptHists = manager.dict()
         dictOptFOMInfo = manager.dict()
+        massToWeightFile = OrderedDict()
+        for mass in lqMassesToUse:
+            if not parametrized:
+                weightFile = "dataset/weights/TMVAClassification_"+signalNameTemplateD.format(mass)+"_BDTG.weights.xml"
+                #weightFile = os.getenv("LQDATAEOS")+"/BDT_amcatnlo/2016postVFP/febSkims/negWeightComparison/include/dataset/weights/TMVAClassification_"+signalDatasetName+"_BDTG.weights.xml"
+            massToWeightFile[mass] = weightFile.format(mass)
+            dictOptFOMInfo[mass] = manager.dict()
         if parallelize:
             # ncores = multiprocessing.cpu_count()
             ncores = 4  # only use 4 parallel jobs to be nice
             pool = multiprocessing.Pool(ncores,maxtasksperchild=1)
             jobCount = 0
-            for mass in lqMassesToUse:
-                if not parametrized:
-                    signalDatasetName = signalNameTemplate.format(mass)
-                    weightFile = "dataset/weights/TMVAClassification_"+signalNameTemplateD.format(mass)+"_BDTG.weights.xml"
-                    #weightFile = os.getenv("LQDATAEOS")+"/BDT_amcatnlo/2016postVFP/febSkims/negWeightComparison/include/dataset/weights/TMVAClassification_"+signalDatasetName+"_BDTG.weights.xml"
-                dictOptFOMInfo[mass] = manager.dict()
+            if options.singlePassBackgrounds:
+                # each job evaluates the BDTs of its group of masses in one pass over the backgrounds
+                nGroups = min(ncores, len(lqMassesToUse))
+                print("INFO: Evaluate the BDTs of {} LQ masses in {} single passes over the backgrounds.".format(len(lqMassesToUse), nGroups))
+                jobs = [(OptimizeBDTCutsForMasses, [OrderedDict((mass, massToWeightFile[mass]) for mass in lqMassesToUse[iGroup::nGroups]), dictOptValues, dictOptHists, dictOptFOMInfo, years])
+                        for iGroup in range(nGroups)]
+            else:
+                jobs = [(OptimizeBDTCut, [massToWeightFile[mass], mass, dictOptValues, dictOptHists, dictOptFOMInfo, years]) for mass in lqMassesToUse]
+            for jobFunc, jobArgs in jobs:
                 try:
-                    pool.apply_async(OptimizeBDTCut, [[weightFile.format(mass), mass, dictOptValues, dictOptHists, dictOptFOMInfo, years]], callback=log_result)
+                    pool.apply_async(jobFunc, [jobArgs], callback=log_result)
                     jobCount += 1
                 except KeyboardInterrupt:
                     print("\n\nCtrl-C detected: Bailing.")
                     pool.terminate()
                     exit(-1)
                 except Exception as e:
-                    print("ERROR: caught exception in job for LQ mass: {}; exiting".format(mass))
+                    print("ERROR: caught exception in job for LQ mass(es): {}; exiting".format(jobArgs[1] if jobFunc is OptimizeBDTCut else list(jobArgs[0].keys())))
                     traceback.print_exc()
                     exit(-2)
             
@@ -2478,10 +2574,12 @@ if __name__ == "__main__":
             # check results?
             if len(result_list) < jobCount:
                 raise RuntimeError("ERROR: {} jobs had errors. Exiting.".format(jobCount-len(result_list)))
+        elif options.singlePassBackgrounds:
+            print("INFO: Evaluate the BDTs for all {} LQ masses in a single pass over the backgrounds.".format(len(lqMassesToUse)))
+            OptimizeBDTCutsForMasses([massToWeightFile, dictOptValues, dictOptHists, dictOptFOMInfo, years])
         else:
             for mass in lqMassesToUse:
-                dictOptFOMInfo[mass] = manager.dict()
-                OptimizeBDTCut([weightFile.format(mass), mass, dictOptValues, dictOptHists, dictOptFOMInfo, year])
+                OptimizeBDTCut([massToWeightFile[mass], mass, dictOptValues, dictOptHists, dictOptFOMInfo, year])
         optTablesTxtFile = optimizationPlotFile.replace("Plots.root","Tables.txt")
         PrintBDTCuts(dictOptValues, parametrized, dictOptFOMInfo, optTablesTxtFile)
         WriteOptimizationHists(optimizationPlotFile, dictOptHists, dictOptValues, dictOptFOMInfo)